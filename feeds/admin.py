@@ -1,9 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
 # Register your models here.
 from feeds import models
+from feeds.utils import merge_sources
 
 
 class SourceAdmin(admin.ModelAdmin):
@@ -12,6 +13,17 @@ class SourceAdmin(admin.ModelAdmin):
         'posts_link',
     )
 
+    actions = ['merge_sources']
+
+    @admin.action(description='Merge selected sources into one')
+    def merge_sources(self, request, queryset):
+        sources = list(queryset.order_by("-live", "-num_subs", "id"))
+        if len(sources) < 2:
+            self.message_user(request, "Select at least two sources to merge", messages.WARNING)
+            return
+        moved = merge_sources(sources[0], sources[1:])
+        self.message_user(request, "Merged %d sources into %s, moving %d subscriptions" % (len(sources) - 1, sources[0], moved))
+
     def posts_link(self, obj=None):
         if obj.id is None:
             return ''
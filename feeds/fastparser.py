@@ -0,0 +1,556 @@
+"""A quicker parser for well formed RSS 2.0 and Atom feeds.
+
+feedparser will read almost anything, but it pays for that with a handler call
+for every element and run of text, in pure Python.  Most feeds are well formed
+RSS 2.0 or Atom using a handful of elements, so for those :func:`parse` reads
+the document with the standard library's ``iterparse`` instead and builds the
+parts of feedparser's result that this app uses.  feedparser's own sanitizer,
+url resolver and date parser are used on the values, so the Posts and
+Enclosures saved from it are the same as if feedparser had parsed the feed.
+
+Anything this parser isn't sure about makes :func:`parse` return None and the
+caller should then use feedparser as usual.  That is the case for other feed
+formats, encodings other than UTF-8, DOCTYPEs, xml:base, XHTML content, XML
+that isn't well formed, and elements that feedparser gives a meaning to that
+aren't handled here.
+"""
+import re
+from io import BytesIO
+import xml.etree.ElementTree as ET
+
+from feedparser import FeedParserDict
+from feedparser.datetimes import _parse_date
+from feedparser.mixin import _FeedParserMixin, _cp1252
+from feedparser.sanitizer import _sanitize_html
+from feedparser.urls import _urljoin, resolve_relative_uris
+
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+# feedparser's names for the namespaces it knows about
+NAMESPACES = {uri.lower(): prefix for uri, prefix in _FeedParserMixin.namespaces.items()}
+
+# The elements this parser understands, by feedparser's name for them, and the
+# elements (also by name) they can be in.
+MEDIA_ELEMENTS = {
+    "media_group": ("item", "entry"),
+    "media_content": ("item", "entry", "media_group"),
+    "media_title": ("item", "entry", "media_group", "media_content"),
+    "media_description": ("item", "entry", "media_group", "media_content"),
+}
+RSS_ELEMENTS = dict(MEDIA_ELEMENTS, **{
+    "channel": ("rss",),
+    "item": ("channel",),
+    "image": ("channel",),
+    "enclosure": ("item",),
+    "content_encoded": ("item",),
+    "guid": ("item",),
+    "author": ("channel", "item"),
+    "dc_creator": ("channel", "item"),
+    "dc_author": ("channel", "item"),
+    "itunes_author": ("channel", "item"),
+})
+ATOM_ELEMENTS = dict(MEDIA_ELEMENTS, **{
+    "entry": ("feed",),
+    "id": ("feed", "entry"),
+    "summary": ("entry",),
+    "content": ("entry",),
+    "author": ("feed", "entry"),
+    "name": ("author",),
+    "email": ("author",),
+    "uri": ("author",),
+})
+# these can go in the channel or item (RSS) or feed or entry (Atom)
+COMMON_ELEMENTS = {"title", "link", "description", "subtitle", "itunes_summary", "itunes_subtitle", "itunes_image"}
+CONTAINERS = {"channel", "item", "feed", "entry"}
+
+# the elements of an RSS <image>, which all go into the feed's image
+IMAGE_ELEMENTS = {"url", "title", "link", "description", "width", "height"}
+
+# Elements feedparser handles that don't change anything this app reads, so can
+# be skipped wherever they are.
+IGNORED_ELEMENTS = {
+    "category", "keywords", "tags", "dc_subject", "itunes_category", "itunes_keywords",
+    "itunes_explicit", "itunes_block", "itunes_owner", "itunes_name", "itunes_email",
+    "media_category", "media_keywords", "media_rating", "media_credit", "media_restriction",
+    "media_license", "media_thumbnail", "media_player", "psc_chapters", "psc_chapter",
+    "language", "dc_language", "copyright", "dc_rights", "rights", "generator", "cloud",
+    "width", "height", "managingeditor", "webmaster", "dc_publisher", "feedburner_browserfriendly",
+}
+
+DATE_ELEMENTS = {
+    "pubdate": "published",
+    "published": "published",
+    "issued": "published",
+    "dcterms_issued": "published",
+    "dc_date": "updated",
+    "updated": "updated",
+    "modified": "updated",
+    "dcterms_modified": "updated",
+    "lastbuilddate": "updated",
+    "dcterms_created": "created",
+}
+
+# The content type feedparser assumes for each text element
+CONTENT_TYPES = {
+    "title": "text/plain",
+    "description": "text/html",
+    "content_encoded": "text/html",
+    "summary": "text/plain",
+    "itunes_summary": "text/plain",
+    "content": "text/plain",
+    "subtitle": "text/plain",
+    "itunes_subtitle": "text/plain",
+    "media_title": "text/plain",
+    "media_description": "text/html",
+}
+# and the element feedparser treats them as
+TEXT_ALIASES = {
+    "itunes_summary": "summary",
+    "itunes_subtitle": "subtitle",
+    "content_encoded": "content",
+    "media_title": "title",
+    "media_description": "description",
+}
+
+# Elements that should only have text in them
+TEXT_ELEMENTS = set(CONTENT_TYPES) | set(DATE_ELEMENTS) | {
+    "guid", "id", "link", "url", "dc_creator", "dc_author", "itunes_author", "name", "email", "uri",
+}
+
+
+EMAIL_RE = re.compile(r"""(([a-zA-Z0-9\_\-\.\+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,4}|[0-9]{1,3})(\]?))(\?subject=\S+)?""")
+
+
+class Unsupported(Exception):
+    """Raised while parsing when a feed needs to be left to feedparser"""
+    pass
+
+
+def parse(content):
+    """Parses an RSS 2.0 or Atom feed if it can be done without feedparser.
+
+    :param content: The feed document.
+    :type content: bytes
+
+    :return: A FeedParserDict like ``feedparser.parse`` returns (with the **feed** and
+        **entries** this app uses), or None if the feed should be given to feedparser.
+    :rtype: FeedParserDict
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    if not _is_simple_xml(content):
+        return None
+
+    try:
+        return _FastParser().parse(content)
+    except (Unsupported, ET.ParseError):
+        return None
+
+
+def _is_simple_xml(content: bytes) -> bool:
+    # UTF-8 only, without a DOCTYPE (feedparser rewrites those) or anything before
+    # the first element that the XML parser and feedparser might disagree about.
+    if content.startswith(b"\xef\xbb\xbf"):
+        content = content[3:]
+    start = re.search(rb"<\w", content)
+    if start is None:
+        return False
+    head = content[:start.start()]
+    if b"<!doctype" in head.lower() or b"<!entity" in head.lower():
+        return False
+    declared = re.search(rb"""encoding\s*=\s*["']([\w.:-]+)["']""", head[:200])
+    if declared and declared.group(1).lower() not in (b"utf-8", b"utf8", b"us-ascii", b"ascii"):
+        return False
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class _FastParser(object):
+
+    def __init__(self):
+        self.feed = FeedParserDict()
+        self.entries = []
+        self.version = None
+        self.entry = None
+        self.has_content = False
+        self.title_depth = -1
+        self.depths = {}  # how deep in the document each of an entry's values came from
+
+        self.prefixes = {}  # namespace -> first prefix the document gave it
+        self.decls = {}  # namespaces declared on the next element
+        self.stack = []  # the open elements
+
+    def parse(self, content: bytes) -> FeedParserDict:
+        for event, item in ET.iterparse(BytesIO(content), events=("start-ns", "start", "end")):
+            if event == "start-ns":
+                prefix, uri = item
+                self.prefixes.setdefault(uri, prefix)
+                self.decls["xmlns:" + prefix if prefix else "xmlns"] = uri
+            elif event == "start":
+                self.start(item)
+            else:
+                self.end(item)
+                item.clear()
+
+        if self.version is None:
+            raise Unsupported()
+
+        return FeedParserDict(
+            feed=self.feed,
+            entries=self.entries,
+            bozo=False,
+            version=self.version,
+            encoding="utf-8",
+            namespaces={},
+        )
+
+    def name(self, tag: str) -> str:
+        # feedparser's name for an element, e.g. content_encoded for <content:encoded>
+        if tag[0] != "{":
+            return tag.lower()
+        uri, local = tag[1:].split("}", 1)
+        lower_uri = uri.lower()
+        if "backend.userland.com/rss" in lower_uri:
+            prefix = ""
+        else:
+            prefix = NAMESPACES.get(lower_uri, self.prefixes.get(uri))
+        if prefix:
+            return prefix.lower() + "_" + local.lower()
+        return local.lower()
+
+    def attrs(self, elem) -> dict:
+        attrs_d, self.decls = self.decls, {}
+        for key, value in elem.attrib.items():
+            if key[0] == "{":
+                uri, local = key[1:].split("}", 1)
+                prefix = NAMESPACES.get(uri.lower(), "")
+                if prefix:
+                    attrs_d[(prefix + ":" + local).lower()] = value
+                else:
+                    attrs_d[local.lower()] = value
+                given = "xml" if uri == "http://www.w3.org/XML/1998/namespace" else self.prefixes.get(uri)
+                if given:
+                    attrs_d[(given + ":" + local).lower()] = value
+            else:
+                attrs_d[key.lower()] = value
+        for key in ("rel", "type"):
+            if key in attrs_d:
+                attrs_d[key] = attrs_d[key].lower()
+        return attrs_d
+
+    @property
+    def context(self) -> dict:
+        return self.feed if self.entry is None else self.entry
+
+    @property
+    def lang(self) -> str:
+        return self.stack[-1][1] if self.stack else None
+
+    def start(self, elem):
+        name = self.name(elem.tag)
+        attrs_d = self.attrs(elem)
+        parent = self.stack[-1][0] if self.stack else None
+
+        if "xml:base" in attrs_d or "base" in attrs_d:
+            raise Unsupported("xml:base")
+
+        lang = attrs_d.get("xml:lang", attrs_d.get("lang"))
+        if lang == "":
+            lang = None
+        elif lang is None:
+            lang = self.lang
+        # name, language and whether the text is kept as it is when the element ends
+        self.stack.append((name, lang, False))
+
+        if parent is None:
+            self.start_root(elem, name, attrs_d)
+            return
+
+        if parent in TEXT_ELEMENTS or (parent == "author" and self.version == "rss20"):
+            raise Unsupported(f"markup in {parent}")
+
+        if parent == "image":
+            if name not in IMAGE_ELEMENTS:
+                raise Unsupported(f"{name} in image")
+            return
+
+        allowed = RSS_ELEMENTS.get(name) if self.version == "rss20" else ATOM_ELEMENTS.get(name)
+        if allowed:
+            if parent not in allowed:
+                raise Unsupported(f"{name} in {parent}")
+        elif name in COMMON_ELEMENTS or name in DATE_ELEMENTS:
+            if parent not in CONTAINERS:
+                raise Unsupported(f"{name} in {parent}")
+        elif name in IGNORED_ELEMENTS:
+            return
+        elif hasattr(_FeedParserMixin, "_start_" + name) or hasattr(_FeedParserMixin, "_end_" + name):
+            raise Unsupported(name)
+        elif attrs_d:
+            # feedparser keeps the attributes of elements it doesn't know...
+            self.context[name] = attrs_d
+            return
+        else:
+            # ...or their text if they don't have any
+            self.stack[-1] = (name, lang, True)
+            return
+
+        handler = getattr(self, "start_" + name, None)
+        if handler:
+            handler(attrs_d)
+
+        if name in CONTENT_TYPES:
+            self.start_text(name, attrs_d)
+
+    def start_root(self, elem, name: str, attrs_d: dict):
+        if elem.tag == "rss" and attrs_d.get("version", "").startswith("2."):
+            self.version = "rss20"
+        elif elem.tag == "{%s}feed" % ATOM_NS and not attrs_d.get("version"):
+            self.version = "atom10"
+        else:
+            raise Unsupported(elem.tag)
+        if self.lang:
+            self.feed["language"] = self.lang.replace("_", "-")
+
+    def start_item(self, attrs_d: dict):
+        if "rdf:about" in attrs_d:
+            raise Unsupported("rdf:about")
+        self.entry = FeedParserDict()
+        self.entries.append(self.entry)
+        self.guid_is_link = False
+        self.title_depth = -1
+
+    start_entry = start_item
+
+    def start_image(self, attrs_d: dict):
+        if self.entry is not None:
+            raise Unsupported("image in item")
+        self.feed.setdefault("image", FeedParserDict())
+        self.title_depth = -1
+
+    def start_itunes_image(self, attrs_d: dict):
+        href = attrs_d.get("href") or attrs_d.get("url")
+        if href:
+            self.context["image"] = FeedParserDict({"href": href})
+
+    def start_link(self, attrs_d: dict):
+        attrs_d.setdefault("rel", "alternate")
+        if attrs_d["rel"] == "self":
+            attrs_d.setdefault("type", "application/atom+xml")
+        else:
+            attrs_d.setdefault("type", "text/html")
+        attrs_d = _enforce_href(attrs_d)
+        if "href" in attrs_d:
+            attrs_d["href"] = _urljoin("", attrs_d["href"])
+        context = self.context
+        context.setdefault("links", []).append(FeedParserDict(attrs_d))
+        if "href" in attrs_d and attrs_d["rel"] == "alternate" and _FeedParserMixin.map_content_type(attrs_d["type"]) in _FeedParserMixin.html_types:
+            context["link"] = attrs_d["href"]
+
+    def start_enclosure(self, attrs_d: dict):
+        attrs_d = _enforce_href(attrs_d)
+        attrs_d["rel"] = "enclosure"
+        self.context.setdefault("links", []).append(FeedParserDict(attrs_d))
+
+    def start_media_content(self, attrs_d: dict):
+        self.context.setdefault("media_content", []).append(attrs_d)
+
+    def start_guid(self, attrs_d: dict):
+        self.guid_is_link = attrs_d.get("ispermalink", "true") == "true"
+
+    start_id = start_guid
+
+    def start_author(self, attrs_d: dict):
+        self.context.setdefault("authors", []).append(FeedParserDict())
+
+    start_dc_creator = start_dc_author = start_itunes_author = start_author
+
+    def start_text(self, name: str, attrs_d: dict):
+        element = TEXT_ALIASES.get(name, name)
+        self.as_content = element == "content"
+        if element in ("description", "summary") and "summary" in self.context and not self.has_content:
+            # feedparser takes a second description as the content
+            self.as_content = True
+            self.content_type = _FeedParserMixin.map_content_type(attrs_d.get("type", "text/plain"))
+        else:
+            self.content_type = _FeedParserMixin.map_content_type(attrs_d.get("type", CONTENT_TYPES[name]))
+
+        if self.as_content:
+            if "src" in attrs_d:
+                raise Unsupported("out of line content")
+            self.has_content = True
+
+        if not self.content_type.startswith("text/"):
+            raise Unsupported(self.content_type)
+
+    def end(self, elem):
+        depth = len(self.stack)
+        name, lang, keep_text = self.stack.pop()
+        parent = self.stack[-1][0] if self.stack else None
+        text = elem.text or ""
+
+        if keep_text:
+            text += "".join(child.tail or "" for child in elem)
+            self.store(name, finish(name, text), depth)
+        elif parent == "image":
+            if name == "url":
+                self.feed["image"]["href"] = finish("href", text)
+        elif name in CONTENT_TYPES:
+            self.end_text(name, text, lang, depth)
+        elif parent not in CONTAINERS and parent != "author":
+            return
+        elif name in ("item", "entry"):
+            self.entry = None
+            self.has_content = False
+        elif name in DATE_ELEMENTS:
+            key = DATE_ELEMENTS[name]
+            value = self.store(key, finish(key, text), depth)
+            self.context[key + "_parsed"] = _parse_date(value)
+        elif name in ("guid", "id"):
+            value = self.store("id", finish("id", text, resolve=self.guid_is_link), depth)
+            if self.guid_is_link:
+                self.context.setdefault("link", value)
+        elif name == "link" and "href" not in self.context.get("links", [{}])[-1]:
+            self.end_link(text)
+        elif name in ("author", "dc_creator", "dc_author", "itunes_author"):
+            self.end_author(text, depth)
+        elif name in ("name", "email"):
+            self.save_author(name, text.strip())
+        elif name == "uri":
+            self.save_author("href", self.store("href", finish("href", text), depth))
+
+    def store(self, key: str, value: str, depth: int) -> str:
+        # Like feedparser, a value from deeper in an entry doesn't replace one
+        # from further up, e.g. a <media:title> doesn't replace the <title>.
+        if self.entry is not None:
+            old_depth = self.depths.get((id(self.entry), key))
+            if old_depth is not None and depth > old_depth:
+                return value
+            self.depths[(id(self.entry), key)] = depth
+        self.context[key] = value
+        return value
+
+    def end_text(self, name: str, text: str, lang: str, depth: int):
+        element = "content" if self.as_content else TEXT_ALIASES.get(name, name)
+        content_type = self.content_type
+        if self.version != "atom10" and content_type == "text/plain" and _FeedParserMixin.looks_like_html(text.strip()):
+            content_type = "text/html"
+        value = finish(element, text, content_type)
+
+        detail = FeedParserDict({"type": content_type, "language": lang.replace("_", "-") if lang else lang, "base": "", "value": value})
+
+        context = self.context
+        if element == "content":
+            if self.entry is None:
+                context["content"] = value
+                context["content_detail"] = detail
+            else:
+                context.setdefault("content", []).append(detail)
+            if self.content_type in ("text/plain", "text/html"):
+                context.setdefault("summary", value)
+            return
+
+        if element == "title":
+            if -1 < self.title_depth <= depth:
+                return
+            if value and name == "title":
+                self.title_depth = depth
+
+        if element == "description":
+            element = "subtitle" if self.entry is None else "summary"
+
+        self.store(element, value, depth)
+        context[element + "_detail"] = detail
+
+    def end_link(self, text: str):
+        value = finish("link", text)
+        context = self.context
+        if self.entry is not None:
+            value = value.replace("&amp;", "&")
+        value = re.sub("&([A-Za-z0-9_]+);", r"&\g<1>", value)
+        context["link"] = value
+        if value:
+            context["links"][-1]["href"] = value
+
+    def end_author(self, text: str, depth: int):
+        self.store("author", finish("author", text), depth)
+        self.sync_author()
+
+    def save_author(self, key: str, value: str):
+        context = self.context
+        context.setdefault("author_detail", FeedParserDict())[key] = value
+        self.sync_author()
+        context.setdefault("authors", [FeedParserDict()])[-1][key] = value
+
+    def sync_author(self):
+        # feedparser's _sync_author_detail, quirks and all, as it decides what author is
+        context = self.context
+        detail = context.get("authors", [FeedParserDict()])[-1]
+        if detail:
+            name = detail.get("name")
+            email = detail.get("email")
+            if name and email:
+                context["author"] = "%s (%s)" % (name, email)
+            elif name:
+                context["author"] = name
+            elif email:
+                context["author"] = email
+            return
+
+        author, email = context.get("author"), None
+        if not author:
+            return
+        match = EMAIL_RE.search(author)
+        if match:
+            email = match.group(0)
+            author = author.replace(email, "").replace("()", "").replace("<>", "").replace("&lt;&gt;", "").strip()
+            if author and author[0] == "(":
+                author = author[1:]
+            if author and author[-1] == ")":
+                author = author[:-1]
+            author = author.strip()
+        if author or email:
+            context.setdefault("author_detail", detail)
+        if author:
+            detail["name"] = author
+        if email:
+            detail["email"] = email
+
+
+def _enforce_href(attrs_d: dict) -> dict:
+    href = attrs_d.get("url", attrs_d.get("uri", attrs_d.get("href", None)))
+    if href:
+        attrs_d.pop("url", None)
+        attrs_d.pop("uri", None)
+        attrs_d["href"] = href
+    return attrs_d
+
+
+def finish(element: str, text: str, content_type: str = "text/html", resolve: bool = True) -> str:
+    """Cleans up the text of an element the way feedparser does before it's stored.
+
+    That is, relative urls are resolved, HTML is sanitized and some common
+    encoding mistakes are undone.
+    """
+    output = text.strip()
+
+    if resolve and element in _FeedParserMixin.can_be_relative_uri and output:
+        output = _urljoin("", output)
+
+    if content_type in _FeedParserMixin.html_types and ("<" in output or ">" in output or "&" in output or "\r" in output):
+        if element in _FeedParserMixin.can_contain_relative_uris:
+            output = resolve_relative_uris(output, "", "utf-8", content_type)
+        if element in _FeedParserMixin.can_contain_dangerous_markup:
+            output = _sanitize_html(output, "utf-8", content_type)
+
+    # text that was UTF-8 but was read as iso-8859-1
+    try:
+        output = output.encode("iso-8859-1").decode("utf-8")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        pass
+
+    return output.translate(_cp1252)
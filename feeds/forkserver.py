@@ -0,0 +1,6 @@
+"""Preloaded by the fork server that parse sandboxes are started from while the poller has
+other threads running (see :func:`feeds.utils_internal.parse_in_sandbox`), so that Django
+is already set up in every sandbox it forks."""
+import django
+
+django.setup()
@@ -0,0 +1,398 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import datetime
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+HOST_CONCURRENCY = 2
+if hasattr(settings, "FEEDS_HOST_CONCURRENCY"):
+    HOST_CONCURRENCY = settings.FEEDS_HOST_CONCURRENCY
+
+HOST_RATE = 1.0
+if hasattr(settings, "FEEDS_HOST_RATE"):
+    HOST_RATE = settings.FEEDS_HOST_RATE
+
+HOST_MAX_WAIT = 30
+if hasattr(settings, "FEEDS_HOST_MAX_WAIT"):
+    HOST_MAX_WAIT = settings.FEEDS_HOST_MAX_WAIT
+
+HOST_FAILURES = 3
+if hasattr(settings, "FEEDS_HOST_FAILURES"):
+    HOST_FAILURES = settings.FEEDS_HOST_FAILURES
+
+HOST_COOLDOWN = 300
+if hasattr(settings, "FEEDS_HOST_COOLDOWN"):
+    HOST_COOLDOWN = settings.FEEDS_HOST_COOLDOWN
+
+FETCH_TIMEOUT = 20
+if hasattr(settings, "FEEDS_FETCH_TIMEOUT"):
+    FETCH_TIMEOUT = settings.FEEDS_FETCH_TIMEOUT
+
+FETCH_DEADLINE = 60
+if hasattr(settings, "FEEDS_FETCH_DEADLINE"):
+    FETCH_DEADLINE = settings.FEEDS_FETCH_DEADLINE
+
+# How long to leave a host alone if it tells us to slow down without saying for how long
+HOST_DEFAULT_PAUSE = 60
+
+# The shortest timeout used for a host, however quick it has been
+MIN_TIMEOUT = 5
+
+# The longest a circuit stays open before the host is tried again
+MAX_COOLDOWN = 60 * 60 * 24
+
+
+class HostDeferred(Exception):
+    """Raised when a host can't be fetched from within the allowed wait"""
+    pass
+
+
+class HostUnavailable(HostDeferred):
+    """Raised when a host's circuit is open because it keeps failing"""
+    pass
+
+
+def get_host(url: str) -> str:
+    """The host part of a url, lower cased.  Used to group feeds by server."""
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+# Other names that feedburner feeds are known by
+FEEDBURNER_HOSTS = {"feeds2.feedburner.com", "feedproxy.google.com", "feedburner.com", "www.feedburner.com"}
+
+
+def canonical_url(url: str) -> str:
+    """A key for a feed url that is the same for urls that fetch the same feed.
+
+    The scheme, default ports, fragment and trailing slash are dropped and the
+    host is lower cased, so ``http://Example.com/feed/`` and
+    ``https://example.com:443/feed`` are both ``example.com/feed``.  Feedburner's
+    aliases all become ``feeds.feedburner.com``.  This is only for comparing
+    urls, it can't be fetched.
+    """
+    url = (url or "").strip()
+    try:
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url.lower()
+
+    query = parts.query
+    if host in FEEDBURNER_HOSTS:
+        host = "feeds.feedburner.com"
+    if host == "feeds.feedburner.com":
+        query = ""  # ?format=xml and the like
+
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+
+    path = parts.path.rstrip("/")
+    if query:
+        path = f"{path}?{query}"
+
+    return host + path
+
+
+def interleave_by_host(sources: list) -> list:
+    """Reorders a batch of Sources so consecutive feeds are on different hosts.
+
+    Sources are grouped by the host of their **feed_url** and then taken from each
+    host in turn, keeping the original order within a host.  This spreads out the
+    requests to busy hosts while the batch as a whole keeps moving.
+    """
+    groups = {}
+    for src in sources:
+        groups.setdefault(get_host(src.feed_url), []).append(src)
+
+    ordered = []
+    queues = list(groups.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [q for q in queues if q]
+
+    return ordered
+
+
+def parse_retry_after(value: str) -> Optional[float]:
+    """Parses a Retry-After header (either a number of seconds or an HTTP date).
+
+    :return: The number of seconds to wait, or None if the header can't be understood.
+    :rtype: float
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+
+def _advertised_pause(ret) -> Optional[float]:
+    # How long the server has asked us to stay away for, if at all.
+    headers = ret.headers
+
+    if ret.status_code in (429, 503):
+        pause = parse_retry_after(headers.get("Retry-After"))
+        if pause is None and ret.status_code == 429:
+            pause = HOST_DEFAULT_PAUSE
+        return pause
+
+    for prefix in ("RateLimit", "X-RateLimit"):
+        remaining = headers.get(f"{prefix}-Remaining")
+        if remaining is not None and remaining.strip() == "0":
+            try:
+                reset = float(headers.get(f"{prefix}-Reset"))
+            except (TypeError, ValueError):
+                return HOST_DEFAULT_PAUSE
+            if reset > 1000000000:
+                # some servers send an epoch time rather than a number of seconds
+                reset -= time.time()
+            return max(reset, 0)
+
+    return None
+
+
+class HostLimiter(object):
+    """Keeps the requests made to any one host at a polite level.
+
+    No more than **concurrency** requests are in flight to a host at once and
+    new requests to a host start no more often than **rate** times a second.
+    Hosts that answer with a 429 / 503 and a Retry-After, or that send RateLimit
+    headers saying we have run out, are left alone for as long as they ask.
+
+    If a host can't be fetched from within **max_wait** seconds then
+    :class:`HostDeferred` is raised so the feed can be left for a later run
+    rather than holding up a worker.
+
+    One HostLimiter is shared by all of the workers in an update run and it can
+    be used from threads (:meth:`slot`) or from asyncio (:meth:`aslot`).
+    """
+
+    def __init__(self, concurrency: int = None, rate: float = None, max_wait: float = None):
+        self.concurrency = concurrency or HOST_CONCURRENCY
+        self.min_delay = 1.0 / (rate or HOST_RATE)
+        self.max_wait = HOST_MAX_WAIT if max_wait is None else max_wait
+
+        self._condition = threading.Condition()
+        self._active = {}
+        self._next_start = {}
+
+    def _try_acquire(self, host: str, deadline: float) -> float:
+        # Takes a slot for the host if one is free and returns 0, otherwise
+        # returns how long to wait before trying again.  Call with the lock held.
+        now = time.monotonic()
+        wait = self._next_start.get(host, now) - now
+        if wait > 0:
+            if now + wait > deadline:
+                raise HostDeferred(f"{host} is not accepting requests for another {int(wait)}s")
+            return wait
+
+        if self._active.get(host, 0) >= self.concurrency:
+            if now > deadline:
+                raise HostDeferred(f"{host} already has {self.concurrency} requests in flight")
+            return 0.1
+
+        self._active[host] = self._active.get(host, 0) + 1
+        self._next_start[host] = now + self.min_delay
+        return 0
+
+    def _release(self, host: str):
+        with self._condition:
+            self._active[host] -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, url: str):
+        """Context manager that waits until it's OK to make a request to the host of **url**."""
+        host = get_host(url)
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            wait = self._try_acquire(host, deadline)
+            while wait:
+                self._condition.wait(wait)
+                wait = self._try_acquire(host, deadline)
+        try:
+            yield
+        finally:
+            self._release(host)
+
+    @asynccontextmanager
+    async def aslot(self, url: str):
+        """Async version of :meth:`slot`."""
+        host = get_host(url)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._condition:
+                wait = self._try_acquire(host, deadline)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        try:
+            yield
+        finally:
+            self._release(host)
+
+    def resume_time(self, url: str) -> Optional[datetime.datetime]:
+        """When the host of **url** will take another request, or None if it already will.
+
+        :rtype: datetime
+        """
+        with self._condition:
+            wait = self._next_start.get(get_host(url), 0) - time.monotonic()
+        if wait <= 0:
+            return None
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=wait)
+
+    def note_response(self, url: str, ret):
+        """Records any limits the host of **url** advertised in its response."""
+        pause = _advertised_pause(ret)
+        if pause:
+            host = get_host(url)
+            with self._condition:
+                self._next_start[host] = max(self._next_start.get(host, 0), time.monotonic() + pause)
+
+
+# Per-host health is kept in Django's cache so that it is shared by every
+# worker (and, with a shared cache backend, every poller).  The lock only
+# stops the workers in this process from losing each other's updates.
+_health_lock = threading.Lock()
+
+
+def _health_key(host: str) -> str:
+    return f"feeds:host:{host}"
+
+
+def _get_health(host: str) -> dict:
+    return cache.get(_health_key(host)) or {"failures": 0, "open_until": None, "cooldown": 0, "latency": None, "deviation": 0}
+
+
+def _set_health(host: str, health: dict):
+    cache.set(_health_key(host), health, timeout=MAX_COOLDOWN)
+
+
+def _probe_key(host: str) -> str:
+    return f"{_health_key(host)}:probe"
+
+
+def check_host(url: str) -> Optional[str]:
+    """Checks that the host of **url** can be fetched from.
+
+    While a host's circuit is open :class:`HostUnavailable` is raised.  Once the
+    cooldown is over a single request is let through to probe the host, and
+    everyone else is turned away until it has either succeeded (closing the
+    circuit) or failed (opening it again for twice as long).
+
+    :return: If this request is the probe, a token to pass to :func:`record_failure` or
+        :func:`release_probe` with its outcome, otherwise None.
+    :rtype: str
+    """
+    host = get_host(url)
+    health = _get_health(host)
+    if health["open_until"] is None:
+        return None
+
+    wait = health["open_until"] - time.time()
+    if wait > 0:
+        raise HostUnavailable(f"{host} is failing, not trying it again for another {int(wait)}s")
+
+    # the probe's outcome clears the key, the timeout only matters if its poller dies
+    probe = uuid.uuid4().hex
+    if not cache.add(_probe_key(host), probe, timeout=HOST_MAX_WAIT + FETCH_DEADLINE + FETCH_TIMEOUT * 2):
+        raise HostUnavailable(f"{host} is failing and is already being probed")
+    return probe
+
+
+def release_probe(url: str, probe: Optional[str]):
+    """Lets another request probe the host of **url** when the probe **probe** ended
+    without showing whether the host is up (it was deferred, or failed for a reason
+    that was down to the feed)."""
+    if probe is not None:
+        key = _probe_key(get_host(url))
+        if cache.get(key) == probe:
+            cache.delete(key)
+
+
+def host_timeouts(url: str) -> tuple:
+    """The (connect, read) timeouts to use for the host of **url**.
+
+    These come from how long the host has been taking to respond: the average
+    plus four times the average deviation (as TCP does), kept between 5 seconds
+    and **FEEDS_FETCH_TIMEOUT**.  Hosts we haven't seen before get the full timeout.
+    """
+    health = _get_health(get_host(url))
+    if health["latency"] is None:
+        return (FETCH_TIMEOUT, FETCH_TIMEOUT)
+    read = min(max(health["latency"] + 4 * health["deviation"], MIN_TIMEOUT), FETCH_TIMEOUT)
+    return (max(read / 2, MIN_TIMEOUT), read)
+
+
+def record_success(url: str, seconds: float):
+    """Records that the host of **url** responded, taking **seconds** to do it.  Closes its circuit."""
+    host = get_host(url)
+    with _health_lock:
+        health = _get_health(host)
+        if health["latency"] is None:
+            health["latency"] = seconds
+            health["deviation"] = seconds / 2
+        else:
+            health["deviation"] = 0.75 * health["deviation"] + 0.25 * abs(seconds - health["latency"])
+            health["latency"] = 0.875 * health["latency"] + 0.125 * seconds
+        health["failures"] = 0
+        health["open_until"] = None
+        health["cooldown"] = 0
+        _set_health(host, health)
+    cache.delete(_probe_key(host))
+
+
+def record_failure(url: str, probe: Optional[str] = None) -> Optional[datetime.datetime]:
+    """Records a connection error or timeout from the host of **url**.
+
+    After **FEEDS_HOST_FAILURES** failures in a row, or if a probe fails, the
+    host's circuit is opened for **FEEDS_HOST_COOLDOWN** seconds, doubling each
+    time it fails again up to a day.
+
+    :param probe: The token :func:`check_host` gave the request, if it was the probe.
+    :type probe: str
+
+    :return: When the circuit will next let a request through if it was just opened, otherwise None.
+    :rtype: datetime
+    """
+    host = get_host(url)
+    with _health_lock:
+        health = _get_health(host)
+        health["failures"] += 1
+        if health["open_until"] is None:
+            opened = health["failures"] >= HOST_FAILURES
+        else:
+            # only the probe can reopen it, anything else was already in flight
+            opened = probe is not None and cache.get(_probe_key(host)) == probe
+        if opened:
+            health["cooldown"] = min(health["cooldown"] * 2 or HOST_COOLDOWN, MAX_COOLDOWN)
+            health["open_until"] = time.time() + health["cooldown"]
+        _set_health(host, health)
+    release_probe(url, probe)
+
+    if opened:
+        return datetime.datetime.fromtimestamp(health["open_until"], datetime.timezone.utc)
+    return None
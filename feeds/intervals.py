@@ -0,0 +1,247 @@
+import datetime
+from email.utils import parsedate_to_datetime
+import re
+from typing import Optional
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from feeds.hosts import parse_retry_after
+from feeds.models import Source, Post
+
+
+INTERVAL_POLICY = "feeds.intervals.HeuristicPolicy"
+if hasattr(settings, "FEEDS_INTERVAL_POLICY"):
+    INTERVAL_POLICY = settings.FEEDS_INTERVAL_POLICY
+
+MAX_HINT_MINUTES = 60 * 24
+if hasattr(settings, "FEEDS_MAX_HINT_MINUTES"):
+    MAX_HINT_MINUTES = settings.FEEDS_MAX_HINT_MINUTES
+
+
+# What happened when a feed was polled
+UPDATED = "updated"
+"""The feed had new posts"""
+
+UNCHANGED = "unchanged"
+"""The feed was fetched and parsed but had nothing new"""
+
+NOT_MODIFIED = "not_modified"
+"""The server told us the feed hadn't changed (304, an empty delta or the same content as last time)"""
+
+ERROR = "error"
+"""The feed couldn't be fetched or parsed"""
+
+REDIRECT_FAILED = "redirect_failed"
+"""The feed sent a temporary redirect that couldn't be followed"""
+
+OTHER = "other"
+"""Anything else, e.g. the feed has been disabled or is blocked"""
+
+
+class IntervalPolicy(object):
+    """Decides how many minutes to wait before polling a feed again.
+
+    To use your own policy, subclass this, implement :meth:`next_interval` and set
+    **FEEDS_INTERVAL_POLICY** in settings to the dotted path of your class.
+    """
+
+    min_interval = 60
+    """**int** The shortest interval in minutes that will be used (1 hour)"""
+
+    max_interval = 60 * 24
+    """**int** The longest interval in minutes that will be used (1 day)"""
+
+    def next_interval(self, source_feed: Source, outcome: str) -> float:
+        """Works out the new interval for a feed that has just been polled.
+
+        :param source_feed: The Source that was polled, **interval** is still the old interval.
+        :type source_feed: Source
+
+        :param outcome: What happened, one of the outcome constants in this module.
+        :type outcome: str
+
+        :return: The number of minutes until the feed should be polled again.
+        :rtype: float
+        """
+        raise NotImplementedError()
+
+    def clamp(self, interval: float) -> float:
+        """Keeps an interval between **min_interval** and **max_interval**"""
+        return min(max(interval, self.min_interval), self.max_interval)
+
+
+class HeuristicPolicy(IntervalPolicy):
+    """The default policy.
+
+    Halves the interval whenever a feed has new posts and slowly backs off when
+    it doesn't, more quickly if there was an error.
+    """
+
+    backoff = {
+        UNCHANGED: 20,  # we slow down feeds a little more that don't send headers we can use
+        NOT_MODIFIED: 10,
+        ERROR: 120,
+        REDIRECT_FAILED: 60,
+    }
+    """**dict** The number of minutes added to the interval for each outcome"""
+
+    def next_interval(self, source_feed: Source, outcome: str) -> float:
+        if outcome == UPDATED:
+            return source_feed.interval / 2
+        return source_feed.interval + self.backoff.get(outcome, 0)
+
+
+class PredictivePolicy(HeuristicPolicy):
+    """Schedules polls for when the feed is next expected to have a new post.
+
+    The feed's recent posts are used to estimate how often it publishes and at
+    which hours of the week, and the next poll is set for the end of the hour
+    in which a new post becomes more likely than not.  Feeds without enough
+    history, or that fail to fetch, fall back to :class:`HeuristicPolicy`.
+    """
+
+    history = 100
+    """**int** The number of recent posts to look at"""
+
+    min_posts = 5
+    """**int** The number of posts needed before a prediction is made"""
+
+    weekly_weight = 0.5
+    """**float** How much the time-of-week pattern counts against the overall rate of posting"""
+
+    def next_interval(self, source_feed: Source, outcome: str) -> float:
+        if outcome in (UPDATED, UNCHANGED, NOT_MODIFIED):
+            expected = self.minutes_to_next_post(source_feed)
+            if expected is not None:
+                return expected
+        return super().next_interval(source_feed, outcome)
+
+    def minutes_to_next_post(self, source_feed: Source, now: datetime.datetime = None) -> Optional[float]:
+        """Estimates how many minutes until the feed will next have a new post.
+
+        :return: The number of minutes, or None if there isn't enough history to say.
+        :rtype: float
+        """
+        now = now or timezone.now()
+
+        times = list(Post.objects.filter(source=source_feed, created__lte=now).order_by("-created").values_list("created", flat=True)[:self.history])
+        if len(times) < self.min_posts:
+            return None
+
+        span = (now - times[-1]).total_seconds() / 3600
+        if span < 1:
+            # probably a feed without dates, where every post was created when we found it
+            return None
+
+        rate = len(times) / span  # posts per hour
+        weeks = max(span / (24 * 7), 1)
+
+        by_hour = [0] * (24 * 7)
+        for created in times:
+            created = created.astimezone(datetime.timezone.utc)
+            by_hour[created.weekday() * 24 + created.hour] += 1
+
+        # Walk forward an hour at a time adding up how many posts we'd expect to
+        # see, until it's more likely than not that there's a new one.
+        hour_start = now.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        expected = 0.0
+        for step in range(2 * 24 * 7):
+            start = hour_start + datetime.timedelta(hours=step)
+            end = start + datetime.timedelta(hours=1)
+            fraction = (end - max(start, now)).total_seconds() / 3600
+
+            hourly = self.weekly_weight * by_hour[start.weekday() * 24 + start.hour] / weeks + (1 - self.weekly_weight) * rate
+            expected += hourly * fraction
+            if expected >= 0.5:
+                return (end - now).total_seconds() / 60
+
+        return None
+
+
+def get_interval_policy() -> IntervalPolicy:
+    """The interval policy set by **FEEDS_INTERVAL_POLICY** (default :class:`HeuristicPolicy`)"""
+    return import_string(INTERVAL_POLICY)()
+
+
+def response_delay(ret) -> Optional[float]:
+    """How many minutes a response says to wait before fetching again, if it says.
+
+    Uses Retry-After on a 429 or 503, otherwise Cache-Control max-age or Expires.
+    """
+    if ret is None:
+        return None
+
+    headers = ret.headers
+
+    if ret.status_code in (429, 503):
+        seconds = parse_retry_after(headers.get("Retry-After"))
+        return None if seconds is None else seconds / 60
+
+    cache_control = headers.get("Cache-Control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return None
+
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match:
+        return int(match.group(1)) / 60
+
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"])
+            # measure from the server's clock if we can
+            date = parsedate_to_datetime(headers["Date"]) if "Date" in headers else timezone.now()
+            return max((expires - date).total_seconds(), 0) / 60
+        except (TypeError, ValueError):
+            return None
+
+    return None
+
+
+def feed_delay(hints: dict) -> Optional[float]:
+    """How many minutes a feed's ttl or sy:updatePeriod says to wait before fetching it again"""
+    if not hints:
+        return None
+    delays = [hints[key] for key in ("ttl", "update_minutes") if hints.get(key)]
+    return max(delays) if delays else None
+
+
+def next_poll_time(source_feed: Source, ret=None, now: datetime.datetime = None) -> datetime.datetime:
+    """Works out when a feed should next be polled.
+
+    This is **interval** minutes from now, unless the server (Retry-After, Cache-Control,
+    Expires) or the feed (ttl, sy:updatePeriod) asked us to wait longer, in which case
+    that is used instead, up to **FEEDS_MAX_HINT_MINUTES**.  The time is then moved on
+    past any of the feed's skipHours and skipDays.
+
+    :param source_feed: The Source, with its new **interval** and **schedule_hints**.
+    :type source_feed: Source
+
+    :param ret: The response from the poll, if there was one.
+    :type ret: Response
+
+    :return: When the feed should be polled next.
+    :rtype: datetime
+    """
+    now = now or timezone.now()
+    hints = source_feed.schedule_hints or {}
+
+    delay = source_feed.interval
+    hinted = [d for d in (response_delay(ret), feed_delay(hints)) if d is not None]
+    if hinted:
+        delay = max(delay, min(max(hinted), MAX_HINT_MINUTES))
+
+    due = now + datetime.timedelta(minutes=delay)
+
+    # skipHours are in GMT, skipDays are Monday = 0
+    skip_hours = set(hints.get("skip_hours", []))
+    skip_days = set(hints.get("skip_days", []))
+    if len(skip_hours) < 24 and len(skip_days) < 7:
+        due = due.astimezone(datetime.timezone.utc)
+        for i in range(24 * 7):
+            if due.hour not in skip_hours and due.weekday() not in skip_days:
+                break
+            due = (due + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+
+    return min(due, now + datetime.timedelta(minutes=max(source_feed.interval, MAX_HINT_MINUTES)))
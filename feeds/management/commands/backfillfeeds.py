@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from feeds.utils import backfill_feeds
+
+
+class Command(BaseCommand):
+    """
+        This command reads the older pages of paginated feeds
+
+        Usage is ``python manage.py backfillfeeds``
+
+        Use ``--max-feeds N`` to backfill up to N feeds and ``--max-pages P`` to read at
+        most P pages from each.  Feeds carry on from where they got to on the next run.
+
+    """
+
+    help = 'Reads the history of paginated feeds, 10 feeds at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-feeds", type=int, default=10, help="The maximum number of feeds to backfill (default 10)")
+        parser.add_argument("--max-pages", type=int, default=None, help="The maximum number of pages to read from each feed")
+
+    def handle(self, *args, **options):
+
+        backfill_feeds(options["max_feeds"], max_pages=options["max_pages"], output=self.stdout)
+
+        self.stdout.write(self.style.SUCCESS('\nFinished'))
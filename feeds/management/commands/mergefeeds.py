@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from feeds.utils import merge_duplicate_sources
+
+
+class Command(BaseCommand):
+    """
+        This command merges Sources that are for the same feed
+
+        Usage is ``python manage.py mergefeeds``
+
+        Sources whose ``feed_url`` is the same once normalised (e.g. http and https,
+        with and without a trailing slash) are merged into one, with their Subscriptions
+        moved over.  Use ``--dry-run`` to see what would be merged.
+
+    """
+
+    help = 'Merges Sources that are for the same feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only show what would be merged")
+
+    def handle(self, *args, **options):
+
+        count = merge_duplicate_sources(self.stdout, dry_run=options["dry_run"])
+
+        self.stdout.write(self.style.SUCCESS(f'\n{count} duplicate feeds {"found" if options["dry_run"] else "merged"}'))
@@ -1,7 +1,9 @@
+import signal
+import threading
 
 from django.core.management.base import BaseCommand
 
-from feeds.utils import update_feeds
+from feeds.utils import run_poller, update_feeds
 
 
 class Command(BaseCommand):
@@ -10,12 +12,43 @@ class Command(BaseCommand):
 
         Usage is ``python manage.py refreshfeeds``
 
+        Use ``--workers N`` to fetch up to N feeds at the same time.
+
+        Use ``--time-budget S`` to stop starting new feeds after S seconds and ``--exclusive``
+        to exit straight away if another exclusive run is still going.
+
+        Use ``--daemon`` to keep running and poll each feed as it becomes due.
+        SIGTERM (or Ctrl-C) stops the daemon once the feeds in flight have been read,
+        SIGHUP makes it drop and reopen its HTTP and database connections.
+
     """
 
     help = 'Refreshes the RSS feeds, 30 at a time'
 
+    def add_arguments(self, parser):
+        parser.add_argument("--max-feeds", type=int, default=30, help="The maximum number of feeds to refresh (default 30)")
+        parser.add_argument("--workers", type=int, default=1, help="The number of feeds to fetch concurrently (default 1)")
+        parser.add_argument("--time-budget", type=float, default=None, help="Stop starting new feeds after this many seconds")
+        parser.add_argument("--exclusive", action="store_true", help="Exit if another exclusive refresh is already running")
+        parser.add_argument("--daemon", action="store_true", help="Keep running, polling feeds as they become due")
+
     def handle(self, *args, **options):
 
-        update_feeds(30)
+        if options["daemon"]:
+            self.run_daemon(options["workers"])
+        else:
+            update_feeds(options["max_feeds"], workers=options["workers"], time_budget=options["time_budget"], exclusive=options["exclusive"])
 
         self.stdout.write(self.style.SUCCESS('\nFinished'))
+
+    def run_daemon(self, workers):
+
+        stop_event = threading.Event()
+        reload_event = threading.Event()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
+
+        run_poller(workers, stop_event=stop_event, reload_event=reload_event)
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0015_source_alt_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0016_source_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='last_bytes_decoded',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='last_bytes_wire',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0017_source_last_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='body_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0018_source_body_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='schedule_hints',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0019_source_schedule_hints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='last_302_etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='last_302_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='last_302_last_modified',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
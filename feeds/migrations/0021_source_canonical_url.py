@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:33
+
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+
+
+# A frozen copy of feeds.hosts.canonical_url as it was when this migration was written,
+# so that later changes to it don't change what this migration does
+FEEDBURNER_HOSTS = {"feeds2.feedburner.com", "feedproxy.google.com", "feedburner.com", "www.feedburner.com"}
+
+
+def canonical_url(url):
+    url = (url or "").strip()
+    try:
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url.lower()
+
+    query = parts.query
+    if host in FEEDBURNER_HOSTS:
+        host = "feeds.feedburner.com"
+    if host == "feeds.feedburner.com":
+        query = ""
+
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+
+    path = parts.path.rstrip("/")
+    if query:
+        path = f"{path}?{query}"
+
+    return host + path
+
+
+def fill_canonical_url(apps, schema_editor):
+    Source = apps.get_model('feeds', 'Source')
+    batch = []
+    for source in Source.objects.only('id', 'feed_url').iterator(chunk_size=1000):
+        source.canonical_url = canonical_url(source.feed_url)
+        batch.append(source)
+        if len(batch) == 1000:
+            Source.objects.bulk_update(batch, ['canonical_url'])
+            batch = []
+    Source.objects.bulk_update(batch, ['canonical_url'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0020_source_last_302_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='canonical_url',
+            field=models.CharField(blank=True, db_index=True, max_length=512, null=True),
+        ),
+        migrations.RunPython(fill_canonical_url, migrations.RunPython.noop),
+    ]
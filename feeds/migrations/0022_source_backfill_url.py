@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0021_source_canonical_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='backfill_url',
+            field=models.CharField(blank=True, max_length=512, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0022_source_backfill_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='quarantine_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='quarantine_reason',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='quarantined_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
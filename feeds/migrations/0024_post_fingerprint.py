@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0023_source_quarantine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:22
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_guid_hash(apps, schema_editor):
+    # Posts are read a feed at a time so that if a feed has more than one Post with
+    # the same guid only the first gets a guid_hash, and 0026 can make it unique.
+    Post = apps.get_model('feeds', 'Post')
+    batch = []
+    source_id = None
+    seen = set()
+    for post in Post.objects.filter(guid__isnull=False).only('id', 'source_id', 'guid').order_by('source_id', 'id').iterator(chunk_size=1000):
+        if post.source_id != source_id:
+            source_id = post.source_id
+            seen = set()
+        guid_hash = hashlib.md5(post.guid.encode('utf-8')).hexdigest()
+        if guid_hash in seen:
+            continue
+        seen.add(guid_hash)
+        post.guid_hash = guid_hash
+        batch.append(post)
+        if len(batch) == 1000:
+            Post.objects.bulk_update(batch, ['guid_hash'])
+            batch = []
+    Post.objects.bulk_update(batch, ['guid_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0024_post_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='guid_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(fill_guid_hash, migrations.RunPython.noop),
+    ]
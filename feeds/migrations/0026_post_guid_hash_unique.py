@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0025_post_guid_hash'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='post',
+            constraint=models.UniqueConstraint(fields=('source', 'guid_hash'), name='feeds_post_source_guid_hash'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='guid',
+            field=models.CharField(blank=True, max_length=768, null=True),
+        ),
+    ]
@@ -1,5 +1,7 @@
 
 import datetime
+import hashlib
+import json
 from urllib.parse import urlencode
 import logging
 
@@ -7,11 +9,20 @@ from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Q
 import django.utils as django_utils
 from django.utils.deconstruct import deconstructible
 
+from feeds.hosts import canonical_url
+
+
+def hash_guid(guid: str) -> str:
+    """The fixed width digest of a Post's guid that it is looked up by, or None if it doesn't have one."""
+    if guid is None:
+        return None
+    return hashlib.md5(guid.encode("utf-8")).hexdigest()
+
 
 @deconstructible
 class ExpiresGenerator(object):
@@ -22,7 +33,80 @@ class ExpiresGenerator(object):
         return django_utils.timezone.now() - datetime.timedelta(days=1)
 
 
-class Source(models.Model):
+class ChangeTrackingModel(models.Model):
+    """A model that remembers the values it was loaded with (or last saved).
+
+    :meth:`save_changes` then writes only the fields that have actually changed,
+    in a single UPDATE, and doesn't touch the database at all if none have.
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = {}
+        instance._remember(f for f in cls._meta.concrete_fields if f.attname in field_names)
+        return instance
+
+    def _snapshot(self, field):
+        value = getattr(self, field.attname)
+        if isinstance(field, models.JSONField):
+            # compare what would be stored, dicts from the parser aren't plain dicts
+            try:
+                return json.dumps(value, cls=field.encoder, sort_keys=True)
+            except (TypeError, ValueError):
+                return object()  # never equal
+        return value
+
+    def _remember(self, fields):
+        for field in fields:
+            self._loaded[field.attname] = self._snapshot(field)
+
+    def changed_fields(self) -> list:
+        """The names of the fields that have changed since the object was loaded or last saved"""
+        loaded = getattr(self, "_loaded", None)
+        fields = [f for f in self._meta.concrete_fields if not f.primary_key]
+        if loaded is None:
+            return [f.name for f in fields]
+        return [
+            f.name for f in fields
+            if (f.attname in loaded and self._snapshot(f) != loaded[f.attname]) or (f.attname not in loaded and f.attname in self.__dict__)
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or not hasattr(self, "_loaded"):
+            self._loaded = {}
+            self._remember(self._meta.concrete_fields)
+        else:
+            names = set(update_fields)
+            self._remember(f for f in self._meta.concrete_fields if f.name in names or f.attname in names)
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if hasattr(self, "_loaded"):
+            names = None if fields is None else set(fields)
+            self._remember(f for f in self._meta.concrete_fields if names is None or f.name in names or f.attname in names)
+
+    def save_changes(self) -> list:
+        """Saves the fields that have changed, if any.
+
+        :return: The names of the fields that were saved.
+        :rtype: list
+        """
+        if self._state.adding:
+            self.save()
+            return [f.name for f in self._meta.concrete_fields]
+        fields = self.changed_fields()
+        if fields:
+            self.save(update_fields=fields)
+        return fields
+
+
+class Source(ChangeTrackingModel):
     """This class represents a Feed to be read.
 
         It really should have been called Feed, but what can you do?
@@ -38,6 +122,9 @@ class Source(models.Model):
     feed_url = models.CharField(max_length=512)
     """**str** The URL that will be fetched to read the feed"""
 
+    canonical_url = models.CharField(max_length=512, blank=True, null=True, db_index=True)
+    """**str** **feed_url** normalised so that Sources for the same feed can be found (automatically populated)"""
+
     image_url = models.CharField(max_length=512, blank=True, null=True)
     """**str** The url of an image representing the feed (automatically populated)"""
 
@@ -71,6 +158,12 @@ class Source(models.Model):
     status_code = models.PositiveIntegerField(default=0)
     last_302_url = models.CharField(max_length=512, null=True, blank=True)
     last_302_start = models.DateTimeField(null=True, blank=True)
+    last_302_etag = models.CharField(max_length=255, blank=True, null=True)
+    """**str** The etag of the feed at **last_302_url**"""
+    last_302_last_modified = models.CharField(max_length=255, blank=True, null=True)
+    """**str** The last modified date of the feed at **last_302_url**"""
+    last_302_expires = models.DateTimeField(null=True, blank=True)
+    """**datetime** Until when the redirect to **last_302_url** can be followed without asking **feed_url** again"""
 
     max_index = models.IntegerField(default=0)
     last_read = models.IntegerField(default=0)
@@ -82,9 +175,46 @@ class Source(models.Model):
     is_cloudflare = models.BooleanField(default=False)
     """**bool** Is this feed being hindered bt Cloudflare?"""
 
+    schedule_hints = models.JSONField(null=True, blank=True)
+    """**dict** Scheduling hints from the feed itself (RSS ttl, skipHours, skipDays and sy:updatePeriod)"""
+
+    body_hash = models.CharField(max_length=64, blank=True, null=True)
+    """**str** A digest of the last feed document that was parsed, so unchanged documents can be skipped"""
+
+    last_bytes_wire = models.IntegerField(default=0)
+    """**int** The number of bytes transferred by the last successful fetch (after any compression)"""
+
+    last_bytes_decoded = models.IntegerField(default=0)
+    """**int** The size in bytes of the last successfully fetched feed once decompressed"""
+
+    backfill_url = models.CharField(max_length=512, blank=True, null=True)
+    """**str** The next page of the feed's history still to be read by **backfill_feeds**"""
+
+    lease_owner = models.CharField(max_length=255, blank=True, null=True)
+    """**str** The poller that has currently claimed this feed for fetching"""
+
+    lease_expires = models.DateTimeField(blank=True, null=True, db_index=True)
+    """**datetime** When the current claim on this feed runs out and another poller may take it"""
+
+    quarantine_reason = models.CharField(max_length=255, blank=True, null=True)
+    """**str** Why the feed was last put in quarantine, e.g. it took too long to parse"""
+
+    quarantine_count = models.IntegerField(default=0)
+    """**int** The number of times in a row the feed has been put in quarantine, 0 once it parses again"""
+
+    quarantined_until = models.DateTimeField(blank=True, null=True)
+    """**datetime** The feed won't be polled again before this"""
+
     def __str__(self):
         return self.display_name
 
+    def save(self, *args, **kwargs):
+        self.canonical_url = canonical_url(self.feed_url)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "feed_url" in update_fields:
+            kwargs["update_fields"] = list(update_fields) + ["canonical_url"]
+        super().save(*args, **kwargs)
+
     @property
     def subscriber_count(self) -> int:
         """**int** he number of subscribers this feed has"""
@@ -224,7 +354,7 @@ class Source(models.Model):
         """In a single user system, mark this feed as read
         """
         self.last_read = self.max_index
-        self.save()
+        self.save(update_fields=["last_read"])
 
     def update_subscriber_count(self):
         """Called by the django save / delete hooks to update num_subs
@@ -232,13 +362,14 @@ class Source(models.Model):
         Internal method, there should be no need to call this
         """
 
+        # only num_subs is written, this instance may be older than the Source's row
         self.num_subs = Subscription.objects.filter(source=self).count()
-        self.save()
+        self.save(update_fields=["num_subs"])
 
     """Will this appear in the docs?"""
 
 
-class Post(models.Model):
+class Post(ChangeTrackingModel):
     """An entry in a feed
 
     """
@@ -264,9 +395,12 @@ class Post(models.Model):
     created = models.DateTimeField(db_index=True)
     """**datetime** The created date for this post as reported in the feed"""
 
-    guid = models.CharField(max_length=GUID_MAX_LENGTH, blank=True, null=True, db_index=True)
+    guid = models.CharField(max_length=GUID_MAX_LENGTH, blank=True, null=True)
     """**str** The unique ID for this post"""
 
+    guid_hash = models.CharField(max_length=32, blank=True, null=True)
+    """**str** A digest of **guid**, which is unique within the Source and indexed instead of the (long) guid"""
+
     author = models.CharField(max_length=255, blank=True, null=True)
     """**str** Name of the author of this post as reported by the feed"""
 
@@ -279,6 +413,9 @@ class Post(models.Model):
     json = models.JSONField(null=True, blank=True)
     """**dict** Raw information about the Post in JSON format (will not be collected unless **FEEDS_SAVE_JSON** is set to **True** in settings)"""
 
+    fingerprint = models.CharField(max_length=32, blank=True, null=True)
+    """**str** A digest of the entry this Post was last saved from, so that unchanged entries can be skipped"""
+
     @property
     def current_enclosures(self):
         """**ResultSet[Enclosure]** Returns all the current enclosures for this post"""
@@ -317,13 +454,28 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["index"]
+        constraints = [
+            models.UniqueConstraint(fields=["source", "guid_hash"], name="feeds_post_source_guid_hash"),
+        ]
 
     def save(self, *args, **kwargs):
+        # Posts that share a guid with an older one in the same feed are left without
+        # a guid_hash by migration 0025, so it is only set for new or changed guids
+        update_fields = kwargs.get("update_fields")
+        if self._state.adding or ("guid" in self.changed_fields() and (update_fields is None or "guid" in update_fields)):
+            self.guid_hash = hash_guid(self.guid)
+            if update_fields is not None:
+                kwargs["update_fields"] = list(update_fields) + ["guid_hash"]
+
         if self.index is None:
-            self.index = self.source.max_index + 1
-            self.source.max_index = self.index
-            self.source.save(update_fields=["max_index"])
-        super().save(*args, **kwargs)
+            with transaction.atomic():
+                # the update locks the Source's row until the Post is saved
+                Source.objects.filter(id=self.source_id).update(max_index=F("max_index") + 1)
+                self.source.refresh_from_db(fields=["max_index"])
+                self.index = self.source.max_index
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
 
 
 class Enclosure(models.Model):
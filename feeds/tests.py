@@ -1,27 +1,51 @@
 
-from datetime import timedelta
-from importlib import reload
+import asyncio
+import fcntl
+from datetime import datetime, timedelta, timezone as dt_timezone
+import gzip
+from importlib import import_module, reload
+from io import StringIO
+import multiprocessing
 import os
+import socket
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
 
+from django.apps import apps as django_apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
+import httpx
+import requests
 import requests_mock
 
 
 # Create your tests here.
-from feeds.models import Source, Subscription, Post
+from feeds.models import Enclosure, Source, Subscription, Post, hash_guid
 from feeds.utils_internal import (
     fix_relative,
     hash_body,
 )
 from feeds.utils import (
+    aread_feed,
+    aupdate_feeds,
+    claim_sources,
     read_feed,
+    update_feeds,
     get_subscription_list_for_user,
     get_unread_subscription_list_for_user
 )
 
+from feeds import fastparser
+from feeds import hosts
+from feeds import intervals
 from feeds import utils
 from feeds import utils_internal
 
@@ -50,9 +74,20 @@ class UtilsTest(TestCase):
 
         self.assertEqual(html, "<a href='https://example.com/'><img src='https://example.com/image.jpg'></a>")
 
+    def test_canonical_url(self):
+
+        self.assertEqual(hosts.canonical_url("http://Example.com/feed/"), "example.com/feed")
+        self.assertEqual(hosts.canonical_url("https://example.com:443/feed#top"), "example.com/feed")
+        self.assertEqual(hosts.canonical_url("http://example.com:8080/feed?id=1"), "example.com:8080/feed?id=1")
+        self.assertEqual(hosts.canonical_url("http://feedproxy.google.com/Blog?format=xml"), "feeds.feedburner.com/Blog")
+        self.assertNotEqual(hosts.canonical_url("http://example.com/Feed"), hosts.canonical_url("http://example.com/feed"))
+
 
 class BaseTest(TransactionTestCase):
 
+    def setUp(self):
+        cache.clear()  # host health is kept in the cache
+
     def _populate_mock(self, mock, test_file, status, content_type, etag=None, headers=None, url=BASE_URL, is_cloudflare=False):
 
         content = open(os.path.join(TEST_FILES_FOLDER, test_file), "rb").read()
@@ -731,6 +766,79 @@ class HTTPStuffTest(BaseTest):
         self.assertEqual(src.interval, 70)
         self.assertTrue(src.live)
 
+    def test_compressed(self, mock):
+
+        content = open(os.path.join(TEST_FILES_FOLDER, "podcast.xml"), "rb").read()
+        mock.register_uri('GET', BASE_URL, status_code=200, content=gzip.compress(content), headers={"Content-Type": "application/rss+xml", "Content-Encoding": "gzip"})
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertIn("gzip", mock.last_request.headers["Accept-Encoding"])
+        self.assertEqual(src.status_code, 200)
+        self.assertGreater(src.posts.count(), 0)
+        self.assertEqual(src.last_bytes_decoded, len(content))
+        self.assertLess(src.last_bytes_wire, src.last_bytes_decoded)
+
+    def test_delta(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+        self.assertEqual(src.posts.count(), 1)
+        self.assertNotIn("A-IM", mock.last_request.headers)
+
+        content = open(os.path.join(TEST_FILES_FOLDER, "rss_delta.xml"), "rb").read()
+        mock.register_uri('GET', BASE_URL, request_headers={"A-IM": "feed", "If-None-Match": "an-etag"}, status_code=226, content=content, headers={"Content-Type": "application/rss+xml", "IM": "feed", "etag": "delta-etag"})
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.status_code, 226)
+        self.assertEqual(src.posts.count(), 2)  # the new entry is added to the existing one
+        self.assertEqual(src.etag, "delta-etag")
+        self.assertEqual(src.last_result, " OK (updated)")
+
+        content = open(os.path.join(TEST_FILES_FOLDER, "rss_empty_delta.xml"), "rb").read()
+        mock.register_uri('GET', BASE_URL, request_headers={"A-IM": "feed", "If-None-Match": "delta-etag"}, status_code=226, content=content, headers={"Content-Type": "application/rss+xml", "IM": "feed", "etag": "delta-etag-2"})
+
+        interval = src.interval
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), 2)
+        self.assertEqual(src.last_result, "Not modified (empty delta)")
+        self.assertEqual(src.interval, interval + 10)
+
+    def test_same_content(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertIsNotNone(src.body_hash)
+        self.assertEqual(src.interval, 60)
+
+        with patch.object(utils, "parse_feed") as parse:
+            read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        parse.assert_not_called()
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.last_result, "Not modified (same content)")
+        self.assertEqual(src.interval, 70)
+
     def test_not_a_feed(self, mock):
 
         self._populate_mock(mock, status=200, test_file="spurious_text_file.txt", content_type="text/plain")
@@ -897,7 +1005,7 @@ class HTTPStuffTest(BaseTest):
         self.assertEqual(src.last_302_url, new_url)  # this is where  went
         self.assertIsNotNone(src.last_302_start)
         self.assertEqual(src.posts.count(), 1)  # after following redirect will have 1 post
-        self.assertEqual(src.interval, 80)
+        self.assertEqual(src.interval, 70)  # same content as last time so treated as not modified
         self.assertTrue(src.live)
 
         # now we test making it permaent
@@ -910,10 +1018,61 @@ class HTTPStuffTest(BaseTest):
         self.assertEqual(src.last_302_url, ' ')
         self.assertIsNone(src.last_302_start)
         self.assertEqual(src.posts.count(), 1)
-        self.assertEqual(src.interval, 100)
+        self.assertEqual(src.interval, 80)
         self.assertEqual(src.feed_url, new_url)
         self.assertTrue(src.live)
 
+    def test_temp_redirect_not_modified(self, mock):
+
+        new_url = "http://new.feed.com/"
+        self._populate_mock(mock, status=302, test_file="empty_file.txt", content_type="text/plain", headers={"Location": new_url})
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/xml+rss", url=new_url, headers={"etag": "new-etag"})
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.last_302_etag, "new-etag")
+        self.assertIsNone(src.etag)
+        self.assertIsNone(src.last_302_expires)  # the redirect didn't say it could be cached
+
+        self._populate_mock(mock, status=304, test_file="empty_file.txt", content_type="text/plain", url=new_url, etag="new-etag")
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(mock.last_request.headers["If-None-Match"], "new-etag")
+        self.assertEqual(src.status_code, 304)
+        self.assertTrue(src.last_result.startswith("Not modified (Temporary Redirect"))
+        self.assertEqual(src.interval, 70)
+        self.assertEqual(src.posts.count(), 1)
+
+    def test_cached_temp_redirect(self, mock):
+
+        new_url = "http://new.feed.com/"
+        self._populate_mock(mock, status=302, test_file="empty_file.txt", content_type="text/plain", headers={"Location": new_url, "Cache-Control": "max-age=86400"})
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/xml+rss", url=new_url)
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertIsNotNone(src.last_302_expires)
+
+        # the redirect is still fresh so feed_url isn't asked again
+        mock.reset_mock()
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual([r.url for r in mock.request_history], [new_url])
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.feed_url, BASE_URL)
+        self.assertEqual(src.posts.count(), 1)
+
     def test_perm_redirect(self, mock):
 
         new_url = "http://new.feed.com/"
@@ -967,3 +1126,1428 @@ class HTTPStuffTest(BaseTest):
         self.assertEqual(src.posts.count(), 0)  # can't have got any
         self.assertTrue(src.live)
         self.assertEqual(src.interval, 120)
+
+    def test_too_large(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        with patch.object(utils_internal, "MAX_FEED_BYTES", 1000):
+            read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.status_code, 0)
+        self.assertTrue(src.last_result.startswith("Feed is too large"))
+        self.assertEqual(src.posts.count(), 0)
+        self.assertEqual(src.interval, 120)
+        self.assertTrue(src.live)
+
+    def test_fetch_deadline(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        with patch.object(utils, "FETCH_DEADLINE", -1):
+            read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.status_code, 0)
+        self.assertIn("to download", src.last_result)
+        self.assertEqual(src.posts.count(), 0)
+
+    def test_error_page_is_sniffed(self, mock):
+
+        page = b"<html>" + b" " * (utils_internal.SNIFF_BYTES * 2) + b"Cloudflare</html>"
+        mock.register_uri('GET', BASE_URL, status_code=403, content=page, headers={"Content-Type": "text/html"})
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        # only the start of the page was read, so this is just forbidden
+        self.assertFalse(src.is_cloudflare)
+        self.assertFalse(src.live)
+
+    def test_too_many_requests(self, mock):
+
+        self._populate_mock(mock, status=429, test_file="empty_file.txt", content_type="text/plain", headers={"Retry-After": "7200"})
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.status_code, 429)
+        self.assertTrue(src.live)  # not disabled, just slowed down
+        self.assertEqual(src.interval, 120)
+        self.assertGreater(src.due_poll, timezone.now() + timedelta(minutes=119))
+
+    def test_cache_control(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml", headers={"Cache-Control": "public, max-age=14400"})
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.interval, 60)
+        self.assertGreater(src.due_poll, timezone.now() + timedelta(minutes=239))
+
+    def test_schedule_hints(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_schedule_hints.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.schedule_hints, {"ttl": 120, "update_minutes": 720, "skip_hours": [1, 2], "skip_days": [5, 6]})
+        self.assertGreater(src.due_poll, timezone.now() + timedelta(minutes=719))
+
+
+@requests_mock.Mocker()
+class SessionTest(BaseTest):
+
+    def test_session_is_shared(self, mock):
+
+        for i in range(2):
+            self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml", url=f"http://feed{i}.com/")
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+
+        session = utils_internal.get_session()
+        update_feeds(10, output=NullOutput())
+
+        self.assertIs(utils_internal.get_session(), session)
+        self.assertEqual(mock.call_count, 2)
+        for src in Source.objects.all():
+            self.assertEqual(src.posts.count(), 1)
+
+    def test_cookies_stay_with_their_feed(self, mock):
+
+        content = open(os.path.join(TEST_FILES_FOLDER, "rss_xhtml_body.xml"), "rb").read()
+        mock.register_uri('GET', BASE_URL, status_code=302, headers={"Location": "http://feed.com/real"}, cookies={"session": "1"})
+        mock.register_uri('GET', "http://feed.com/real", status_code=403)
+        mock.register_uri('GET', "http://feed.com/real", request_headers={"Cookie": "session=1"}, status_code=200, content=content, headers={"Content-Type": "application/rss+xml"})
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml", url="http://feed.com/other")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+        read_feed(src, output=NullOutput())
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.posts.count(), 1)
+
+        other = Source(name="test2", feed_url="http://feed.com/other", interval=0)
+        other.save()
+        read_feed(other, output=NullOutput())
+        self.assertNotIn("Cookie", mock.request_history[-1].headers)
+
+    def test_close_session(self, mock):
+
+        session = utils_internal.get_session()
+        utils_internal.close_session()
+        self.assertIsNot(utils_internal.get_session(), session)
+
+
+def _drip_server(chunks: int, pause: float) -> str:
+    # Serves one feed a few bytes at a time, each well inside the read timeout
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def serve():
+        (conn, addr) = listener.accept()
+        with conn:
+            conn.recv(4096)
+            try:
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/rss+xml\r\nContent-Length: %d\r\n\r\n" % (chunks * 30))
+                for i in range(chunks):
+                    conn.sendall(b" " * 30)
+                    time.sleep(pause)
+            except OSError:
+                pass  # the client hung up
+        listener.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return "http://127.0.0.1:%d/" % listener.getsockname()[1]
+
+
+class SlowBodyTest(TestCase):
+
+    def test_drip_is_cut_off(self):
+
+        url = _drip_server(chunks=50, pause=0.2)
+        session = requests.Session()
+        session.trust_env = False
+        ret = session.get(url, timeout=1, stream=True)
+
+        start = time.monotonic()
+        with self.assertRaises(utils_internal.FetchDeadlineExceeded):
+            utils_internal.read_body(ret, start + 1)
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_async_drip_is_cut_off(self):
+
+        url = _drip_server(chunks=50, pause=0.2)
+
+        async def fetch():
+            async with httpx.AsyncClient(trust_env=False, timeout=1) as client:
+                ret = await client.send(client.build_request("GET", url), stream=True)
+                await utils_internal.aread_body(ret, time.monotonic() + 1)
+
+        start = time.monotonic()
+        with self.assertRaises(utils_internal.FetchDeadlineExceeded):
+            asyncio.run(fetch())
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_slow_body_within_deadline(self):
+
+        url = _drip_server(chunks=3, pause=0.1)
+        session = requests.Session()
+        session.trust_env = False
+        ret = session.get(url, timeout=1, stream=True)
+
+        utils_internal.read_body(ret, time.monotonic() + 10)
+        self.assertEqual(ret.content, b" " * 90)
+
+
+@requests_mock.Mocker()
+class HostLimiterTest(BaseTest):
+
+    def test_interleave_by_host(self, mock):
+
+        urls = ["http://a.com/1", "http://a.com/2", "http://a.com/3", "https://b.com/1", "http://c.com/1", "http://b.com/2"]
+        sources = [Source(feed_url=url) for url in urls]
+
+        ordered = [s.feed_url for s in hosts.interleave_by_host(sources)]
+
+        self.assertEqual(ordered, ["http://a.com/1", "https://b.com/1", "http://c.com/1", "http://a.com/2", "http://b.com/2", "http://a.com/3"])
+
+    def test_parse_retry_after(self, mock):
+
+        self.assertEqual(hosts.parse_retry_after("120"), 120)
+        self.assertIsNone(hosts.parse_retry_after("soon"))
+        when = timezone.now() + timedelta(minutes=10)
+        self.assertAlmostEqual(hosts.parse_retry_after(when.strftime("%a, %d %b %Y %H:%M:%S GMT")), 600, delta=5)
+
+    def test_rate(self, mock):
+
+        limiter = hosts.HostLimiter(rate=10)
+        start = time.monotonic()
+        for i in range(3):
+            with limiter.slot(BASE_URL):
+                pass
+        with limiter.slot("http://other.com/"):
+            pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_retry_after_defers_host(self, mock):
+
+        self._populate_mock(mock, status=429, test_file="empty_file.txt", content_type="text/plain", headers={"Retry-After": "3600"}, url=f"{BASE_URL}1/")
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml", url=f"{BASE_URL}2/")
+
+        src1 = Source(name="test1", feed_url=f"{BASE_URL}1/", interval=0)
+        src1.save()
+        src2 = Source(name="test2", feed_url=f"{BASE_URL}2/", interval=0)
+        src2.save()
+
+        limiter = hosts.HostLimiter(max_wait=1)
+        read_feed(src1, NullOutput(), limiter)
+        read_feed(src2, NullOutput(), limiter)
+
+        src2.refresh_from_db()
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(src2.status_code, 0)
+        self.assertIsNone(src2.last_polled)
+        self.assertLess(src2.due_poll, timezone.now())
+
+
+@requests_mock.Mocker()
+class HostHealthTest(BaseTest):
+
+    def test_circuit_breaker(self, mock):
+
+        mock.register_uri('GET', BASE_URL, exc=requests.exceptions.ConnectTimeout)
+        sources = [Source(name=f"test{i}", feed_url=f"{BASE_URL}{i}", interval=0) for i in range(5)]
+        for src in sources:
+            mock.register_uri('GET', src.feed_url, exc=requests.exceptions.ConnectTimeout)
+            src.save()
+        Source(name="other", feed_url="http://other.com/", interval=0).save()
+
+        for src in sources[:hosts.HOST_FAILURES]:
+            self.assertTrue(read_feed(src, output=NullOutput()))
+            self.assertEqual(src.status_code, 0)
+
+        # the circuit is open, the rest of the host's feeds are put off and not fetched
+        calls = mock.call_count
+        self.assertFalse(read_feed(sources[-1], output=NullOutput()))
+        self.assertEqual(mock.call_count, calls)
+        self.assertEqual(Source.objects.filter(due_poll__lt=timezone.now()).count(), 1)
+
+        # once the cooldown is over one probe is let through
+        health = hosts._get_health("feed.com")
+        health["open_until"] = time.time() - 1
+        hosts._set_health("feed.com", health)
+        probe = hosts.check_host(BASE_URL)
+        self.assertIsNotNone(probe)
+        with self.assertRaises(hosts.HostUnavailable):
+            hosts.check_host(BASE_URL)
+
+        # a request that was already in flight doesn't reopen it or end the probe
+        self.assertIsNone(hosts.record_failure(BASE_URL))
+        self.assertEqual(hosts._get_health("feed.com")["cooldown"], hosts.HOST_COOLDOWN)
+        with self.assertRaises(hosts.HostUnavailable):
+            hosts.check_host(BASE_URL)
+
+        # a failed probe opens it for twice as long
+        self.assertIsNotNone(hosts.record_failure(BASE_URL, probe))
+        self.assertEqual(hosts._get_health("feed.com")["cooldown"], hosts.HOST_COOLDOWN * 2)
+
+        # and a response closes it
+        hosts.record_success(BASE_URL, 0.5)
+        hosts.check_host(BASE_URL)
+        self.assertEqual(hosts._get_health("feed.com")["failures"], 0)
+
+    def test_feed_errors_dont_count(self, mock):
+
+        errors = [requests.exceptions.TooManyRedirects, requests.exceptions.InvalidURL, requests.exceptions.ContentDecodingError, requests.exceptions.InvalidSchema]
+        for (i, error) in enumerate(errors):
+            src = Source(name=f"test{i}", feed_url=f"{BASE_URL}{i}", interval=0)
+            src.save()
+            mock.register_uri('GET', src.feed_url, exc=error)
+            self.assertTrue(read_feed(src, output=NullOutput()))
+            self.assertEqual(src.status_code, 0)
+
+        self.assertEqual(hosts._get_health("feed.com")["failures"], 0)
+        hosts.check_host(BASE_URL)
+
+    def test_probe_outlasts_fetch_timeout(self, mock):
+
+        hosts._set_health("feed.com", {"failures": 3, "open_until": time.time() - 1, "cooldown": hosts.HOST_COOLDOWN, "latency": None, "deviation": 0})
+        with patch.object(hosts.cache, "add", wraps=hosts.cache.add) as add:
+            probe = hosts.check_host(BASE_URL)
+        self.assertGreater(add.call_args.kwargs["timeout"], hosts.FETCH_DEADLINE)
+
+        # a probe that ends without an answer lets another through
+        hosts.release_probe(BASE_URL, probe)
+        self.assertIsNotNone(hosts.check_host(BASE_URL))
+
+    def test_probe_deferred_by_feed_error(self, mock):
+
+        mock.register_uri('GET', BASE_URL, exc=requests.exceptions.TooManyRedirects)
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+        hosts._set_health("feed.com", {"failures": 3, "open_until": time.time() - 1, "cooldown": hosts.HOST_COOLDOWN, "latency": None, "deviation": 0})
+
+        self.assertTrue(read_feed(src, output=NullOutput()))
+        self.assertEqual(mock.call_count, 1)
+        # the feed's own error says nothing about the host, so it can be probed again
+        self.assertIsNotNone(hosts.check_host(BASE_URL))
+
+    def test_timeouts(self, mock):
+
+        self.assertEqual(hosts.host_timeouts(BASE_URL), (hosts.FETCH_TIMEOUT, hosts.FETCH_TIMEOUT))
+
+        for i in range(10):
+            hosts.record_success(BASE_URL, 0.2)
+        self.assertEqual(hosts.host_timeouts(BASE_URL), (hosts.MIN_TIMEOUT, hosts.MIN_TIMEOUT))
+
+        for i in range(10):
+            hosts.record_success(BASE_URL, 4)
+        (connect, read) = hosts.host_timeouts(BASE_URL)
+        self.assertGreater(read, 5)
+        self.assertLessEqual(read, hosts.FETCH_TIMEOUT)
+
+
+@requests_mock.Mocker()
+class DuplicateSourcesTest(BaseTest):
+
+    def test_canonical_url_saved(self, mock):
+
+        src = Source(name="test1", feed_url="http://feed.com/", interval=0)
+        src.save()
+        self.assertEqual(src.canonical_url, "feed.com")
+
+        src.feed_url = "https://other.com/rss"
+        src.save(update_fields=["feed_url"])
+        src.refresh_from_db()
+        self.assertEqual(src.canonical_url, "other.com/rss")
+
+    def test_get_or_create_source(self, mock):
+
+        (src, created) = utils.get_or_create_source("http://feed.com/", name="test1")
+        self.assertTrue(created)
+
+        (src2, created) = utils.get_or_create_source("https://FEED.com")
+        self.assertFalse(created)
+        self.assertEqual(src2.id, src.id)
+        self.assertEqual(utils.get_source_for_url("feed.com/").id, src.id)
+
+    def test_batch_fetches_once(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml", url="https://feed.com")
+
+        Source(name="test1", feed_url=BASE_URL, interval=0).save()
+        Source(name="test2", feed_url="https://feed.com", interval=0).save()
+
+        summary = update_feeds(10, output=NullOutput())
+
+        self.assertEqual(summary.processed, 2)
+        self.assertEqual(mock.call_count, 1)
+        for src in Source.objects.all():
+            self.assertEqual(src.posts.count(), 1)
+
+    def test_deltas_are_not_shared(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml", url="https://feed.com")
+        delta = open(os.path.join(TEST_FILES_FOLDER, "rss_xhtml_body.xml"), "rb").read()
+        mock.register_uri('GET', BASE_URL, request_headers={"A-IM": "feed", "If-None-Match": "e1"}, status_code=226, content=delta, headers={"Content-Type": "application/rss+xml", "IM": "feed", "etag": "e2"})
+
+        Source(name="test1", feed_url=BASE_URL, interval=0, etag="e1", due_poll=datetime(1899, 1, 1, tzinfo=dt_timezone.utc)).save()
+        other = Source(name="test2", feed_url="https://feed.com", interval=0)
+        other.save()
+
+        update_feeds(10, output=NullOutput())
+
+        self.assertEqual(mock.call_count, 2)
+        other.refresh_from_db()
+        self.assertEqual(other.posts.count(), 100)
+        self.assertNotEqual(other.etag, "e2")
+
+    def test_responses_are_only_kept_while_wanted(self, mock):
+
+        ret = requests.Response()
+        ret.status_code = 200
+        shared = utils.SharedResponses([Source(feed_url=BASE_URL), Source(feed_url="https://feed.com"), Source(feed_url="http://other.com/")])
+
+        with shared.fetching("http://other.com/") as cached:
+            self.assertIsNone(cached)
+            shared.add("http://other.com/", ret, {})
+        self.assertEqual(shared._responses, {})
+
+        with shared.fetching(BASE_URL) as cached:
+            shared.add(BASE_URL, ret, {})
+        with shared.fetching("https://feed.com") as cached:
+            self.assertIs(cached, ret)
+        self.assertEqual(shared._responses, {})
+
+    def test_merge_sources(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+
+        keep = Source(name="test1", feed_url=BASE_URL, interval=0)
+        keep.save()
+        read_feed(keep, output=NullOutput())
+
+        dup = Source(name="test2", feed_url="https://feed.com", interval=0, max_index=10)
+        dup.save()
+
+        user = User(email='x@example.com', username='x')
+        user.save()
+        sub = Subscription(user=user, source=dup, name="dup", last_read=7)
+        sub.save()
+
+        self.assertEqual(utils.merge_duplicate_sources(NullOutput(), dry_run=True), 1)
+        self.assertEqual(Source.objects.count(), 2)
+
+        self.assertEqual(utils.merge_duplicate_sources(NullOutput()), 1)
+
+        keep.refresh_from_db()
+        sub.refresh_from_db()
+        self.assertEqual(Source.objects.count(), 1)
+        self.assertEqual(sub.source_id, keep.id)
+        self.assertEqual(sub.unread_count, 3)  # still 3 unread
+        self.assertEqual(keep.num_subs, 1)
+
+
+@requests_mock.Mocker()
+class BackfillTest(BaseTest):
+
+    def test_backfill(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_paged_1.xml", content_type="application/rss+xml")
+        for n in (2, 3):
+            self._populate_mock(mock, status=200, test_file=f"rss_paged_{n}.xml", content_type="application/rss+xml", url=f"http://feed.com/page{n}")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        # the poll only reads the first page
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+        user = User(email='x@example.com', username='x')
+        user.save()
+        sub = Subscription(user=user, source=src, name="paged", last_read=1)
+        sub.save()
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(src.posts.count(), 2)
+        self.assertEqual(src.backfill_url, "http://feed.com/page2")
+        unread = [(p.index, p.title) for p in sub.get_unread_posts()]
+
+        self.assertEqual(utils.backfill_feeds(output=NullOutput(), max_pages=1), 1)
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), 4)
+        self.assertEqual(src.max_index, 4)
+        self.assertEqual(src.backfill_url, "http://feed.com/page3")
+        self.assertIsNone(src.lease_owner)
+        # the archive comes before the existing posts and doesn't count as unread
+        sub.refresh_from_db()
+        self.assertEqual(sub.unread_count, 1)
+        self.assertEqual([p.title for p in sub.get_unread_posts()], [title for (index, title) in unread])
+        self.assertEqual(src.last_read, 2)
+        archive = list(src.posts.order_by("index").values_list("index", "title"))
+        self.assertEqual([index for (index, title) in archive], [1, 2, 3, 4])
+        self.assertNotIn(unread[0][1], [title for (index, title) in archive[:2]])
+
+        self.assertEqual(utils.backfill_feeds(output=NullOutput()), 1)
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), 6)
+        self.assertIsNone(src.backfill_url)
+        self.assertEqual(src.name, "Paged")
+
+        # nothing left to do
+        self.assertEqual(utils.backfill_feeds(output=NullOutput()), 0)
+
+    def test_unparseable_page_ends_backfill(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_paged_2.xml", content_type="application/rss+xml", url="http://feed.com/page2")
+        src = Source(name="test1", feed_url=BASE_URL, interval=0, backfill_url="http://feed.com/page2")
+        src.save()
+
+        with patch.object(utils_internal, "PARSE_SANDBOX", True), patch.object(utils_internal, "PARSE_TIMEOUT", 1):
+            with patch.object(utils_internal, "parse_document", _crashing_parse), patch.object(utils_internal, "_sandbox_context", _fork_context):
+                self.assertEqual(utils.backfill_feeds(output=NullOutput()), 1)
+
+        src.refresh_from_db()
+        self.assertIsNone(src.backfill_url)
+        self.assertIsNone(src.lease_owner)
+
+    def test_backfill_skips_leased(self, mock):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0, backfill_url="http://feed.com/page2", lease_owner="poller", lease_expires=timezone.now() + timedelta(minutes=5))
+        src.save()
+
+        self.assertEqual(utils.backfill_feeds(output=NullOutput()), 0)
+        self.assertEqual(mock.call_count, 0)
+
+
+class FastParserTest(TransactionTestCase):
+
+    def _parse(self, test_file, fast):
+        content = open(os.path.join(TEST_FILES_FOLDER, test_file), "rb").read()
+        src = Source(name="test", feed_url=f"http://{'fast' if fast else 'slow'}.com/{test_file}", site_url="http://feed.com/", interval=0)
+        src.save()
+        with patch.object(utils_internal, "FAST_PARSER", fast):
+            utils_internal.parse_feed_xml(src, content, NullOutput())
+        src.save_changes()
+        src.refresh_from_db()
+        posts = []
+        for p in src.posts.order_by("index"):
+            enclosures = [(e.href, e.length, e.type, e.medium, e.description) for e in p.enclosures.order_by("href")]
+            posts.append(((p.index, p.guid, p.title, p.link, p.body, p.author, p.image_url), p.created, enclosures))
+        return (src.name, src.site_url, src.image_url, src.description, src.schedule_hints, src.backfill_url), posts
+
+    def test_corpus(self):
+        # every feed in testdata gives the same Posts and Enclosures whichever parser is used
+        fast_parsed = []
+        for test_file in sorted(os.listdir(TEST_FILES_FOLDER)):
+            if not test_file.endswith(".xml"):
+                continue
+            if fastparser.parse(open(os.path.join(TEST_FILES_FOLDER, test_file), "rb").read()) is not None:
+                fast_parsed.append(test_file)
+
+            slow_source, slow_posts = self._parse(test_file, False)
+            fast_source, fast_posts = self._parse(test_file, True)
+
+            self.assertEqual(slow_source, fast_source, test_file)
+            self.assertEqual(len(slow_posts), len(fast_posts), test_file)
+            for slow, fast in zip(slow_posts, fast_posts):
+                self.assertEqual(slow[0], fast[0], test_file)
+                self.assertEqual(slow[2], fast[2], test_file)
+                # undated posts are created when they are found
+                self.assertAlmostEqual(slow[1], fast[1], delta=timedelta(seconds=30))
+
+        self.assertIn("atom_entries.xml", fast_parsed)
+        self.assertIn("podcast.xml", fast_parsed)
+        self.assertIn("media_content.xml", fast_parsed)
+        self.assertNotIn("rss_xhtml_body.xml", fast_parsed)
+
+    def test_atom(self):
+        f = fastparser.parse(open(os.path.join(TEST_FILES_FOLDER, "atom_entries.xml"), "rb").read())
+
+        self.assertEqual(f.feed.title, "Atom & Eve")
+        self.assertEqual(f.feed.link, "https://atom.example.com/")
+        self.assertEqual(len(f.entries), 3)
+
+        e = f.entries[0]
+        self.assertEqual(e.title, "Fish &amp; <b>chips</b>")
+        self.assertEqual(e.link, "https://atom.example.com/2024/03/fish")
+        self.assertEqual(e.author, "Adam")
+        self.assertEqual(e.enclosures[0].type, "audio/mpeg")
+        self.assertNotIn("script", e.content[0].value)
+
+        self.assertEqual(f.entries[1].author, "chef@example.com")
+        self.assertEqual(f.entries[1].media_content[0]["filesize"], "2048")
+
+    def test_fallback(self):
+        self.assertIsNone(fastparser.parse(b"<rss version='2.0'><channel><title>Broken</channel></rss>"))
+        self.assertIsNone(fastparser.parse(b"<rss version='0.91'><channel><title>Old</title></channel></rss>"))
+        self.assertIsNone(fastparser.parse(b"<?xml version='1.0' encoding='iso-8859-1'?><rss version='2.0'><channel><title>\xe9</title></channel></rss>"))
+        self.assertIsNone(fastparser.parse(b"<rss version='2.0'><channel><item><source url='http://x.com/'>X</source></item></channel></rss>"))
+        self.assertIsNotNone(fastparser.parse(b"<rss version='2.0'><channel><title>Fine</title></channel></rss>"))
+
+
+@requests_mock.Mocker()
+class ParsePoolTest(BaseTest):
+
+    def tearDown(self):
+        utils_internal.close_parse_pool()
+
+    def test_parse_in_pool(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        with patch.object(utils_internal, "PARSE_PROCESSES", 2):
+            read_feed(src, output=NullOutput())
+            pool = utils_internal.get_parse_pool()
+        src.refresh_from_db()
+
+        self.assertEqual(pool._max_workers, 2)
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.description, 'SU: Three nerds discussing tech, Apple, programming, and loosely related matters.')
+        self.assertEqual(src.posts.all()[0].enclosures.all()[0].href, "http://traffic.libsyn.com/atpfm/atp238.mp3")
+
+    def test_same_as_in_process(self, mock):
+
+        content = open(os.path.join(TEST_FILES_FOLDER, "rss_xhtml_body.xml"), "rb").read()
+        (f, hints) = utils_internal.parse_document(content)
+        with patch.object(utils_internal, "PARSE_PROCESSES", 1):
+            (pool_f, pool_hints) = utils_internal.read_document(content)
+
+        self.assertEqual(pool_f.entries, f.entries)
+        self.assertEqual(pool_f.feed, f.feed)
+        self.assertEqual(pool_hints, hints)
+
+    def test_close_parse_pool(self, mock):
+
+        with patch.object(utils_internal, "PARSE_PROCESSES", 1):
+            pool = utils_internal.get_parse_pool()
+            self.assertIs(utils_internal.get_parse_pool(), pool)
+            utils_internal.close_parse_pool()
+            self.assertIsNot(utils_internal.get_parse_pool(), pool)
+
+    def test_older_python(self, mock):
+
+        # max_tasks_per_child is new in Python 3.11
+        with patch.object(utils_internal, "PARSE_PROCESSES", 1), patch.object(utils_internal, "sys", SimpleNamespace(version_info=(3, 10, 0))):
+            with patch.object(utils_internal, "ProcessPoolExecutor") as executor:
+                utils_internal.get_parse_pool()
+
+        self.assertNotIn("max_tasks_per_child", executor.call_args.kwargs)
+
+
+def _fork_context():
+    return multiprocessing.get_context("fork")
+
+
+def _slow_parse(feed_content, *args):
+    time.sleep(30)
+
+
+def _greedy_parse(feed_content):
+    return bytearray(200 * 1024 * 1024)
+
+
+def _crashing_parse(feed_content):
+    os._exit(1)
+
+
+@requests_mock.Mocker()
+class ParseSandboxTest(BaseTest):
+
+    def _read(self, mock, parse=None, test_file="podcast.xml", content_type="application/rss+xml", parser="parse_document", sandbox=True):
+        self._populate_mock(mock, status=200, test_file=test_file, content_type=content_type)
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        with patch.object(utils_internal, "PARSE_SANDBOX", sandbox), patch.object(utils_internal, "PARSE_TIMEOUT", 1), patch.object(utils_internal, "PARSE_MEMORY_MB", 50):
+            if parse is None:
+                read_feed(src, output=NullOutput())
+            else:
+                # the stand in parsers only reach a sandbox forked straight from this process
+                with patch.object(utils_internal, parser, parse), patch.object(utils_internal, "_sandbox_context", _fork_context):
+                    read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+        return src
+
+    def test_sandbox(self, mock):
+
+        src = self._read(mock)
+
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.posts.all()[0].enclosures.all()[0].href, "http://traffic.libsyn.com/atpfm/atp238.mp3")
+        self.assertIsNone(src.quarantined_until)
+
+    def test_sandbox_with_threads(self, mock):
+
+        stop = threading.Event()
+        worker = threading.Thread(target=stop.wait)
+        worker.start()
+        try:
+            self.assertEqual(utils_internal._sandbox_context().get_start_method(), "forkserver")
+            src = self._read(mock)
+        finally:
+            stop.set()
+            worker.join()
+
+        self.assertEqual(src.posts.count(), 100)
+
+    def test_timeout(self, mock):
+
+        start = time.monotonic()
+        src = self._read(mock, _slow_parse)
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(src.posts.count(), 0)
+        self.assertEqual(src.quarantine_count, 1)
+        self.assertEqual(src.quarantine_reason, "Parsing took longer than 1s")
+        self.assertTrue(src.last_result.startswith("Quarantined"))
+        self.assertGreaterEqual(src.due_poll, src.quarantined_until)
+
+    def test_json(self, mock):
+
+        src = self._read(mock, test_file="podcast.json", content_type="application/json")
+        posts = list(src.posts.order_by("index").values_list("guid", "title", "body"))
+        description = src.description
+        src.delete()
+
+        src = self._read(mock, test_file="podcast.json", content_type="application/json", sandbox=False)
+
+        self.assertEqual(src.status_code, 200)
+        self.assertGreater(len(posts), 0)
+        self.assertEqual(list(src.posts.order_by("index").values_list("guid", "title", "body")), posts)
+        self.assertEqual(src.description, description)
+
+    def test_json_timeout(self, mock):
+
+        src = self._read(mock, _slow_parse, test_file="podcast.json", content_type="application/json", parser="parse_json_document")
+
+        self.assertEqual(src.posts.count(), 0)
+        self.assertEqual(src.quarantine_reason, "Parsing took longer than 1s")
+
+    def test_memory(self, mock):
+
+        src = self._read(mock, _greedy_parse)
+
+        self.assertEqual(src.quarantine_reason, "Parsing needed more than 50MB")
+
+    def test_crash(self, mock):
+
+        src = self._read(mock, _crashing_parse)
+
+        self.assertEqual(src.quarantine_reason, "The parser died (exit code 1)")
+
+    def test_backoff(self, mock):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        durations = []
+        for i in range(3):
+            utils_internal.quarantine(src, "Too slow")
+            durations.append(src.quarantined_until - timezone.now())
+
+        self.assertAlmostEqual(durations[0], timedelta(minutes=utils_internal.QUARANTINE_MINUTES), delta=timedelta(seconds=30))
+        self.assertAlmostEqual(durations[2], timedelta(minutes=utils_internal.QUARANTINE_MINUTES * 4), delta=timedelta(seconds=30))
+
+        # and it's let out once the feed parses again
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.quarantine_count, 0)
+        self.assertIsNone(src.quarantine_reason)
+        self.assertGreater(src.posts.count(), 0)
+
+
+@requests_mock.Mocker()
+class ChangeTrackingTest(BaseTest):
+
+    def _updates(self, queries, table):
+        return [q["sql"] for q in queries.captured_queries if q["sql"].startswith(f'UPDATE "{table}"')]
+
+    def test_one_update_per_poll(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.body_hash = None  # so it's parsed again
+        with CaptureQueriesContext(connection) as queries:
+            read_feed(src, output=NullOutput())
+
+        self.assertEqual(len(self._updates(queries, "feeds_source")), 1)
+        self.assertEqual(self._updates(queries, "feeds_post"), [])
+
+        src.refresh_from_db()
+        self.assertEqual(src.name, "Accidental Tech Podcast")
+        self.assertEqual(src.posts.count(), 100)
+
+    def test_only_changed_fields(self, mock):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+        src = Source.objects.get(id=src.id)
+
+        self.assertEqual(src.changed_fields(), [])
+        self.assertEqual(src.save_changes(), [])
+
+        src.name = "test2"
+        src.schedule_hints = {"ttl": 60}
+        self.assertEqual(src.save_changes(), ["name", "schedule_hints"])
+        self.assertEqual(src.changed_fields(), [])
+
+        src.schedule_hints = {"ttl": 60}
+        self.assertEqual(src.changed_fields(), [])
+
+    def test_json_feed_details(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.json", content_type="application/json")
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.name, "It's Been a Minute with Sam Sanders")
+        self.assertEqual(src.site_url, "https://www.npr.org/podcasts/510317/its-been-a-minute-with-sam-sanders")
+        self.assertTrue(src.image_url.startswith("https://"))
+
+    def test_expired_json_feed(self, mock):
+
+        mock.register_uri('GET', BASE_URL, status_code=200, content=b'{"title": "Done", "expired": true, "items": [{"id": "1"}]}', headers={"Content-Type": "application/json"})
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertEqual(src.last_result, "This feed has expired")
+        self.assertEqual(src.posts.count(), 0)
+
+
+class SaveEntriesTest(TransactionTestCase):
+
+    def _save_entries(self, src, content):
+        # Parses an RSS / Atom document and saves its entries, returning whether any
+        # were new, what was written to the output and the SQL that was run
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        output = StringIO()
+        entries = utils_internal.parse_xml(content)["entries"]
+        with CaptureQueriesContext(connection) as queries:
+            changed = utils_internal.save_xml_entries(src, entries, output)
+        return (changed, output.getvalue(), [q["sql"] for q in queries.captured_queries])
+
+
+class FingerprintTest(SaveEntriesTest):
+
+    FEED = """<rss version="2.0"><channel><title>Prints</title><link>http://feed.com/</link>
+        <item><guid>http://feed.com/1</guid><title>One</title><enclosure url="http://feed.com/1.mp3" length="1" type="audio/mpeg"/></item>
+        <item><guid>http://feed.com/2</guid><title>%s</title><enclosure url="http://feed.com/2.mp3" length="2" type="audio/mpeg"/></item>
+        </channel></rss>"""
+
+    def test_unchanged_entries_are_skipped(self):
+
+        src = Source(name="test", feed_url=BASE_URL, site_url="http://feed.com/", interval=0)
+        src.save()
+        self._save_entries(src, self.FEED % "Two")
+
+        (changed, output, queries) = self._save_entries(src, self.FEED % "Two")
+        self.assertFalse(changed)
+        self.assertEqual(output.count("UNCHANGED"), 2)
+        self.assertFalse([q for q in queries if "feeds_enclosure" in q or q.startswith("UPDATE")])
+
+        (changed, output, queries) = self._save_entries(src, self.FEED % "Deux")
+        self.assertFalse(changed)
+        self.assertEqual(output.count("UNCHANGED"), 1)
+        self.assertEqual(src.posts.get(guid="http://feed.com/2").title, "Deux")
+
+    def test_fingerprint(self):
+
+        entry = {"title": "One", "published_parsed": time.gmtime(0)}
+        self.assertEqual(utils_internal.fingerprint_entry(entry, "http://feed.com/"), utils_internal.fingerprint_entry(dict(entry), "http://feed.com/"))
+        self.assertNotEqual(utils_internal.fingerprint_entry(entry, "http://feed.com/"), utils_internal.fingerprint_entry(entry, "http://other.com/"))
+        self.assertEqual(len(utils_internal.fingerprint_entry(entry, None)), 32)
+
+
+class PostWriterTest(SaveEntriesTest):
+
+    def test_new_posts_are_bulk_created(self):
+
+        src = Source(name="test", feed_url=BASE_URL, site_url="http://feed.com/", interval=0)
+        src.save()
+        content = open(os.path.join(TEST_FILES_FOLDER, "podcast.xml"), "rb").read()
+        (changed, output, queries) = self._save_entries(src, content)
+
+        self.assertTrue(changed)
+        self.assertEqual(src.posts.count(), 100)
+        self.assertEqual(Enclosure.objects.filter(post__source=src).count(), 100)
+        # begin, guid lookup, posts (in batches on sqlite), enclosures, commit
+        self.assertLessEqual(len(queries), 6)
+
+    def test_duplicate_guids(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        content = b"""<rss version="2.0"><channel><title>Dupes</title>
+            <item><guid>http://feed.com/1</guid><title>Second</title><enclosure url="http://feed.com/1.mp3" length="20" type="audio/mpeg"/></item>
+            <item><guid>http://feed.com/1</guid><title>First</title><enclosure url="http://feed.com/1.mp3" length="10" type="audio/mpeg"/></item>
+            </channel></rss>"""
+        self._save_entries(src, content)
+
+        post = src.posts.get()
+        self.assertEqual(post.title, "Second")
+        self.assertEqual([(e.href, e.length) for e in post.enclosures.all()], [("http://feed.com/1.mp3", 20)])
+
+
+class EnclosureSyncTest(SaveEntriesTest):
+
+    FEED = """<rss version="2.0"><channel><title>Files</title><item><guid>http://feed.com/1</guid><title>%s</title>%s</item></channel></rss>"""
+
+    def _save(self, src, title, files):
+        # Saves a post with these (name, length) files, returning the enclosure queries
+        enclosures = "".join(f'<enclosure url="http://feed.com/{name}" length="{length}" type="audio/mpeg"/>' for (name, length) in files)
+        (changed, output, queries) = self._save_entries(src, self.FEED % (title, enclosures))
+        return [q for q in queries if "feeds_enclosure" in q]
+
+    def test_reconcile(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        self._save(src, "One", [("a.mp3", 1), ("b.mp3", 2), ("c.mp3", 3)])
+
+        queries = self._save(src, "Two", [("b.mp3", 20), ("c.mp3", 3), ("d.mp3", 4), ("d.mp3", 5)])
+        post = src.posts.get()
+        self.assertEqual([(e.href, e.length) for e in post.enclosures.order_by("href")],
+                         [("http://feed.com/b.mp3", 20), ("http://feed.com/c.mp3", 3), ("http://feed.com/d.mp3", 4)])
+        # load, create, update, delete (select and delete)
+        self.assertEqual(len([q for q in queries if q.startswith("UPDATE")]), 1)
+        self.assertEqual(len([q for q in queries if q.startswith("INSERT")]), 1)
+        self.assertEqual(len([q for q in queries if q.startswith("DELETE")]), 1)
+
+    def test_keep_old(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        self._save(src, "One", [("a.mp3", 1), ("b.mp3", 2), ("c.mp3", 3)])
+
+        with patch.object(utils_internal, "KEEP_OLD_ENCLOSURES", True):
+            queries = self._save(src, "Two", [("c.mp3", 3)])
+
+        post = src.posts.get()
+        self.assertEqual(post.enclosures.count(), 3)
+        self.assertEqual([e.href for e in post.current_enclosures], ["http://feed.com/c.mp3"])
+        self.assertEqual([q for q in queries if q.startswith(("INSERT", "DELETE"))], [])
+        self.assertEqual(len([q for q in queries if q.startswith("UPDATE")]), 1)
+
+
+class GuidHashTest(SaveEntriesTest):
+
+    def test_posts_are_found_by_guid_hash(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        content = b"""<rss version="2.0"><channel><title>Hash</title><item><guid>http://feed.com/1</guid><title>One</title></item></channel></rss>"""
+
+        self._save_entries(src, content)
+        (changed, output, queries) = self._save_entries(src, content.replace(b"One", b"Two"))
+
+        post = src.posts.get()
+        self.assertEqual(post.title, "Two")
+        self.assertEqual(post.guid_hash, hash_guid("http://feed.com/1"))
+        self.assertIn("guid_hash", queries[1])
+
+    def test_migration_skips_duplicates(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        Post.objects.bulk_create([Post(source=src, guid=guid, index=i, created=timezone.now()) for (i, guid) in enumerate(["a", "b", "a"])])
+
+        migration = import_module("feeds.migrations.0025_post_guid_hash")
+        migration.fill_guid_hash(django_apps, None)
+
+        self.assertEqual(list(src.posts.order_by("id").values_list("guid_hash", flat=True)), [hash_guid("a"), hash_guid("b"), None])
+
+        # the duplicate can still be saved
+        duplicate = src.posts.get(guid_hash__isnull=True)
+        duplicate.title = "Dupe"
+        duplicate.save()
+        self.assertIsNone(Post.objects.get(id=duplicate.id).guid_hash)
+
+        duplicate.guid = "c"
+        duplicate.save()
+        self.assertEqual(Post.objects.get(id=duplicate.id).guid_hash, hash_guid("c"))
+
+
+class IndexTest(TransactionTestCase):
+
+    def _new_posts(self, src, count):
+        start = timezone.now()
+        first = Post.objects.count()
+        for i in range(count):
+            Post(source=src, guid=f"{src.id}-{first + i}", index=0, created=start - timedelta(minutes=i)).save()
+
+    def test_indices_follow_created(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        self._new_posts(src, 5)
+
+        utils_internal.index_new_posts(src)
+        self.assertEqual(src.max_index, 5)
+        self.assertEqual(list(src.posts.order_by("created").values_list("index", flat=True)), [1, 2, 3, 4, 5])
+
+    def test_constant_queries(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        self._new_posts(src, 3)
+        with CaptureQueriesContext(connection) as few:
+            utils_internal.index_new_posts(src)
+
+        self._new_posts(src, 30)
+        with CaptureQueriesContext(connection) as many:
+            utils_internal.index_new_posts(src)
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(src.max_index, 33)
+
+    def test_stale_source_keeps_indices_unique(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        stale = Source.objects.get(id=src.id)
+
+        self._new_posts(src, 2)
+        utils_internal.index_new_posts(src)
+        src.save_changes()
+
+        # another worker with an out of date copy of the Source
+        self._new_posts(stale, 2)
+        utils_internal.index_new_posts(stale)
+        stale.name = "renamed"
+        stale.save_changes()
+
+        Post(source=Source.objects.get(id=src.id), guid="direct", created=timezone.now()).save()
+
+        src.refresh_from_db()
+        self.assertEqual(src.max_index, 5)
+        self.assertEqual(sorted(src.posts.values_list("index", flat=True)), [1, 2, 3, 4, 5])
+
+    def test_stale_source_in_hooks(self):
+
+        src = Source(name="test", feed_url=BASE_URL, interval=0)
+        src.save()
+        stale = Source.objects.get(id=src.id)
+
+        self._new_posts(src, 2)
+        utils_internal.index_new_posts(src)
+
+        # subscribing and marking read while a poll was indexing
+        user = User(email='x@example.com', username='x')
+        user.save()
+        Subscription(user=user, source=stale).save()
+        stale.mark_read()
+
+        src.refresh_from_db()
+        self.assertEqual(src.max_index, 2)
+        self.assertEqual(src.num_subs, 1)
+        self.assertEqual(src.last_read, 0)
+
+
+@requests_mock.Mocker()
+class LeaseTest(BaseTest):
+
+    def test_claims_are_disjoint(self, mock):
+
+        for i in range(5):
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+
+        first = claim_sources(3, owner="a")
+        second = claim_sources(3, owner="b")
+        third = claim_sources(3, owner="c")
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertEqual(len(third), 0)
+        self.assertFalse({s.id for s in first} & {s.id for s in second})
+        self.assertEqual(Source.objects.filter(lease_owner="a").count(), 3)
+
+        # leases that have run out can be claimed again
+        Source.objects.filter(lease_owner="a").update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(claim_sources(5, owner="c")), 3)
+
+    def test_read_releases_lease(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+
+        Source(name="test1", feed_url=BASE_URL, interval=0).save()
+
+        (src,) = claim_sources(1, owner="a")
+        self.assertEqual(src.lease_owner, "a")
+
+        read_feed(src, output=NullOutput())
+        src.refresh_from_db()
+
+        self.assertIsNone(src.lease_owner)
+        self.assertIsNone(src.lease_expires)
+        self.assertEqual(src.posts.count(), 1)
+
+
+@requests_mock.Mocker()
+class UpdateSummaryTest(BaseTest):
+
+    def test_summary(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml", url="http://good.com/")
+        self._populate_mock(mock, status=500, test_file="empty_file.txt", content_type="text/plain", url="http://bad.com/")
+        Source(name="good", feed_url="http://good.com/", interval=0).save()
+        Source(name="bad", feed_url="http://bad.com/", interval=0).save()
+
+        summary = update_feeds(10, output=NullOutput())
+
+        self.assertEqual(summary.processed, 1)
+        self.assertEqual(summary.errors, 1)
+        self.assertEqual(summary.skipped, 0)
+        self.assertEqual(summary.remaining, 0)
+        self.assertGreater(summary.elapsed, 0)
+
+    def test_time_budget(self, mock):
+
+        for i in range(3):
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+
+        summary = update_feeds(10, output=NullOutput(), time_budget=0)
+
+        self.assertEqual(summary.processed, 0)
+        self.assertEqual(summary.remaining, 3)
+        self.assertEqual(mock.call_count, 0)
+        # nothing was claimed
+        self.assertEqual(Source.objects.filter(lease_owner__isnull=True).count(), 3)
+
+    def test_claims_in_batches(self, mock):
+
+        def slow(request, context):
+            time.sleep(0.3)
+            return open(os.path.join(TEST_FILES_FOLDER, "rss_xhtml_body.xml"), "rb").read()
+
+        for i in range(5):
+            mock.register_uri('GET', f"http://feed{i}.com/", content=slow, headers={"Content-Type": "application/rss+xml"})
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+
+        with patch.object(utils, "CLAIM_BATCH", 2):
+            summary = update_feeds(10, output=NullOutput(), time_budget=0.2)
+
+        # the rest of the first batch is skipped and the others are never claimed
+        self.assertEqual(summary.processed, 1)
+        self.assertEqual(summary.skipped, 1)
+        self.assertEqual(summary.remaining, 4)
+        self.assertEqual(Source.objects.filter(lease_owner__isnull=True).count(), 5)
+
+        with patch.object(utils, "CLAIM_BATCH", 2):
+            summary = update_feeds(10, output=NullOutput())
+
+        self.assertEqual(summary.processed, 4)
+        self.assertEqual(summary.remaining, 0)
+
+    def test_host_pause_hands_back_feeds(self, mock):
+
+        for i in range(3):
+            mock.register_uri('GET', f"http://feed.com/{i}", status_code=429, headers={"Retry-After": "3600"})
+            Source(name=f"test{i}", feed_url=f"http://feed.com/{i}", interval=0).save()
+
+        summary = update_feeds(10, output=NullOutput())
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(summary.skipped, 2)
+        soon = timezone.now() + timedelta(minutes=59)
+        for src in Source.objects.all():
+            self.assertIsNone(src.lease_owner)
+            self.assertGreater(src.due_poll, soon)
+
+    def test_exclusive(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+        Source(name="test1", feed_url=BASE_URL, interval=0).save()
+
+        with open(utils.RUN_LOCK_FILE, "a") as other_run:
+            fcntl.flock(other_run, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            summary = update_feeds(10, output=NullOutput(), exclusive=True)
+
+        self.assertTrue(summary.locked_out)
+        self.assertEqual(mock.call_count, 0)
+
+        summary = update_feeds(10, output=NullOutput(), exclusive=True)
+
+        self.assertFalse(summary.locked_out)
+        self.assertEqual(summary.processed, 1)
+
+        # the lock has been released
+        with open(utils.RUN_LOCK_FILE, "a") as other_run:
+            fcntl.flock(other_run, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_exclusive_without_file_locks(self, mock):
+
+        with patch.object(utils, "fcntl", None), patch.object(utils, "msvcrt", None):
+            with self.assertRaises(ImproperlyConfigured):
+                update_feeds(10, output=NullOutput(), exclusive=True)
+
+
+class IntervalPolicyTest(TransactionTestCase):
+
+    def test_heuristic(self):
+
+        policy = intervals.HeuristicPolicy()
+        src = Source(name="test1", feed_url=BASE_URL, interval=200)
+
+        self.assertEqual(policy.next_interval(src, intervals.UPDATED), 100)
+        self.assertEqual(policy.next_interval(src, intervals.NOT_MODIFIED), 210)
+        self.assertEqual(policy.next_interval(src, intervals.ERROR), 320)
+        self.assertEqual(policy.clamp(10), 60)
+        self.assertEqual(policy.clamp(5000), 1440)
+
+    def test_predictive(self):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=200)
+        src.save()
+
+        # a post at 9am every day for the last 3 weeks
+        now = timezone.now().replace(hour=15, minute=30, second=0, microsecond=0)
+        for day in range(1, 22):
+            Post(source=src, title=f"post{day}", created=(now - timedelta(days=day)).replace(hour=9, minute=5), index=day, guid=f"post-{day}").save()
+
+        policy = intervals.PredictivePolicy()
+
+        # expect the next one in the 9am hour tomorrow, so poll at 10am
+        self.assertAlmostEqual(policy.minutes_to_next_post(src, now=now), (18 * 60) + 30, delta=1)
+
+        # not enough history to go on
+        src2 = Source(name="test2", feed_url=BASE_URL, interval=200)
+        src2.save()
+        self.assertIsNone(policy.minutes_to_next_post(src2, now=now))
+        self.assertEqual(policy.next_interval(src2, intervals.UNCHANGED), 220)
+
+    def test_next_poll_time(self):
+
+        # a Friday at 22:30
+        now = datetime(2024, 3, 1, 22, 30, tzinfo=dt_timezone.utc)
+        src = Source(name="test1", feed_url=BASE_URL, interval=60)
+
+        self.assertEqual(intervals.next_poll_time(src, now=now), now + timedelta(minutes=60))
+
+        # a longer ttl wins, but only up to FEEDS_MAX_HINT_MINUTES
+        src.schedule_hints = {"ttl": 180}
+        self.assertEqual(intervals.next_poll_time(src, now=now), now + timedelta(minutes=180))
+        src.schedule_hints = {"ttl": 60 * 24 * 30}
+        self.assertEqual(intervals.next_poll_time(src, now=now), now + timedelta(minutes=intervals.MAX_HINT_MINUTES))
+
+        # 23:30 is skipped so wait until midnight
+        src.schedule_hints = {"skip_hours": [23]}
+        self.assertEqual(intervals.next_poll_time(src, now=now), datetime(2024, 3, 2, 0, 0, tzinfo=dt_timezone.utc))
+
+        # no weekends, so wait until Monday (if FEEDS_MAX_HINT_MINUTES allows)
+        src.interval = 120
+        src.schedule_hints = {"skip_days": [5, 6]}
+        with patch.object(intervals, "MAX_HINT_MINUTES", 60 * 24 * 3):
+            self.assertEqual(intervals.next_poll_time(src, now=now), datetime(2024, 3, 4, 0, 0, tzinfo=dt_timezone.utc))
+        self.assertEqual(intervals.next_poll_time(src, now=now), now + timedelta(minutes=intervals.MAX_HINT_MINUTES))
+
+    def test_custom_policy(self):
+
+        with patch.object(intervals, "INTERVAL_POLICY", "feeds.tests.FixedPolicy"):
+            self.assertIsInstance(intervals.get_interval_policy(), FixedPolicy)
+
+
+class FixedPolicy(intervals.IntervalPolicy):
+
+    def next_interval(self, source_feed, outcome):
+        return 90
+
+
+class UpdateFeedsTest(TransactionTestCase):
+
+    def test_workers(self):
+
+        for i in range(6):
+            Source(name=f"test{i}", feed_url=f"{BASE_URL}{i}/", interval=0).save()
+
+        seen = []
+        threads = set()
+
+        def fake_read_feed(source_feed, output, limiter=None, shared=None):
+            seen.append(source_feed.id)
+            threads.add(threading.get_ident())
+            time.sleep(0.05)
+            output.write(f"\nread {source_feed.id}")
+            source_feed.status_code = 200
+            return True
+
+        output = StringIO()
+        with patch.object(utils, "read_feed", fake_read_feed):
+            summary = update_feeds(10, output=output, workers=3)
+
+        self.assertEqual(summary.processed, 6)
+        self.assertEqual(sorted(seen), sorted(Source.objects.values_list("id", flat=True)))
+        self.assertGreater(len(threads), 1)
+        for source_id in seen:
+            self.assertIn(f"read {source_id}", output.getvalue())
+
+    def test_poller(self):
+
+        for i in range(3):
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+        Source(name="later", feed_url="http://later.com/", interval=0, due_poll=timezone.now() + timedelta(hours=1)).save()
+
+        seen = []
+        stop_event = threading.Event()
+
+        def fake_read_feed(source_feed, output, limiter=None, shared=None):
+            seen.append(source_feed.feed_url)
+            if len(seen) == 3:
+                stop_event.set()
+            return True
+
+        with patch.object(utils, "read_feed", fake_read_feed):
+            poller = threading.Thread(target=utils.run_poller, kwargs={"workers": 2, "output": NullOutput(), "stop_event": stop_event, "max_sleep": 0.1})
+            poller.start()
+            poller.join(10)
+
+        self.assertFalse(poller.is_alive())
+        self.assertEqual(sorted(seen), [f"http://feed{i}.com/" for i in range(3)])
+        self.assertGreater(utils._seconds_until_next_due(7200), 3000)
+
+
+class AsyncReadFeedTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def _client(self, responses):
+        # responses is a dict of url -> (status, test_file, headers)
+        def handler(request):
+            (status, test_file, headers) = responses[str(request.url)]
+            content = open(os.path.join(TEST_FILES_FOLDER, test_file), "rb").read()
+            return httpx.Response(status, content=content, headers={"etag": "an-etag", **headers})
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def _aread_feed(self, src, responses):
+        async def run():
+            async with self._client(responses) as client:
+                await aread_feed(src, NullOutput(), client)
+        asyncio.run(run())
+        src.refresh_from_db()
+
+    def test_simple_xml(self):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        self._aread_feed(src, {BASE_URL: (200, "rss_xhtml_body.xml", {"Content-Type": "application/rss+xml"})})
+
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.posts.count(), 1)
+        self.assertEqual(src.interval, 60)
+        self.assertEqual(src.etag, "an-etag")
+
+        self._aread_feed(src, {BASE_URL: (304, "empty_file.txt", {})})
+
+        self.assertEqual(src.status_code, 304)
+        self.assertEqual(src.interval, 70)
+        self.assertEqual(src.last_result, "Not modified")
+
+    def test_temp_redirect(self):
+
+        new_url = "http://new.feed.com/"
+        responses = {
+            BASE_URL: (302, "empty_file.txt", {"Location": new_url}),
+            new_url: (200, "rss_xhtml_body.xml", {"Content-Type": "application/rss+xml"}),
+        }
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        self._aread_feed(src, responses)
+
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.last_302_url, new_url)
+        self.assertIsNotNone(src.last_302_start)
+        self.assertEqual(src.posts.count(), 1)
+        self.assertEqual(src.feed_url, BASE_URL)
+
+    def test_feed_gone(self):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        self._aread_feed(src, {BASE_URL: (410, "empty_file.txt", {})})
+
+        self.assertEqual(src.status_code, 410)
+        self.assertFalse(src.live)
+
+    def test_fetch_error(self):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        self._aread_feed(src, {})
+
+        self.assertEqual(src.status_code, 0)
+        self.assertTrue(src.last_result.startswith("Fetch error"))
+        self.assertEqual(src.interval, 120)
+
+    def test_too_large(self):
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        with patch.object(utils_internal, "MAX_FEED_BYTES", 1000):
+            self._aread_feed(src, {BASE_URL: (200, "podcast.xml", {"Content-Type": "application/rss+xml"})})
+
+        self.assertEqual(src.status_code, 0)
+        self.assertTrue(src.last_result.startswith("Feed is too large"))
+        self.assertEqual(src.posts.count(), 0)
+
+    def test_aupdate_feeds(self):
+
+        for i in range(3):
+            Source(name=f"test{i}", feed_url=f"http://feed{i}.com/", interval=0).save()
+
+        responses = {f"http://feed{i}.com/": (200, "rss_xhtml_body.xml", {"Content-Type": "application/rss+xml"}) for i in range(3)}
+
+        with patch.object(utils, "_async_client", lambda: self._client(responses)):
+            asyncio.run(aupdate_feeds(10, output=NullOutput(), concurrency=2))
+
+        for src in Source.objects.all():
+            self.assertEqual(src.status_code, 200)
+            self.assertEqual(src.posts.count(), 1)
@@ -1,22 +1,82 @@
 
 
+import asyncio
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 import datetime
+from io import StringIO
 import logging
-from typing import TextIO, List
+import os
+import socket
+import tempfile
+import threading
+import time
+from typing import TextIO, List, Optional
 from sys import stdout
 
 
-from django.db.models import Q, F
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.models import Count, Q, F, Min, Value
+from django.db.models.functions import Greatest
 from django.utils import timezone
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from dripfeed import DripFeed, DripFeedException
 import requests
 
-from feeds.models import Source, Subscription
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # only on Unix, used for the exclusive run lock
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None  # only on Windows, used for the exclusive run lock instead of fcntl
+
+try:
+    import httpx
+except ImportError:
+    httpx = None  # only needed for aread_feed / aupdate_feeds
+
+from feeds import intervals
+from feeds.hosts import (
+    HostDeferred,
+    FETCH_TIMEOUT,
+    HostLimiter,
+    canonical_url,
+    check_host,
+    get_host,
+    host_timeouts,
+    interleave_by_host,
+    record_failure,
+    record_success,
+    release_probe,
+)
+from feeds.models import Post, Source, Subscription
 
 from feeds.utils_internal import (
+    ACCEPT_ENCODING,
+    FETCH_DEADLINE,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_RETRIES,
+    FeedTooLarge,
+    FetchDeadlineExceeded,
+    ParseLimitExceeded,
+    aread_body,
+    close_parse_pool,
+    close_session,
     get_agent,
+    get_session,
+    get_transfer_size,
+    hash_content,
+    parse_backfill_page,
     parse_feed,
+    read_body,
 )
 
 VERIFY_HTTPS = True
@@ -31,10 +91,59 @@ CLOUDFLARE_WORKER = None
 if hasattr(settings, "FEEDS_CLOUDFLARE_WORKER"):
     CLOUDFLARE_WORKER = settings.FEEDS_CLOUDFLARE_WORKER
 
+LEASE_SECONDS = 600
+if hasattr(settings, "FEEDS_LEASE_SECONDS"):
+    LEASE_SECONDS = settings.FEEDS_LEASE_SECONDS
+
+BACKFILL_PAGES = 10
+if hasattr(settings, "FEEDS_BACKFILL_PAGES"):
+    BACKFILL_PAGES = settings.FEEDS_BACKFILL_PAGES
+
+# The fetch errors that count against a host's circuit breaker
+HOST_ERRORS = (requests.ConnectionError, requests.Timeout, FetchDeadlineExceeded)
+if httpx is not None:
+    HOST_ERRORS += (httpx.TransportError,)
+
+# How many feeds update_feeds claims at a time, so that a run that runs out of time
+# isn't left holding leases on feeds it never started
+CLAIM_BATCH = 10
+
+RUN_LOCK_FILE = os.path.join(tempfile.gettempdir(), "feeds-update-feeds.lock")
+if hasattr(settings, "FEEDS_RUN_LOCK_FILE"):
+    RUN_LOCK_FILE = settings.FEEDS_RUN_LOCK_FILE
+
 logger = logging.getLogger(__file__)
 
 
-def update_feeds(max_feeds: int = 3, output: TextIO = stdout):
+class UpdateSummary(object):
+    """What happened during a run of :func:`update_feeds`"""
+
+    def __init__(self):
+        self.processed = 0
+        """**int** The number of feeds that were read"""
+
+        self.skipped = 0
+        """**int** The number of feeds that were claimed but not read (out of time or their host was busy)"""
+
+        self.errors = 0
+        """**int** The number of feeds that could not be fetched or failed with an error"""
+
+        self.elapsed = 0.0
+        """**float** How long the run took in seconds"""
+
+        self.remaining = 0
+        """**int** The number of feeds still due in the queue at the end of the run"""
+
+        self.locked_out = False
+        """**bool** True if the run didn't happen because another exclusive run held the lock"""
+
+    def __str__(self):
+        if self.locked_out:
+            return "Another update is already running"
+        return "Processed %d, skipped %d, errors %d in %.1fs. %d left in queue" % (self.processed, self.skipped, self.errors, self.elapsed, self.remaining)
+
+
+def update_feeds(max_feeds: int = 3, output: TextIO = stdout, workers: int = 1, time_budget: float = None, exclusive: bool = False) -> UpdateSummary:
     """Process the queue of feeds that need polling.
 
     :param max_feeds: The maximum number of feeds to read from the queue (default 3).
@@ -42,20 +151,500 @@ def update_feeds(max_feeds: int = 3, output: TextIO = stdout):
 
     :param output: A file-like object where logging messages will be written (default stdout).
     :type output: TextIO
+
+    :param workers: The number of feeds to fetch at the same time (default 1).
+        Each worker is a thread with its own database connection, so every Source
+        is still read and saved by exactly one worker.
+    :type workers: int
+
+    :param time_budget: The number of seconds the run may take (default None, no limit).
+        Feeds are claimed from the queue a few at a time, and once the budget has been
+        used up no more are claimed or started.  Any left over from the last claim are
+        handed back to the queue and counted as skipped.
+    :type time_budget: float
+
+    :param exclusive: If True, don't run if another exclusive run is already in progress on
+        this machine (default False).  The lock is taken on **FEEDS_RUN_LOCK_FILE** (with
+        ``flock`` on Unix, ``msvcrt.locking`` on Windows) and is held until the run,
+        including any fetches still in flight, has finished.
+    :type exclusive: bool
+
+    :return: A summary of the run.
+    :rtype: UpdateSummary
+
+    Feeds in the batch are interleaved by host and the requests to each host are
+    limited by a :class:`feeds.hosts.HostLimiter` so that no one server gets hit too hard.
+    Sources in the batch with the same **canonical_url** share a single fetch.
+    """
+    summary = UpdateSummary()
+    start = time.monotonic()
+    deadline = None if time_budget is None else start + time_budget
+
+    with _run_lock(exclusive) as locked:
+        if not locked:
+            summary.locked_out = True
+            output.write(f"\n{summary}")
+            return summary
+
+        limiter = HostLimiter()
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        claimed = 0
+        try:
+            while claimed < max_feeds and (deadline is None or time.monotonic() < deadline):
+                wanted = min(max(CLAIM_BATCH, workers), max_feeds - claimed)
+                sources = _get_due_sources(wanted, output)
+                claimed += len(sources)
+                shared = SharedResponses(sources)
+
+                if pool is not None and len(sources) > 1:
+                    futures = [pool.submit(_read_feed_in_worker, src, limiter, deadline, shared) for src in sources]
+                    for future in as_completed(futures):
+                        (feed_output, outcome) = future.result()
+                        output.write(feed_output)
+                        _count_outcome(summary, outcome)
+                else:
+                    for src in sources:
+                        _count_outcome(summary, _read_one(src, output, limiter, deadline, shared))
+
+                if len(sources) < wanted:
+                    break  # the queue is empty
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    summary.elapsed = time.monotonic() - start
+    summary.remaining = _due_queue(timezone.now()).count()
+    output.write(f"\n{summary}")
+
+    return summary
+
+
+@contextmanager
+def _run_lock(exclusive: bool):
+    # Holds the lock on RUN_LOCK_FILE for the whole of an exclusive run, giving False if
+    # another run already has it.  The lock goes with the process, so a run that dies
+    # can't leave it behind and a run can only ever release its own.
+    if not exclusive:
+        yield True
+        return
+    if fcntl is None and msvcrt is None:
+        raise ImproperlyConfigured("Exclusive runs need a file lock (fcntl or msvcrt), which this platform doesn't have")
+
+    with open(RUN_LOCK_FILE, "a") as lock_file:
+        if not _lock_file(lock_file):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            _unlock_file(lock_file)
+
+
+def _lock_file(lock_file) -> bool:
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+    else:
+        lock_file.seek(0)
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+    return True
+
+
+def _unlock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _count_outcome(summary: UpdateSummary, outcome: str):
+    setattr(summary, outcome, getattr(summary, outcome) + 1)
+
+
+async def aupdate_feeds(max_feeds: int = 3, output: TextIO = stdout, concurrency: int = 10):
+    """Async version of :func:`update_feeds`.
+
+    All the feeds in the batch are fetched on the event loop, up to ``concurrency``
+    at a time, using a single shared ``httpx.AsyncClient``.
+
+    :param max_feeds: The maximum number of feeds to read from the queue (default 3).
+    :type max_feeds: int
+
+    :param output: A file-like object where logging messages will be written (default stdout).
+    :type output: TextIO
+
+    :param concurrency: The maximum number of fetches in flight at once (default 10).
+    :type concurrency: int
+    """
+    sources = await sync_to_async(_get_due_sources)(max_feeds, output)
+    limiter = HostLimiter()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def read_one(source_feed, client):
+        buffer = StringIO()
+        async with semaphore:
+            try:
+                if not await aread_feed(source_feed, buffer, client, limiter):
+                    await sync_to_async(_hand_back)(source_feed, limiter)
+            except Exception as ex:
+                logger.exception("Error reading feed %s", source_feed.feed_url)
+                buffer.write(f"\nError reading {source_feed.feed_url}: {ex}")
+        output.write(buffer.getvalue())
+
+    async with _async_client() as client:
+        await asyncio.gather(*[read_one(src, client) for src in sources])
+
+    await sync_to_async(connections.close_all)()
+
+
+def claim_sources(max_feeds: int, owner: str = None, lease_seconds: int = None) -> List[Source]:
+    """Claims a batch of due feeds so that no other poller will fetch them.
+
+    Each claimed Source is given a lease that lasts until it has been read (or until
+    **lease_seconds** have passed, in case the poller dies part way through).  Any
+    number of pollers, on any number of machines, can claim from the queue at the
+    same time without getting the same feeds.
+
+    On databases that support it (PostgreSQL, MySQL 8+, Oracle) the batch is claimed with
+    ``SELECT ... FOR UPDATE SKIP LOCKED``.  On others (e.g. SQLite) each feed is claimed
+    with a conditional update on its lease instead.
+
+    :param max_feeds: The maximum number of feeds to claim.
+    :type max_feeds: int
+
+    :param owner: A name for the poller making the claim (default is the host name and process id).
+    :type owner: str
+
+    :param lease_seconds: How long the claim lasts (default **FEEDS_LEASE_SECONDS** or 600).
+    :type lease_seconds: int
+
+    :return: The claimed Sources, most overdue first.
+    :rtype: List[Source]
+    """
+    now = timezone.now()
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    expires = now + datetime.timedelta(seconds=lease_seconds or LEASE_SECONDS)
+
+    candidates = _due_queue(now).order_by("due_poll")
+
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            ids = list(candidates.select_for_update(skip_locked=True).values_list("id", flat=True)[:max_feeds])
+            Source.objects.filter(id__in=ids).update(lease_owner=owner, lease_expires=expires)
+        else:
+            ids = []
+            for (source_id, old_expires) in candidates.values_list("id", "lease_expires")[:max_feeds]:
+                # only take the lease if nobody else has since we looked
+                unchanged = Q(lease_expires=old_expires) if old_expires else Q(lease_expires__isnull=True)
+                if Source.objects.filter(Q(id=source_id) & unchanged).update(lease_owner=owner, lease_expires=expires):
+                    ids.append(source_id)
+
+    return list(Source.objects.filter(id__in=ids).order_by("due_poll"))
+
+
+def run_poller(workers: int = 4, output: TextIO = stdout, stop_event: threading.Event = None, reload_event: threading.Event = None, max_sleep: float = 60):
+    """Polls feeds continuously until **stop_event** is set.
+
+    Rather than working through a fixed batch like :func:`update_feeds`, this keeps up to
+    **workers** feeds in flight at all times, claiming more from the queue as each one
+    finishes.  When there is nothing due it sleeps until the next feed is due (or for
+    **max_sleep** seconds at most).  This is what ``refreshfeeds --daemon`` runs.
+
+    :param workers: The number of feeds to fetch at the same time (default 4).
+    :type workers: int
+
+    :param output: A file-like object where logging messages will be written (default stdout).
+    :type output: TextIO
+
+    :param stop_event: When set, no more feeds are claimed and the poller returns once the
+        feeds in flight have been read.
+    :type stop_event: threading.Event
+
+    :param reload_event: When set, the HTTP session, host limits, parse pool and database
+        connections are thrown away and started afresh.
+    :type reload_event: threading.Event
+
+    :param max_sleep: The longest time in seconds to sleep before checking the queue again (default 60).
+    :type max_sleep: float
+    """
+    stop_event = stop_event or threading.Event()
+    reload_event = reload_event or threading.Event()
+
+    limiter = HostLimiter()
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while not stop_event.is_set():
+            if reload_event.is_set():
+                reload_event.clear()
+                output.write("\nReloading")
+                close_session()
+                close_parse_pool()
+                connections.close_all()
+                limiter = HostLimiter()
+
+            close_old_connections()
+
+            free = workers - len(in_flight)
+            if free > 0:
+                for src in interleave_by_host(claim_sources(free)):
+                    output.write(f"\nClaimed {src.feed_url}")
+                    in_flight.add(pool.submit(_read_feed_in_worker, src, limiter, None))
+
+            if len(in_flight) < workers:
+                # there's spare capacity so only wait until the next feed is due
+                timeout = _seconds_until_next_due(max_sleep)
+            else:
+                timeout = max_sleep
+
+            if in_flight:
+                (done, in_flight) = wait(in_flight, timeout=min(timeout, 1), return_when=FIRST_COMPLETED)
+                for future in done:
+                    output.write(future.result()[0])
+            else:
+                stop_event.wait(timeout)
+
+        for future in as_completed(in_flight):
+            output.write(future.result()[0])
+
+    close_old_connections()
+    output.write("\nPoller stopped")
+
+
+def backfill_feeds(max_feeds: int = 10, max_pages: int = None, output: TextIO = stdout) -> int:
+    """Reads the older pages of paginated feeds.
+
+    When a feed is first read and it has a ``rel="next"`` link, the link is kept in
+    **backfill_url** rather than being followed there and then.  This works through
+    those feeds up to **max_pages** pages each, saving where it got to after every
+    page so the next run carries on from there.  It is run by ``python manage.py
+    backfillfeeds``, separately from the regular polling.
+
+    Each feed is leased while it is being backfilled so a poller won't read it at the
+    same time, and feeds that are currently leased by a poller are left for next time.
+
+    :param max_feeds: The maximum number of feeds to backfill (default 10).
+    :type max_feeds: int
+
+    :param max_pages: The maximum number of pages to read from each feed (default **FEEDS_BACKFILL_PAGES**).
+    :type max_pages: int
+
+    :param output: A file-like object where logging messages will be written (default stdout).
+    :type output: TextIO
+
+    :return: The number of pages read.
+    :rtype: int
     """
-    todo = Source.objects.filter(Q(due_poll__lt=timezone.now()) & Q(live=True))
+    max_pages = max_pages or BACKFILL_PAGES
+    owner = f"backfill:{socket.gethostname()}:{os.getpid()}"
+    limiter = HostLimiter()
+    pages = 0
+
+    now = timezone.now()
+    candidates = Source.objects.filter(Q(live=True) & Q(backfill_url__isnull=False) & (Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)))
+    for (source_id, old_expires) in candidates.order_by("id").values_list("id", "lease_expires")[:max_feeds]:
+        unchanged = Q(lease_expires=old_expires) if old_expires else Q(lease_expires__isnull=True)
+        if not Source.objects.filter(Q(id=source_id) & unchanged).update(lease_owner=owner, lease_expires=now + datetime.timedelta(seconds=LEASE_SECONDS)):
+            continue  # a poller got there first
+
+        source_feed = Source.objects.get(id=source_id)
+        try:
+            pages += _backfill_feed(source_feed, max_pages, limiter, output)
+        finally:
+            _release_lease(source_feed)
+
+    output.write(f"\nBackfilled {pages} pages")
+    return pages
+
+
+def _backfill_feed(source_feed: Source, max_pages: int, limiter: HostLimiter, output: TextIO) -> int:
+    pages = 0
+    headers = {"User-Agent": get_agent(source_feed), "Accept-Encoding": ACCEPT_ENCODING}
+    while source_feed.backfill_url and pages < max_pages:
+        url = source_feed.backfill_url
+        output.write(f"\nBackfilling {url}")
+        try:
+            ret = _fetch_politely({"url": url, "headers": headers, "allow_redirects": True}, limiter, output)
+        except HostDeferred as ex:
+            output.write(f"\nDeferred: {ex}")
+            break
+        except Exception as ex:
+            # keep the cursor and try again next time
+            output.write(f"\nFetch error: {ex}")
+            break
+
+        pages += 1
+        if ret.status_code >= 500:
+            output.write(f"\nServer error ({ret.status_code})")
+            break
+        elif ret.status_code >= 300:
+            output.write(f"\nGiving up backfilling, page returned {ret.status_code}")
+            next_url = None
+        else:
+            try:
+                (changed, next_url) = parse_backfill_page(source_feed, ret.content, output)
+            except (ParseLimitExceeded, ValueError, BrokenProcessPool) as ex:
+                # the same page would stop every later run too
+                output.write(f"\nGiving up backfilling, page couldn't be parsed: {ex}")
+                next_url = None
+            else:
+                if changed:
+                    _index_archive_posts(source_feed)
+
+        # checkpoint after every page
+        source_feed.backfill_url = next_url if next_url != url else None
+        source_feed.save(update_fields=["backfill_url"])
+
+    return pages
+
+
+def _index_archive_posts(source_feed: Source) -> int:
+    # Backfilled posts are older than everything already in the feed, so they are
+    # numbered before it: the existing posts and everyone's place in the feed move
+    # up to make room, which leaves the archive read and the same posts unread.
+    with transaction.atomic():
+        Source.objects.select_for_update().filter(id=source_feed.id).values_list("id").first()
+        archive = list(Post.objects.filter(Q(source=source_feed) & Q(index=0)).order_by("created", "id").only("id", "created"))
+        added = len(archive)
+        if added:
+            Post.objects.filter(Q(source=source_feed) & Q(index__gt=0)).update(index=F("index") + added)
+            Subscription.objects.filter(source=source_feed).update(last_read=F("last_read") + added)
+            Source.objects.filter(id=source_feed.id).update(max_index=F("max_index") + added, last_read=F("last_read") + added)
+            for (i, p) in enumerate(archive):
+                p.index = i + 1
+            Post.objects.bulk_update(archive, ["index"])
+        source_feed.refresh_from_db(fields=["max_index", "last_read"])
+
+    return added
+
+
+def _seconds_until_next_due(max_sleep: float) -> float:
+    now = timezone.now()
+    next_due = Source.objects.filter(Q(live=True) & (Q(lease_expires__isnull=True) | Q(lease_expires__lt=now))).aggregate(Min("due_poll"))["due_poll__min"]
+    if next_due is None:
+        return max_sleep
+    # wait at least a moment, due feeds that we didn't get will have been claimed by another poller
+    return min(max((next_due - now).total_seconds(), 1), max_sleep)
+
+
+def _due_queue(now: datetime.datetime):
+    # Sources that are due and not leased by another poller
+    return Source.objects.filter(Q(due_poll__lt=now) & Q(live=True) & (Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)))
+
+
+def _get_due_sources(max_feeds: int, output: TextIO) -> List[Source]:
+    output.write(f"\nQueue size is {_due_queue(timezone.now()).count()}")
+
+    sources = interleave_by_host(claim_sources(max_feeds))
+
+    output.write("\nProcessing %d" % len(sources))
+
+    return sources
+
+
+def _read_one(source_feed: Source, output: TextIO, limiter: HostLimiter, deadline: float, shared: "SharedResponses" = None) -> str:
+    # Reads one feed from a batch and says how it went for the UpdateSummary
+    if deadline is not None and time.monotonic() > deadline:
+        output.write(f"\nOut of time, skipping {source_feed.feed_url}")
+        _release_lease(source_feed)
+        return "skipped"
+
+    try:
+        if not read_feed(source_feed, output, limiter, shared=shared):
+            _hand_back(source_feed, limiter)
+            return "skipped"
+    except Exception as ex:
+        logger.exception("Error reading feed %s", source_feed.feed_url)
+        output.write(f"\nError reading {source_feed.feed_url}: {ex}")
+        return "errors"
+
+    if source_feed.status_code == 0 or source_feed.status_code >= 400:
+        return "errors"
+    return "processed"
+
+
+def _read_feed_in_worker(source_feed: Source, limiter: HostLimiter, deadline: float, shared: "SharedResponses" = None) -> tuple:
+    # Runs _read_one on a pool thread.  Output is buffered so that the
+    # messages for each feed are written out together rather than interleaved
+    # and the thread's database connection is closed when it's done with.
+    buffer = StringIO()
+    try:
+        outcome = _read_one(source_feed, buffer, limiter, deadline, shared)
+    finally:
+        connections.close_all()
+    return (buffer.getvalue(), outcome)
+
 
-    output.write(f"\nQueue size is {todo.count()}")
+def _release_lease(source_feed: Source):
+    Source.objects.filter(id=source_feed.id, lease_owner=source_feed.lease_owner).update(lease_owner=None, lease_expires=None)
 
-    sources = todo.order_by("due_poll")[:max_feeds]
 
-    output.write("\nProcessing %d" % sources.count())
+def _hand_back(source_feed: Source, limiter: HostLimiter):
+    # Returns a feed that was deferred by its host to the queue, not to be polled
+    # again until the host has said it will take requests.
+    resume = limiter.resume_time(source_feed.feed_url) if limiter is not None else None
+    if resume is not None:
+        Source.objects.filter(id=source_feed.id, due_poll__lt=resume).update(due_poll=resume)
+    _release_lease(source_feed)
 
-    for src in sources:
-        read_feed(src, output)
 
+class SharedResponses(object):
+    """Lets the Sources in a batch that fetch the same feed share one response.
 
-def read_feed(source_feed: Source, output: TextIO = stdout):
+    Requests are matched on the canonical form of their url.  While one Source is
+    fetching a url, any other Source that wants it waits and is then given the same
+    response, as long as it was a plain 200 to a request without an etag, last
+    modified date or ``A-IM``.  Otherwise it makes its own request, as the response
+    (a 304 or a delta, say) may only make sense to the Source that asked for it.
+
+    Responses are only kept for urls that more than one of **sources** wants, and
+    only until the last of them has had it.
+    """
+
+    CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since", "A-IM")
+
+    def __init__(self, sources: List[Source] = ()):
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._responses = {}
+        self._wanted = Counter(canonical_url(src.feed_url) for src in sources)
+
+    @contextmanager
+    def fetching(self, url: str):
+        """Context manager that gives the response already fetched for **url**, or None if there
+        isn't one, in which case the caller should fetch it and pass it to :meth:`add`."""
+        key = canonical_url(url)
+        with self._lock:
+            url_lock = self._url_locks.setdefault(key, threading.Lock())
+            self._wanted[key] -= 1
+        with url_lock:
+            try:
+                yield self._responses.get(key)
+            finally:
+                if self._wanted[key] <= 0:
+                    self._responses.pop(key, None)  # nobody else wants it
+
+    def add(self, url: str, ret, headers: dict = None):
+        """Keeps a response for **url** for the other Sources that want it, if it can be shared.
+
+        :param headers: The headers the request for **url** was made with.
+        :type headers: dict
+        """
+        key = canonical_url(url)
+        if ret.status_code != 200 or any(h in (headers or {}) for h in self.CONDITIONAL_HEADERS):
+            return
+        if self._wanted[key] > 0:
+            self._responses[key] = ret
+
+
+def read_feed(source_feed: Source, output: TextIO = stdout, limiter: HostLimiter = None, shared: SharedResponses = None) -> bool:
     """Fetches a specific feed and stores the output.
 
     :param source_feed: The Source object to fetch.
@@ -63,8 +652,203 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
 
     :param output: A file-like object where logging messages will be written (default stdout).
     :type output: TextIO
+
+    :param limiter: Limits the rate of requests to each host (default None).  If the
+        feed's host can't be fetched from in time, the feed is left untouched so it
+        will be picked up again on the next run.
+    :type limiter: HostLimiter
+
+    :param shared: Responses that have already been fetched in this batch (default None).
+    :type shared: SharedResponses
+
+    :return: True if the feed was read, False if it was deferred by the limiter or
+        because its host is failing.
+    :rtype: bool
+
+    Connection errors and timeouts are counted against the feed's host and once
+    a host keeps failing all of its feeds are put off together (see
+    :func:`feeds.hosts.check_host`).
     """
+    steps = _read_feed_steps(source_feed, output)
+    cookies = requests.cookies.RequestsCookieJar()  # kept for this feed's requests only
+    request = _advance(steps)
+    while request is not None:
+        try:
+            if shared is None:
+                ret = _fetch_politely(request, limiter, output, cookies)
+            else:
+                with shared.fetching(request["url"]) as ret:
+                    if ret is None:
+                        ret = _fetch_politely(request, limiter, output, cookies)
+                        shared.add(request["url"], ret, request["headers"])
+                    else:
+                        output.write("\nUsing the response already fetched for %s" % request["url"])
+        except HostDeferred as ex:
+            output.write(f"\nDeferred: {ex}")
+            steps.close()
+            return False
+        except Exception as ex:
+            request = _advance(steps, error=ex)
+        else:
+            request = _advance(steps, ret)
+
+    return True
+
+
+def _fetch_politely(request: dict, limiter: HostLimiter, output: TextIO, cookies=None):
+    # Fetches a request if its host is up and the limiter allows, keeping track of how the host did
+    probe = check_host(request["url"])
+    try:
+        start = time.monotonic()
+        if limiter is None:
+            ret = _fetch(request, cookies)
+        else:
+            with limiter.slot(request["url"]):
+                start = time.monotonic()
+                ret = _fetch(request, cookies)
+            limiter.note_response(request["url"], ret)
+    except Exception as ex:
+        _note_failure(request["url"], ex, output, probe)
+        raise
+    record_success(request["url"], time.monotonic() - start)
+    return ret
+
+
+def _fetch(request: dict, cookies=None):
+    # The body is streamed so that it can be cut off if it's too big or too slow.
+    # The shared session never keeps cookies, so any that the feed needs to get
+    # through a redirect are carried in **cookies** from one request to the next.
+    deadline = time.monotonic() + FETCH_DEADLINE
+    ret = get_session().get(request["url"], headers=request["headers"], cookies=cookies, verify=VERIFY_HTTPS, allow_redirects=request["allow_redirects"], timeout=host_timeouts(request["url"]), stream=True)
+    if cookies is not None:
+        for response in ret.history + [ret]:
+            cookies.update(response.cookies)
+    read_body(ret, deadline)
+    return ret
+
+
+def _note_failure(url: str, error: Exception, output: TextIO, probe: str = None):
+    # Counts a connection error or timeout against its host and, if that opens the
+    # host's circuit, puts off all of the host's feeds until it will be tried again.
+    # Anything else (too many redirects, a bad url, a feed that's too big) is down
+    # to the feed, not the host, and if it was the host's probe another is allowed.
+    if not isinstance(error, HOST_ERRORS):
+        release_probe(url, probe)
+        return
+    until = record_failure(url, probe)
+    if until is not None:
+        count = defer_host(get_host(url), until)
+        output.write(f"\n{get_host(url)} keeps failing, deferred {count} feeds until {until}")
+
+
+def defer_host(host: str, until: datetime.datetime) -> int:
+    """Puts off polling every live feed on **host** until **until**.
+
+    :return: The number of feeds that were deferred.
+    :rtype: int
+    """
+    if not host:
+        return 0
+    on_host = Q()
+    for scheme in ("http", "https"):
+        on_host |= Q(feed_url__istartswith=f"{scheme}://{host}/") | Q(feed_url__istartswith=f"{scheme}://{host}:") | Q(feed_url__iexact=f"{scheme}://{host}")
+    return Source.objects.filter(on_host, live=True, due_poll__lt=until).update(due_poll=until)
+
+
+async def aread_feed(source_feed: Source, output: TextIO = stdout, client=None, limiter: HostLimiter = None) -> bool:
+    """Async version of :func:`read_feed`.
+
+    The fetches are made with `httpx <https://www.python-httpx.org>`_ and the
+    database work is run through ``sync_to_async``.  Requires ``httpx`` to be
+    installed (``pip install django-feed-reader[async]``).
+
+    :param source_feed: The Source object to fetch.
+    :type source_feed: Source
+
+    :param output: A file-like object where logging messages will be written (default stdout).
+    :type output: TextIO
+
+    :param client: An ``httpx.AsyncClient`` to make the requests with.  If not given
+        a new client is created just for this feed.
+    :type client: httpx.AsyncClient
+
+    :param limiter: Limits the rate of requests to each host (default None).
+    :type limiter: HostLimiter
+
+    :return: True if the feed was read, False if it was deferred by the limiter.
+    :rtype: bool
+    """
+    if client is None:
+        async with _async_client() as client:
+            return await aread_feed(source_feed, output, client, limiter)
+
+    steps = _read_feed_steps(source_feed, output)
+    advance = sync_to_async(_advance)
+    request = await advance(steps)
+    while request is not None:
+        probe = None
+        try:
+            # the host's health is kept in the cache, which may be a database
+            probe = await sync_to_async(check_host)(request["url"])
+            (connect, read) = await sync_to_async(host_timeouts)(request["url"])
+            timeout = httpx.Timeout(read, connect=connect)
+            start = time.monotonic()
+            if limiter is None:
+                ret = await _afetch(client, request, timeout)
+            else:
+                async with limiter.aslot(request["url"]):
+                    start = time.monotonic()
+                    ret = await _afetch(client, request, timeout)
+                limiter.note_response(request["url"], ret)
+        except HostDeferred as ex:
+            output.write(f"\nDeferred: {ex}")
+            await sync_to_async(release_probe)(request["url"], probe)
+            await sync_to_async(steps.close)()
+            return False
+        except Exception as ex:
+            await sync_to_async(_note_failure)(request["url"], ex, output, probe)
+            request = await advance(steps, error=ex)
+        else:
+            await sync_to_async(record_success)(request["url"], time.monotonic() - start)
+            request = await advance(steps, ret)
+
+    return True
+
+
+async def _afetch(client, request: dict, timeout):
+    deadline = time.monotonic() + FETCH_DEADLINE
+    req = client.build_request("GET", request["url"], headers=request["headers"], timeout=timeout)
+    ret = await client.send(req, follow_redirects=request["allow_redirects"], stream=True)
+    await aread_body(ret, deadline)
+    return ret
+
+
+def _async_client():
+    if httpx is None:
+        raise ImportError("The async feed reader requires httpx - pip install django-feed-reader[async]")
+    limits = httpx.Limits(max_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE, max_keepalive_connections=HTTP_POOL_CONNECTIONS)
+    transport = httpx.AsyncHTTPTransport(verify=VERIFY_HTTPS, retries=HTTP_RETRIES, limits=limits)
+    return httpx.AsyncClient(transport=transport, timeout=FETCH_TIMEOUT)
+
+
+def _advance(steps, ret=None, error: Exception = None):
+    # Moves the read_feed state machine on with a response (or fetch error),
+    # returning the next request it wants made or None when it is finished.
+    try:
+        if error is not None:
+            return steps.throw(error)
+        return steps.send(ret)
+    except StopIteration:
+        return None
+
+
+def _read_feed_steps(source_feed: Source, output: TextIO):
+    # The body of read_feed as a generator so that the sync and async readers
+    # share one state machine. Each HTTP request needed is yielded as a dict and
+    # the response is sent back in; fetch errors are thrown back in so they are
+    # handled at the point the request was made.
     old_interval = source_feed.interval
+    outcome = intervals.OTHER
 
     was302 = False
 
@@ -72,7 +856,7 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
 
     agent = get_agent(source_feed)
 
-    headers = {"User-Agent": agent}  # identify ourselves
+    headers = {"User-Agent": agent, "Accept-Encoding": ACCEPT_ENCODING}  # identify ourselves
 
     feed_url = source_feed.feed_url
     if source_feed.is_cloudflare:  # Fuck you !
@@ -84,39 +868,60 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
 
     if source_feed.etag:
         headers["If-None-Match"] = str(source_feed.etag)
+        headers["A-IM"] = "feed"  # RFC 3229, only send us the new entries
     if source_feed.last_modified:
         headers["If-Modified-Since"] = str(source_feed.last_modified)
 
-    output.write("\nFetching %s" % feed_url)
-
     ret = None
-    try:
-        ret = requests.get(feed_url, headers=headers, verify=VERIFY_HTTPS, allow_redirects=False, timeout=20)
-        source_feed.status_code = ret.status_code
-        source_feed.last_result = "Unhandled Case"
-        output.write(str(ret))
-    except Exception as ex:
-        source_feed.last_result = ("Fetch error:" + str(ex))[:255]
-        source_feed.status_code = 0
-        output.write("\nFetch error: " + str(ex))
+    if source_feed.last_302_url and source_feed.last_302_expires and source_feed.last_302_expires > timezone.now():
+        # the server said the redirect could be cached, so go straight to where it points
+        output.write("\nFollowing cached redirect to %s" % source_feed.last_302_url)
+        was302 = True
+        try:
+            ret = yield from _follow_temporary_redirect(source_feed, source_feed.last_302_url, headers, output)
+            if ret.status_code >= 400:
+                source_feed.last_302_expires = None  # ask feed_url where to go next time
+        except Exception as ex:
+            source_feed.status_code = 0
+            source_feed.last_302_expires = None
+            source_feed.last_result = ("Failed Redirection to " + source_feed.last_302_url + " " + str(ex))[:255]
+            outcome = intervals.REDIRECT_FAILED
+    else:
+        output.write("\nFetching %s" % feed_url)
+        try:
+            ret = yield {"url": feed_url, "headers": headers, "allow_redirects": False}
+            source_feed.status_code = ret.status_code
+            source_feed.last_result = "Unhandled Case"
+            output.write(str(ret))
+        except FeedTooLarge as ex:
+            source_feed.last_result = str(ex)[:255]
+            source_feed.status_code = 0
+            output.write("\n" + str(ex))
+        except Exception as ex:
+            source_feed.last_result = ("Fetch error:" + str(ex))[:255]
+            source_feed.status_code = 0
+            output.write("\nFetch error: " + str(ex))
 
-    if ret is None and source_feed.status_code == 1:  # er ??
+    if was302:
+        pass  # already followed the cached redirect
+    elif ret is None and source_feed.status_code == 1:  # er ??
         pass
     elif ret is None or source_feed.status_code == 0:
-        source_feed.interval += 120
+        outcome = intervals.ERROR
     elif ret.status_code < 200 or ret.status_code >= 500:
         # errors, impossible return codes
-        source_feed.interval += 120
+        outcome = intervals.ERROR
         source_feed.last_result = "Server error fetching feed (%d)" % ret.status_code
     elif ret.status_code == 404:
         # not found
-        source_feed.interval += 120
+        outcome = intervals.ERROR
         source_feed.last_result = "The feed could not be found"
     elif ret.status_code == 410:  # Gone
         source_feed.last_result = "Feed has gone away and says it isn't coming back."
         source_feed.live = False
     elif ret.status_code == 403:  # Forbidden
-        if "Cloudflare" in ret.text or ("Server" in ret.headers and "cloudflare" in ret.headers["Server"]):
+        # only the start of an error page is downloaded, but that's enough
+        if "Cloudflare" in ret.content.decode("utf-8", "ignore") or ("Server" in ret.headers and "cloudflare" in ret.headers["Server"]):
             source_feed.is_cloudflare = True
             source_feed.last_result = "Blocked by Cloudflare (grr)"
             if DRIPFEED_KEY:
@@ -130,13 +935,17 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
             source_feed.last_result = "Feed is no longer accessible."
             source_feed.live = False
 
+    elif ret.status_code == 429:
+        # too many requests, back off and try again later (the Retry-After is used below)
+        outcome = intervals.ERROR
+        source_feed.last_result = "Too many requests (429)"
     elif ret.status_code >= 400 and ret.status_code < 500:
         # treat as bad request
         source_feed.live = False
         source_feed.last_result = "Bad request (%d)" % ret.status_code
     elif ret.status_code == 304:
         # not modified
-        source_feed.interval += 10
+        outcome = intervals.NOT_MODIFIED
         source_feed.last_result = "Not modified"
         source_feed.last_success = timezone.now()
 
@@ -161,7 +970,9 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
                 source_feed.feed_url = new_url
                 source_feed.last_result = "Moved"
                 source_feed.status_code = ret.status_code
-                source_feed.save(update_fields=["feed_url", "last_result", "status_code"])
+                source_feed.lease_owner = None
+                source_feed.lease_expires = None
+                source_feed.save(update_fields=["feed_url", "last_result", "status_code", "lease_owner", "lease_expires"])
                 return  # don't go to the bottom handling, drop out here so we poll again on the next go around
 
             else:
@@ -185,33 +996,24 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
 
                 new_url = start + end + new_url
 
-            ret = requests.get(new_url, headers=headers, allow_redirects=True, timeout=20, verify=VERIFY_HTTPS)
-            source_feed.status_code = ret.status_code
-            source_feed.last_result = ("Temporary Redirect to " + new_url)[:255]
-
-            if source_feed.last_302_url == new_url:
-                # this is where we 302'd to last time
-                td = timezone.now() - source_feed.last_302_start
-                if td.days > 60:
-                    source_feed.feed_url = new_url
-                    source_feed.last_302_url = " "
-                    source_feed.last_302_start = None
-                    source_feed.last_result = ("Permanent Redirect to " + new_url)[:255]
-
-                    source_feed.save(update_fields=["feed_url", "last_result", "last_302_url", "last_302_start"])
-
-                else:
-                    source_feed.last_result = ("Temporary Redirect to " + new_url + " since " + source_feed.last_302_start.strftime("%d %B"))[:255]
-
+            # redirects can only be cached if the server explicitly says so
+            fresh_for = intervals.response_delay(ret)
+            ret = yield from _follow_temporary_redirect(source_feed, new_url, headers, output)
+            if fresh_for and ret.status_code < 400 and source_feed.last_302_url == new_url:
+                source_feed.last_302_expires = timezone.now() + datetime.timedelta(minutes=fresh_for)
             else:
-                source_feed.last_302_url = new_url
-                source_feed.last_302_start = timezone.now()
-
-                source_feed.last_result = ("Temporary Redirect to " + new_url + " since " + source_feed.last_302_start.strftime("%d %B"))[:255]
+                source_feed.last_302_expires = None
 
         except Exception as ex:
+            source_feed.last_302_expires = None
             source_feed.last_result = ("Failed Redirection to " + new_url + " " + str(ex))[:255]
-            source_feed.interval += 60
+            outcome = intervals.REDIRECT_FAILED
+
+    if was302 and ret is not None and ret.status_code == 304:
+        # the feed we were redirected to hasn't changed
+        outcome = intervals.NOT_MODIFIED
+        source_feed.last_result = ("Not modified (" + source_feed.last_result + ")")[:255]
+        source_feed.last_success = timezone.now()
 
     # NOT ELIF, WE HAVE TO START THE IF AGAIN TO COPE WTIH 302
     if ret and ret.status_code >= 200 and ret.status_code < 300:  # now we are not following redirects 302,303 and so forth are going to fail here, but what the hell :)
@@ -221,8 +1023,11 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
         changed = False
 
         if was302:
+            # the validators belong to the feed we were redirected to, not feed_url
             source_feed.etag = None
             source_feed.last_modified = None
+            source_feed.last_302_etag = ret.headers.get("etag")
+            source_feed.last_302_last_modified = ret.headers.get("Last-Modified")
         else:
             try:
                 source_feed.etag = ret.headers["etag"]
@@ -239,34 +1044,98 @@ def read_feed(source_feed: Source, output: TextIO = stdout):
         if "Content-Type" in ret.headers:
             content_type = ret.headers["Content-Type"]
 
-        (ok, changed) = parse_feed(source_feed=source_feed, feed_body=ret.content, content_type=content_type, output=output)
+        source_feed.last_bytes_decoded = len(ret.content)
+        source_feed.last_bytes_wire = get_transfer_size(ret)
+        output.write("\nBytes: %d (%d on the wire)" % (source_feed.last_bytes_decoded, source_feed.last_bytes_wire))
+
+        # 226 IM Used - the server has only sent us the entries that are new since our etag
+        is_delta = ret.status_code == 226 and "feed" in ret.headers.get("IM", "")
+
+        # Lots of feeds don't send an etag or last modified, so check if we have
+        # been sent exactly the same document as last time before parsing it
+        body_hash = hash_content(ret.content)
+        unchanged = not is_delta and body_hash == source_feed.body_hash
+
+        if unchanged:
+            output.write("\nSame content as last time")
+        else:
+            (ok, changed) = parse_feed(source_feed=source_feed, feed_body=ret.content, content_type=content_type, output=output, is_delta=is_delta)
+            # a delta isn't the whole document so there's nothing to compare the next one with
+            source_feed.body_hash = body_hash if ok and not is_delta else None
 
         if ok and changed:
-            source_feed.interval /= 2
+            outcome = intervals.UPDATED
             source_feed.last_result = " OK (updated)"  # and temporary redirects
             source_feed.last_change = timezone.now()
 
+        elif ok and unchanged:
+            # as good as a 304
+            outcome = intervals.NOT_MODIFIED
+            source_feed.last_result = "Not modified (same content)"
+            source_feed.last_success = timezone.now()
+
+        elif ok and is_delta:
+            # an empty delta is as good as a 304
+            outcome = intervals.NOT_MODIFIED
+            source_feed.last_result = "Not modified (empty delta)"
+
         elif ok:
+            outcome = intervals.UNCHANGED
             source_feed.last_result = " OK"
-            source_feed.interval += 20  # we slow down feeds a little more that don't send headers we can use
         else:  # not OK
-            source_feed.interval += 120
+            outcome = intervals.ERROR
 
-    if source_feed.interval < 60:
-        source_feed.interval = 60  # no less than 1 hour
-    if source_feed.interval > (60 * 24):
-        source_feed.interval = (60 * 24)  # no more than a day
+    policy = intervals.get_interval_policy()
+    source_feed.interval = policy.clamp(policy.next_interval(source_feed, outcome))
 
     output.write("\nUpdating source_feed.interval from %d to %d" % (old_interval, source_feed.interval))
-    td = datetime.timedelta(minutes=source_feed.interval)
-    source_feed.due_poll = timezone.now() + td
-    source_feed.save(update_fields=[
-                "due_poll", "interval", "last_result",
-                "last_modified", "etag", "last_302_start",
-                "last_302_url", "last_success", "live",
-                "status_code", "max_index", "is_cloudflare",
-                "last_change", "alt_url"
-            ])
+    source_feed.due_poll = intervals.next_poll_time(source_feed, ret)
+    if source_feed.quarantined_until is not None and source_feed.quarantined_until > source_feed.due_poll:
+        source_feed.due_poll = source_feed.quarantined_until
+    source_feed.lease_owner = None
+    source_feed.lease_expires = None
+    source_feed.save_changes()
+
+
+def _follow_temporary_redirect(source_feed: Source, new_url: str, headers: dict, output: TextIO):
+    # Fetches the feed a temporary redirect points to, sending the validators
+    # from last time if it's the same place, and keeps track of how long the
+    # feed has been redirected there.  Used with yield from in _read_feed_steps.
+    headers = {k: v for (k, v) in headers.items() if k not in ("If-None-Match", "If-Modified-Since", "A-IM")}
+    if source_feed.last_302_url == new_url:
+        if source_feed.last_302_etag:
+            headers["If-None-Match"] = str(source_feed.last_302_etag)
+            headers["A-IM"] = "feed"
+        if source_feed.last_302_last_modified:
+            headers["If-Modified-Since"] = str(source_feed.last_302_last_modified)
+
+    output.write("\nFetching %s" % new_url)
+    ret = yield {"url": new_url, "headers": headers, "allow_redirects": True}
+    source_feed.status_code = ret.status_code
+    source_feed.last_result = ("Temporary Redirect to " + new_url)[:255]
+
+    if source_feed.last_302_url == new_url:
+        # this is where we 302'd to last time
+        td = timezone.now() - source_feed.last_302_start
+        if td.days > 60:
+            source_feed.feed_url = new_url
+            source_feed.last_302_url = " "
+            source_feed.last_302_start = None
+            source_feed.last_302_expires = None
+            source_feed.last_result = ("Permanent Redirect to " + new_url)[:255]
+
+        else:
+            source_feed.last_result = ("Temporary Redirect to " + new_url + " since " + source_feed.last_302_start.strftime("%d %B"))[:255]
+
+    else:
+        source_feed.last_302_url = new_url
+        source_feed.last_302_start = timezone.now()
+        source_feed.last_302_etag = None
+        source_feed.last_302_last_modified = None
+
+        source_feed.last_result = ("Temporary Redirect to " + new_url + " since " + source_feed.last_302_start.strftime("%d %B"))[:255]
+
+    return ret
 
 
 def test_feed(source_feed: Source, cache: bool = False, output: TextIO = stdout) -> bool:
@@ -304,7 +1173,7 @@ def test_feed(source_feed: Source, cache: bool = False, output: TextIO = stdout)
     output.write(str(headers))
 
     try:
-        ret = requests.get(source_feed.feed_url, headers=headers, allow_redirects=False, verify=VERIFY_HTTPS, timeout=20)
+        ret = get_session().get(source_feed.feed_url, headers=headers, allow_redirects=False, verify=VERIFY_HTTPS, timeout=20)
 
         output.write(str(ret))
         output.write(ret.text)
@@ -382,3 +1251,98 @@ def get_unread_subscription_list_for_user(user) -> List[Subscription]:
                 groups.pop(folder.id)
 
     return [s for s in subs_list if s.unread_count > 0 or s.is_river]  # Filter out folders with no undread items
+
+
+def get_source_for_url(feed_url: str) -> Optional[Source]:
+    """Finds the Source for a feed url, if there is one.
+
+    Urls are compared by their canonical form, so ``http://example.com/feed/`` will
+    find a Source for ``https://example.com/feed``.
+
+    :param feed_url: The url of the feed.
+    :type feed_url: str
+
+    :return: The Source, or None if the feed isn't known.
+    :rtype: Source
+    """
+    return Source.objects.filter(canonical_url=canonical_url(feed_url)).order_by("-live", "id").first()
+
+
+def get_or_create_source(feed_url: str, **kwargs) -> tuple:
+    """Gets the Source for a feed url, creating it if there isn't one yet.
+
+    Use this rather than creating Sources directly to avoid having the same feed
+    in the database more than once.
+
+    :param feed_url: The url of the feed.
+    :type feed_url: str
+
+    :param kwargs: Any other fields to set on a new Source.
+
+    :return: The Source and whether it was created.
+    :rtype: tuple
+    """
+    source_feed = get_source_for_url(feed_url)
+    if source_feed is not None:
+        return (source_feed, False)
+    source_feed = Source(feed_url=feed_url, **kwargs)
+    source_feed.save()
+    return (source_feed, True)
+
+
+def merge_sources(keep: Source, duplicates: List[Source]) -> int:
+    """Merges duplicate Sources for the same feed into one.
+
+    Every Subscription to a duplicate is moved to **keep** with its **last_read**
+    shifted so that it keeps the same number of unread posts (as far as **keep**
+    has posts), then the duplicates and their posts are deleted.
+
+    :param keep: The Source to keep.
+    :type keep: Source
+
+    :param duplicates: The Sources to merge into **keep**.
+    :type duplicates: List[Source]
+
+    :return: The number of Subscriptions that were moved.
+    :rtype: int
+    """
+    moved = 0
+    with transaction.atomic():
+        keep.refresh_from_db()
+        for dup in duplicates:
+            if dup.id == keep.id:
+                continue
+            moved += Subscription.objects.filter(source=dup).update(
+                source=keep,
+                last_read=Greatest(Value(0), F("last_read") + (keep.max_index - dup.max_index))
+            )
+            dup.delete()
+        keep.update_subscriber_count()
+    return moved
+
+
+def merge_duplicate_sources(output: TextIO = stdout, dry_run: bool = False) -> int:
+    """Finds Sources that share a **canonical_url** and merges each set into one.
+
+    The Source kept is the live one with the most subscribers (then the oldest).
+    This is what ``python manage.py mergefeeds`` runs.
+
+    :param output: A file-like object where logging messages will be written (default stdout).
+    :type output: TextIO
+
+    :param dry_run: Only report what would be merged (default False).
+    :type dry_run: bool
+
+    :return: The number of duplicate Sources merged (or that would be).
+    :rtype: int
+    """
+    count = 0
+    shared = Source.objects.exclude(canonical_url=None).values("canonical_url").annotate(sources=Count("id")).filter(sources__gt=1)
+    for row in shared:
+        sources = list(Source.objects.filter(canonical_url=row["canonical_url"]).order_by("-live", "-num_subs", "id"))
+        (keep, duplicates) = (sources[0], sources[1:])
+        output.write("\n%s: keeping %d %s, merging %s" % (row["canonical_url"], keep.id, keep.feed_url, ", ".join("%d %s" % (d.id, d.feed_url) for d in duplicates)))
+        if not dry_run:
+            merge_sources(keep, duplicates)
+        count += len(duplicates)
+    return count
@@ -1,19 +1,38 @@
 
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import datetime
 import hashlib
+from http.cookiejar import DefaultCookiePolicy
 import json
 import logging
+import multiprocessing
+import re
+import socket
+import sys
+import threading
 import time
 from typing import TextIO
 
-from django.db.models import Q
+import django
+from django.db import connection, transaction
+from django.db.models import F, Q
 from django.conf import settings
 from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 
+try:
+    import resource
+except ImportError:
+    resource = None  # only on Unix, used to limit the parse sandbox's memory
 
 import feedparser as parser
-from feeds.models import Source, Enclosure, Post
+from feeds import fastparser
+from feeds.models import Source, Enclosure, Post, hash_guid
 import pyrfc3339
 
 
@@ -33,10 +52,93 @@ FEEDS_USER_AGENT = "django-feed-reader"
 if hasattr(settings, "FEEDS_USER_AGENT"):
     FEEDS_USER_AGENT = settings.FEEDS_USER_AGENT
 
+HTTP_POOL_CONNECTIONS = 100
+if hasattr(settings, "FEEDS_HTTP_POOL_CONNECTIONS"):
+    HTTP_POOL_CONNECTIONS = settings.FEEDS_HTTP_POOL_CONNECTIONS
+
+HTTP_POOL_MAXSIZE = 10
+if hasattr(settings, "FEEDS_HTTP_POOL_MAXSIZE"):
+    HTTP_POOL_MAXSIZE = settings.FEEDS_HTTP_POOL_MAXSIZE
+
+HTTP_RETRIES = 1
+if hasattr(settings, "FEEDS_HTTP_RETRIES"):
+    HTTP_RETRIES = settings.FEEDS_HTTP_RETRIES
+
+MAX_FEED_BYTES = 10 * 1024 * 1024
+if hasattr(settings, "FEEDS_MAX_FEED_BYTES"):
+    MAX_FEED_BYTES = settings.FEEDS_MAX_FEED_BYTES
+
+FETCH_DEADLINE = 60
+if hasattr(settings, "FEEDS_FETCH_DEADLINE"):
+    FETCH_DEADLINE = settings.FEEDS_FETCH_DEADLINE
+
+FAST_PARSER = False
+if hasattr(settings, "FEEDS_FAST_PARSER"):
+    FAST_PARSER = settings.FEEDS_FAST_PARSER
+
+PARSE_PROCESSES = 0
+if hasattr(settings, "FEEDS_PARSE_PROCESSES"):
+    PARSE_PROCESSES = settings.FEEDS_PARSE_PROCESSES
+
+PARSE_MAX_TASKS_PER_CHILD = 100
+if hasattr(settings, "FEEDS_PARSE_MAX_TASKS_PER_CHILD"):
+    PARSE_MAX_TASKS_PER_CHILD = settings.FEEDS_PARSE_MAX_TASKS_PER_CHILD
+
+PARSE_SANDBOX = False
+if hasattr(settings, "FEEDS_PARSE_SANDBOX"):
+    PARSE_SANDBOX = settings.FEEDS_PARSE_SANDBOX
+
+PARSE_TIMEOUT = 60
+if hasattr(settings, "FEEDS_PARSE_TIMEOUT"):
+    PARSE_TIMEOUT = settings.FEEDS_PARSE_TIMEOUT
+
+PARSE_MEMORY_MB = 512
+if hasattr(settings, "FEEDS_PARSE_MEMORY_MB"):
+    PARSE_MEMORY_MB = settings.FEEDS_PARSE_MEMORY_MB
+
+QUARANTINE_MINUTES = 60
+if hasattr(settings, "FEEDS_QUARANTINE_MINUTES"):
+    QUARANTINE_MINUTES = settings.FEEDS_QUARANTINE_MINUTES
+
+# The longest a feed is kept in quarantine, however many times it has been there
+MAX_QUARANTINE_MINUTES = 60 * 24 * 7
+
+# How many guids are looked up in one query, to stay under the database's limit on parameters
+GUID_LOOKUP_BATCH = 500
+
+# How much of an error response is read, enough to see what sort of error page it is
+SNIFF_BYTES = 64 * 1024
+
+
+# gzip and deflate, plus brotli / zstd if the libraries for them are installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
 
 logger = logging.getLogger(__file__)
 
 
+class FeedTooLarge(Exception):
+    """Raised when a feed is bigger than **FEEDS_MAX_FEED_BYTES**"""
+    pass
+
+
+class ParseLimitExceeded(Exception):
+    """Raised when a feed parsed in the sandbox takes longer than **FEEDS_PARSE_TIMEOUT**
+    seconds or more memory than **FEEDS_PARSE_MEMORY_MB**"""
+    pass
+
+
+class FetchDeadlineExceeded(Exception):
+    """Raised when a feed takes longer than **FEEDS_FETCH_DEADLINE** seconds to download"""
+    pass
+
+
+_session = None
+_session_lock = threading.Lock()
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
 def _customize_sanitizer(fp):
 
     bad_attributes = [
@@ -61,6 +163,192 @@ def get_agent(source_feed: Source):
     return agent
 
 
+def get_session() -> requests.Session:
+    """The shared requests Session used to fetch feeds.
+
+    Connections are pooled per host and kept alive between fetches, so feeds
+    that share a host don't pay for a new connection each time.  The Session is
+    created on first use and is safe to share between worker threads.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retries = Retry(total=HTTP_RETRIES, read=0, status=0, redirect=False, backoff_factor=0.5)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retries)
+
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.verify = VERIFY_HTTPS
+            # Don't let cookies set by one feed get sent along with another, read_feed
+            # keeps the cookies for each feed's own requests (a redirect chain, say)
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            _session = session
+
+        return _session
+
+
+def close_session():
+    """Closes the shared Session and its pooled connections.
+
+    A new one will be created the next time :func:`get_session` is called.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """The shared pool of processes that feeds are parsed in when **FEEDS_PARSE_PROCESSES** is set.
+
+    The processes are started afresh rather than forked from the poller and its threads,
+    so they set Django up from ``DJANGO_SETTINGS_MODULE``.  On Python 3.11 and later each
+    one is replaced after it has parsed **FEEDS_PARSE_MAX_TASKS_PER_CHILD** feeds, so the
+    memory used by a big feed isn't held onto.  The pool is created on first use.
+    """
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            options = {}
+            if sys.version_info >= (3, 11):
+                options["max_tasks_per_child"] = PARSE_MAX_TASKS_PER_CHILD
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+                **options,
+            )
+
+        return _parse_pool
+
+
+def close_parse_pool():
+    """Shuts down the shared parse pool, if there is one.
+
+    A new one will be created the next time :func:`get_parse_pool` is called.
+    """
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+
+
+def _body_limit(ret) -> int:
+    # Error pages are only read far enough to tell what they are
+    if ret.status_code >= 400:
+        return SNIFF_BYTES
+    try:
+        if int(ret.headers["Content-Length"]) > MAX_FEED_BYTES:
+            raise FeedTooLarge(f"Feed is too large ({ret.headers['Content-Length']} bytes, the limit is {MAX_FEED_BYTES})")
+    except (KeyError, ValueError):
+        pass
+    return MAX_FEED_BYTES
+
+
+def _add_chunk(ret, body: bytearray, chunk: bytes, limit: int, deadline: float) -> bool:
+    # Adds a chunk to a body being downloaded, returns False once there's enough
+    body += chunk
+    if len(body) > limit:
+        if ret.status_code >= 400:
+            del body[limit:]
+            return False
+        raise FeedTooLarge(f"Feed is too large (more than {MAX_FEED_BYTES} bytes)")
+    if time.monotonic() > deadline:
+        raise FetchDeadlineExceeded(f"Feed took more than {FETCH_DEADLINE}s to download")
+    return True
+
+
+def _shut_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # already closed
+
+
+def _watch_deadline(ret, deadline: float):
+    # A read only times out when the server goes quiet, so one that trickles the
+    # body out a few bytes at a time is cut off by shutting its socket at the deadline.
+    sock = getattr(getattr(ret.raw, "_connection", None), "sock", None)
+    if sock is None:
+        return None
+    timer = threading.Timer(max(deadline - time.monotonic(), 0), _shut_socket, (sock,))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def read_body(ret, deadline: float):
+    """Downloads the body of a streamed requests Response.
+
+    The download is stopped with :class:`FeedTooLarge` if the (decompressed)
+    body is bigger than **FEEDS_MAX_FEED_BYTES**, or :class:`FetchDeadlineExceeded`
+    if it is still going at **deadline** (a ``time.monotonic()`` time), however
+    slowly the server is sending it.  Error responses only have their first 64KB
+    read.  Afterwards ``ret.content`` is the body as usual.
+    """
+    body = bytearray()
+    timer = _watch_deadline(ret, deadline)
+    try:
+        limit = _body_limit(ret)
+        for chunk in ret.iter_content(chunk_size=16 * 1024):
+            if not _add_chunk(ret, body, chunk, limit, deadline):
+                break
+    except requests.RequestException:
+        if time.monotonic() > deadline:
+            raise FetchDeadlineExceeded(f"Feed took more than {FETCH_DEADLINE}s to download") from None
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        ret.close()
+    if timer is not None and time.monotonic() > deadline:
+        # the socket was shut before the end of the body
+        raise FetchDeadlineExceeded(f"Feed took more than {FETCH_DEADLINE}s to download")
+    ret._content = bytes(body)
+    ret._content_consumed = True
+
+
+async def aread_body(ret, deadline: float):
+    """Async version of :func:`read_body` for a streamed httpx Response."""
+    body = bytearray()
+
+    async def read():
+        async for chunk in ret.aiter_bytes():
+            if not _add_chunk(ret, body, chunk, limit, deadline):
+                break
+
+    try:
+        limit = _body_limit(ret)
+        await asyncio.wait_for(read(), max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        raise FetchDeadlineExceeded(f"Feed took more than {FETCH_DEADLINE}s to download") from None
+    finally:
+        await ret.aclose()
+    ret._content = bytes(body)
+
+
+def get_transfer_size(ret) -> int:
+    """The number of bytes a response took on the wire, before it was decompressed."""
+    if hasattr(ret, "num_bytes_downloaded"):
+        # httpx
+        return ret.num_bytes_downloaded
+    try:
+        return ret.raw.tell()
+    except Exception:
+        pass
+    try:
+        return int(ret.headers["Content-Length"])
+    except Exception:
+        return len(ret.content)
+
+
 def fix_relative(html: str, url: str):
 
     """ this is fucking cheesy """
@@ -100,11 +388,63 @@ def hash_body(body):
     return m.hexdigest()
 
 
+UPDATE_PERIODS = {
+    "hourly": 60,
+    "daily": 60 * 24,
+    "weekly": 60 * 24 * 7,
+    "monthly": 60 * 24 * 30,
+    "yearly": 60 * 24 * 365,
+}
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def get_schedule_hints(f, feed_content: bytes) -> dict:
+    """Finds the RSS ttl, skipHours, skipDays and sy:updatePeriod of a feed.
+
+    feedparser only keeps the last of the skipHours and skipDays, so those
+    are picked out of the raw feed.
+    """
+    hints = {}
+
+    try:
+        hints["ttl"] = int(f.feed.ttl)
+    except Exception:
+        pass
+
+    try:
+        period = UPDATE_PERIODS[f.feed.sy_updateperiod.strip().lower()]
+        frequency = int(f.feed.get("sy_updatefrequency", 1)) or 1
+        hints["update_minutes"] = period / frequency
+    except Exception:
+        pass
+
+    text = feed_content.decode("utf-8", "ignore") if isinstance(feed_content, bytes) else feed_content
+
+    match = re.search(r"<skipHours>(.*?)</skipHours>", text, re.S | re.I)
+    if match:
+        hours = {int(h) % 24 for h in re.findall(r"<hour>\s*(\d+)\s*</hour>", match.group(1), re.I)}
+        if hours:
+            hints["skip_hours"] = sorted(hours)
+
+    match = re.search(r"<skipDays>(.*?)</skipDays>", text, re.S | re.I)
+    if match:
+        days = {DAYS.index(d.lower()) for d in re.findall(r"<day>\s*(\w+)\s*</day>", match.group(1), re.I) if d.lower() in DAYS}
+        if days:
+            hints["skip_days"] = sorted(days)
+
+    return hints or None
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
 def is_valid_post_guid(x):
     return (x is not None) and (len(x) <= Post.GUID_MAX_LENGTH)
 
 
-def parse_feed(source_feed: Source, feed_body, content_type, output: TextIO):
+def parse_feed(source_feed: Source, feed_body, content_type, output: TextIO, is_delta: bool = False):
     """Process the queue of feeds that need polling.
 
     :param max_feeds: The maximum number of feeds to read from the queue (default 3).
@@ -112,14 +452,17 @@ def parse_feed(source_feed: Source, feed_body, content_type, output: TextIO):
 
     :param output: A file-like object where logging messages will be written.
     :type output: TextIO
+
+    :param is_delta: The body is an RFC 3229 feed delta that only holds new entries (default False).
+    :type is_delta: bool
     """
     ok = False
     changed = False
 
     if "xml" in content_type or feed_body[0:1] == b"<":
-        (ok, changed) = parse_feed_xml(source_feed, feed_body, output)
+        (ok, changed) = parse_feed_xml(source_feed, feed_body, output, is_delta)
     elif "json" in content_type or feed_body[0:1] == b"{":
-        (ok, changed) = parse_feed_json(source_feed, str(feed_body, "utf-8"), output)
+        (ok, changed) = parse_feed_json(source_feed, str(feed_body, "utf-8"), output, is_delta)
     else:
         ok = False
         source_feed.last_result = "Unknown Feed Type: " + content_type
@@ -127,21 +470,227 @@ def parse_feed(source_feed: Source, feed_body, content_type, output: TextIO):
     if ok and changed:
         source_feed.last_result = " OK (updated)"  # and temporary redirects
         source_feed.last_change = timezone.now()
+        index_new_posts(source_feed)
 
-        idx = source_feed.max_index
-        # give indices to posts based on created date
-        posts = Post.objects.filter(Q(source=source_feed) & Q(index=0)).order_by("created")
-        for p in posts:
-            idx += 1
-            p.index = idx
-            p.save(update_fields=["index"])
+    return (ok, changed)
 
-        source_feed.max_index = idx
 
-    return (ok, changed)
+def index_new_posts(source_feed: Source) -> int:
+    """Gives the new Posts of a feed (those with an index of 0) their indices, in order of creation.
+
+    The Source's row is locked while a block of indices is reserved from its **max_index**
+    and the Posts are numbered in one ``bulk_update``, so two workers indexing the same
+    feed can never hand out the same index twice.
+
+    :return: The number of Posts that were indexed.
+    :rtype: int
+    """
+    with transaction.atomic():
+        Source.objects.select_for_update().filter(id=source_feed.id).values_list("id").first()
+        posts = list(Post.objects.filter(Q(source=source_feed) & Q(index=0)).order_by("created", "id").only("id", "created"))
+        if posts:
+            Source.objects.filter(id=source_feed.id).update(max_index=F("max_index") + len(posts))
+        source_feed.refresh_from_db(fields=["max_index"])
+
+        first = source_feed.max_index - len(posts) + 1
+        for (i, p) in enumerate(posts):
+            p.index = first + i
+        Post.objects.bulk_update(posts, ["index"])
+
+    return len(posts)
+
+
+def parse_xml(feed_content: bytes):
+    """Parses an RSS / Atom feed with feedparser.
+
+    If **FEEDS_FAST_PARSER** is set, well formed RSS 2.0 and Atom feeds are read by
+    :mod:`feeds.fastparser` instead, which gives the same entries more quickly.
+    """
+    _customize_sanitizer(parser)
+    f = None
+    if FAST_PARSER and not SAVE_JSON:  # the saved json is everything feedparser found
+        f = fastparser.parse(feed_content)
+    if f is None:
+        f = parser.parse(feed_content)
+    return f
+
+
+def parse_document(feed_content: bytes) -> tuple:
+    """Parses an RSS / Atom feed and finds its schedule hints.
+
+    This only deals in plain data, not models, so it can be run in the parse pool.
+
+    :return: The feed as parsed by feedparser and its schedule hints.
+    :rtype: tuple
+    """
+    f = parse_xml(feed_content)
+    return (f, get_schedule_hints(f, feed_content))
+
 
+def _parse_document_elsewhere(feed_content: bytes) -> tuple:
+    # Runs in a pool or sandbox process.  Not every exception can be pickled to send back.
+    (f, hints) = parse_document(feed_content)
+    if "bozo_exception" in f:
+        f["bozo_exception"] = str(f["bozo_exception"])
+    return (f, hints)
 
-def parse_feed_xml(source_feed, feed_content, output: TextIO):
+
+def _address_space() -> int:
+    # The size of this process's address space in bytes, or 0 if it can't be found (Linux only)
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * resource.getpagesize()
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def _run_sandbox(conn, parse, args: tuple, memory_limit: int):
+    # The body of the sandbox process.  It was forked from the poller so it
+    # starts out the same size, the limit is how much more it may take.
+    size = _address_space()
+    if memory_limit and size:
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        soft = size + memory_limit
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+    try:
+        conn.send(("ok", parse(*args)))
+    except MemoryError:
+        conn.send(("memory", None))
+    except Exception as ex:
+        conn.send(("error", str(ex)))
+    finally:
+        conn.close()
+
+
+def _sandbox_context():
+    # A child forked while other threads are running can be stuck forever on a lock one
+    # of them held at the time, so then the sandbox is forked from a fork server instead.
+    if threading.active_count() == 1:
+        return multiprocessing.get_context("fork")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["feeds.forkserver"])
+    return context
+
+
+def parse_in_sandbox(feed_content, *args, parse=None) -> tuple:
+    """Parses a feed with :func:`parse_document` (or **parse**, given **feed_content** and
+    **args**) in a process of its own.
+
+    The process is killed if it hasn't finished after **FEEDS_PARSE_TIMEOUT** seconds
+    and it can't use more than **FEEDS_PARSE_MEMORY_MB** of extra memory, so a hostile
+    or broken feed can't hang or take down the poller.  It is forked (so this is Unix
+    only) which is quick as everything the parser needs is already loaded.  If the poller
+    has other threads (``--workers`` or the daemon) it is forked from a fork server
+    instead, as forking a process with threads isn't safe.
+
+    :raises ParseLimitExceeded: If the feed took too long or too much memory to parse.
+    """
+    context = _sandbox_context()
+    (receiver, sender) = context.Pipe(duplex=False)
+    parse = parse or _parse_document_elsewhere
+    process = context.Process(target=_run_sandbox, args=(sender, parse, (feed_content,) + args, PARSE_MEMORY_MB * 1024 * 1024), daemon=True)
+    process.start()
+    sender.close()
+
+    try:
+        if not receiver.poll(PARSE_TIMEOUT):
+            raise ParseLimitExceeded(f"Parsing took longer than {PARSE_TIMEOUT}s")
+        try:
+            (status, result) = receiver.recv()
+        except EOFError:
+            process.join()
+            raise ParseLimitExceeded(f"The parser died (exit code {process.exitcode})")
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+
+    if status == "memory":
+        raise ParseLimitExceeded(f"Parsing needed more than {PARSE_MEMORY_MB}MB")
+    if status == "error":
+        raise ValueError(result)
+    return result
+
+
+def quarantine(source_feed: Source, reason: str):
+    """Puts a feed that couldn't be parsed within the sandbox's limits aside for a while.
+
+    It won't be polled for **FEEDS_QUARANTINE_MINUTES**, doubling each time it is
+    quarantined again in a row, up to a week.
+    """
+    source_feed.quarantine_count += 1
+    minutes = min(QUARANTINE_MINUTES * 2 ** (source_feed.quarantine_count - 1), MAX_QUARANTINE_MINUTES)
+    source_feed.quarantine_reason = reason[:255]
+    source_feed.quarantined_until = timezone.now() + datetime.timedelta(minutes=minutes)
+    source_feed.last_result = f"Quarantined: {reason}"[:255]
+
+
+def release_quarantine(source_feed: Source):
+    """Clears a feed's quarantine once it has been parsed successfully."""
+    if source_feed.quarantine_count:
+        source_feed.quarantine_count = 0
+        source_feed.quarantine_reason = None
+        source_feed.quarantined_until = None
+
+
+def read_document(feed_content: bytes) -> tuple:
+    """Parses a feed with :func:`parse_document`.
+
+    If **FEEDS_PARSE_SANDBOX** is set it is parsed by :func:`parse_in_sandbox`, otherwise in
+    the parse pool if **FEEDS_PARSE_PROCESSES** is set.  Either way the calling thread waits
+    for the result, so use as many update workers as there are parse processes to keep them busy.
+    """
+    return _run_parser(parse_document, _parse_document_elsewhere, feed_content)
+
+
+def read_json_document(feed_content: str, site_url: str) -> tuple:
+    """Parses a JSON feed with :func:`parse_json_document`, in the sandbox or the parse pool
+    like :func:`read_document`."""
+    return _run_parser(parse_json_document, parse_json_document, feed_content, site_url)
+
+
+def _run_parser(parse, parse_elsewhere, *args):
+    # Runs a parser where it's been set up to run, parse_elsewhere is the version
+    # of it whose results can be sent back from another process
+    if PARSE_SANDBOX:
+        return parse_in_sandbox(*args, parse=parse_elsewhere)
+
+    if not PARSE_PROCESSES:
+        return parse(*args)
+
+    try:
+        return get_parse_pool().submit(parse_elsewhere, *args).result()
+    except BrokenProcessPool:
+        close_parse_pool()  # start a new pool for the next feed
+        raise
+
+
+def get_next_page(f) -> str:
+    """The url of the next (older) page of a paginated feed parsed by feedparser, or None."""
+    for link in f.feed.get("links", []):
+        if link.get("rel") == "next" and link.get("href"):
+            return link["href"]
+    return None
+
+
+def parse_backfill_page(source_feed: Source, feed_content: bytes, output: TextIO) -> tuple:
+    """Saves the entries from an older page of a paginated feed.
+
+    Unlike :func:`parse_feed` this leaves the feed's own details alone.
+
+    :return: Whether there were any new entries and the url of the page after this one (or None).
+    :rtype: tuple
+    """
+    f = read_document(feed_content)[0]
+    changed = save_xml_entries(source_feed, f["entries"], output)
+    return (changed, get_next_page(f))
+
+
+def parse_feed_xml(source_feed, feed_content, output: TextIO, is_delta: bool = False):
 
     ok = True
     changed = False
@@ -154,39 +703,41 @@ def parse_feed_xml(source_feed, feed_content, output: TextIO):
     # output.write(ret.content)
     try:
 
-        _customize_sanitizer(parser)
-        f = parser.parse(feed_content)  # need to start checking feed parser errors here
+        (f, hints) = read_document(feed_content)  # need to start checking feed parser errors here
+        release_quarantine(source_feed)
         entries = f['entries']
-        if len(entries):
+        source_feed.schedule_hints = hints
+        if len(entries) or is_delta:  # a delta can be empty if there's nothing new
             source_feed.last_success = timezone.now()  # in case we start auto unsubscribing long dead feeds
         else:
             source_feed.last_result = "Feed is empty"
             ok = False
 
+    except ParseLimitExceeded as ex:
+        output.write(f"\nQuarantined: {ex}")
+        quarantine(source_feed, str(ex))
+        entries = []
+        ok = False
+
     except Exception:
         source_feed.last_result = "Feed Parse Error"
         entries = []
         ok = False
 
-    source_feed.save(update_fields=["last_success", "last_result"])
-
     if ok:
         try:
             source_feed.name = f.feed.title
-            source_feed.save(update_fields=["name"])
         except Exception as ex:
             logger.warning("Update name error:" + str(ex))
             pass
 
         try:
             source_feed.site_url = f.feed.link
-            source_feed.save(update_fields=["site_url"])
         except Exception:
             pass
 
         try:
             source_feed.image_url = f.feed.image.href
-            source_feed.save(update_fields=["image_url"])
         except Exception:
             pass
 
@@ -202,435 +753,538 @@ def parse_feed_xml(source_feed, feed_content, output: TextIO):
         except Exception:
             pass
 
-        try:
-            source_feed.save(update_fields=["description"])
-        except Exception:
-            pass
-
         # output.write(entries)
-        entries.reverse()  # Entries are typically in reverse chronological order - put them in right order
-        for e in entries:
-            # we are going to take the longest
-            body = ""
-
-            if hasattr(e, "summary"):
-                if len(e.summary) > len(body):
-                    body = e.summary
-                    body = body.strip()
-
-            if hasattr(e, "summary_detail"):
-                if len(e.summary_detail.value) >= len(body):
-                    body = e.summary_detail.value
-                    body = body.strip()
-
-            if hasattr(e, "description"):
-                if len(e.description) >= len(body):
-                    body = e.description
-                    body = body.strip()
-
-            # This can be a content:encoded html body
-            # but it can also be the alt-text of an an Enclosure
-            if hasattr(e, "content"):
-                for c in e.content:
-                    if c.get("type", "") == "text/html" and len(c.get("value", "")) > len(body):
-                        body = c.value
-
-            body = fix_relative(body, source_feed.site_url)
-            e_guid = getattr(e, 'guid', None)
-            e_link = getattr(e, 'link', None)
-            guid = make_guid(e_guid, e_link, body)
-            try:
-                p = Post.objects.filter(source=source_feed).filter(guid=guid)[0]
-                output.write("\nEXISTING " + guid)
+        changed = save_xml_entries(source_feed, entries, output)
 
-            except Exception:
-                output.write("\nNEW " + guid)
-                p = Post(index=0, body=" ", title="", guid=guid)
-                p.found = timezone.now()
-                changed = True
-
-                try:
-                    p.created = datetime.datetime.fromtimestamp(time.mktime(e.published_parsed)).replace(tzinfo=datetime.timezone.utc)
-                except Exception:
-                    try:
-                        p.created = datetime.datetime.fromtimestamp(time.mktime(e.updated_parsed)).replace(tzinfo=datetime.timezone.utc)
-                    except Exception as ex3:
-                        output.write("\nCREATED ERROR:" + str(ex3))
-                        p.created = timezone.now()
-
-                p.source = source_feed
-                p.save()
-
-            if SAVE_JSON:
-                p.json = e
-                p.save(update_fields=["json"])
+        if SAVE_JSON:
+            # Kill the entries
+            f["entries"] = None
+            source_feed.json = f
 
-            try:
-                p.title = e.title
-                p.save(update_fields=["title"])
-            except Exception as ex:
-                output.write("\nTitle error:" + str(ex))
+    if is_first and ok and source_feed.posts.all().count() > 0:
+        # If this is the first time we have parsed this then see if it's
+        # paginated, if so backfill_feeds will go back through its history
+        source_feed.backfill_url = get_next_page(f)
+        if source_feed.backfill_url:
+            output.write("\nOlder posts to backfill from " + source_feed.backfill_url)
 
-            try:
-                p.link = e.link
-                p.save(update_fields=["link"])
-            except Exception as ex:
-                output.write("\nLink error:" + str(ex))
+    _fit(source_feed)
+    return (ok, changed)
 
-            try:
-                p.image_url = e.image.href
-                p.save(update_fields=["image_url"])
-            except Exception:
-                pass
 
-            try:
-                p.author = e.author
-                p.save(update_fields=["author"])
-            except Exception:
-                p.author = ""
+def _fit(instance):
+    # Cuts strings down to their field's max_length, so that one overlong value
+    # can't fail the transaction that a whole feed is saved in
+    for field in instance._meta.concrete_fields:
+        value = getattr(instance, field.attname)
+        if field.max_length and isinstance(value, str) and len(value) > field.max_length:
+            setattr(instance, field.attname, value[:field.max_length])
 
-            try:
-                p.body = body
-                p.save(update_fields=["body"])
-                # output.write(p.body)
-            except Exception as ex:
-                output.write(str(ex))
-                output.write(p.body)
-
-            try:
-                seen_files = []
 
-                post_files = e["enclosures"]
-                non_dupes = []
-
-                # find any files in media_content that aren't already declared as enclosures
-                if "media_content" in e:
-                    for ee in e["media_content"]:
+class PostWriter(object):
+    """Writes the Posts and Enclosures for the entries of one feed in a handful of queries.
 
-                        # try and find a description for this.
-                        # The way the feedparser works makes this difficult
-                        # because it should be a child of ee but it isn't
-                        # so while, I don't think this is right, it works most of the time
-                        if len(e["media_content"]) == 1 and len(e.get("content", [])) == 1:
-                            ee["description"] = e["content"][0].get("value")
+    All of the feed's existing Posts with the given guids are loaded up front, then
+    the Enclosures of just those that are going to be updated (see :meth:`skip_unchanged`).
+    New Posts and Enclosures are kept until :meth:`save` creates them all with
+    ``bulk_create``, and changes to existing Enclosures are written then too, with
+    one query for each kind of change.  Changes to existing Posts are written straight
+    away.  Use it inside a transaction so that the whole feed is saved or none of it.
+    """
 
-                        found = False
-                        for ff in post_files:
-                            if ff["href"] == ee["url"]:
-                                found = True
-                                break
-                        if not found:
-                            non_dupes.append(ee)
+    def __init__(self, source_feed: Source, guids: list):
+        self.source_feed = source_feed
+        self.posts = {}
+        self.enclosures = {}
+        self.new_posts = []
+        self.new_enclosures = {}  # by the id() of the Post, which may not have a pk yet
+        self.changed_enclosures = {}  # by pk
+        self.retired_enclosures = []
+        self.deleted_enclosures = []
+
+        hashes = list({hash_guid(guid) for guid in guids})
+        for i in range(0, len(hashes), GUID_LOOKUP_BATCH):
+            for p in Post.objects.filter(source=source_feed, guid_hash__in=hashes[i:i + GUID_LOOKUP_BATCH]):
+                self.posts.setdefault(p.guid, p)
+
+    def load_enclosures(self, guids: list):
+        """Loads the Enclosures of the existing Posts with these guids, which are about to be updated."""
+        ids = list({self.posts[guid].id for guid in guids if guid in self.posts})
+        for i in range(0, len(ids), GUID_LOOKUP_BATCH):
+            for ee in Enclosure.objects.filter(post_id__in=ids[i:i + GUID_LOOKUP_BATCH]).order_by("id"):
+                self.enclosures.setdefault(ee.post_id, []).append(ee)
+
+    def get(self, guid: str) -> Post:
+        """The Post with this guid, existing or new, or None if there isn't one yet."""
+        return self.posts.get(guid)
+
+    def skip_unchanged(self, parsed: list, site_url: str, output: TextIO) -> list:
+        """Drops the entries that are the same as when their Post was saved and loads the Enclosures for the rest.
+
+        :param parsed: (entry, body, guid) for each entry.
+        :type parsed: list
+
+        :return: (entry, body, guid, fingerprint) for each entry that is new or has changed.
+        :rtype: list
+        """
+        todo = []
+        for (e, body, guid) in parsed:
+            fingerprint = fingerprint_entry(e, site_url)
+            post = self.posts.get(guid)
+            if post is not None and post.fingerprint == fingerprint:
+                output.write("\nUNCHANGED " + guid)
+            else:
+                todo.append((e, body, guid, fingerprint))
+        self.load_enclosures([guid for (e, body, guid, fingerprint) in todo])
+        return todo
+
+    def add(self, post: Post):
+        """Adds a new Post, to be created by :meth:`save`."""
+        post.guid_hash = hash_guid(post.guid)  # bulk_create doesn't call save()
+        self.posts[post.guid] = post
+        self.new_posts.append(post)
+
+    def update(self, post: Post):
+        """Saves whatever has changed on **post** in one UPDATE, if it already exists.  New Posts are saved by :meth:`save`."""
+        if post.pk is not None:
+            _fit(post)
+            post.save_changes()
+
+    def get_enclosures(self, post: Post) -> list:
+        """The Enclosures **post** has so far, existing or new."""
+        existing = self.enclosures.get(post.pk, []) if post.pk is not None else []
+        return existing + self.new_enclosures.get(id(post), [])
+
+    def add_enclosure(self, enclosure: Enclosure):
+        """Adds a new Enclosure, to be created by :meth:`save`."""
+        self.new_enclosures.setdefault(id(enclosure.post), []).append(enclosure)
+
+    def sync_enclosures(self, post: Post, files: dict):
+        """Makes **post**'s Enclosures match the files of its entry.
+
+        Each Enclosure is matched to a file by its href.  Those that have changed are
+        updated and files without one are added.  Enclosures that are no longer in the
+        entry (or repeat an earlier href) are deleted, or marked as not current if
+        **FEEDS_KEEP_OLD_ENCLOSURES** is set.  Nothing is written until :meth:`save`.
+
+        :param files: The Enclosure fields for each of the entry's files, by href.
+        :type files: dict
+        """
+        seen = set()
+        for ee in self.get_enclosures(post):
+            fields = files.get(ee.href)
+            if fields is None or ee.href in seen:
+                self._drop_enclosure(ee)
+            else:
+                changed = False
+                for (name, value) in fields.items():
+                    if getattr(ee, name) != value:
+                        setattr(ee, name, value)
+                        changed = True
+                if changed and ee.pk is not None:
+                    self.changed_enclosures[ee.pk] = ee
+            seen.add(ee.href)
+
+        for (href, fields) in files.items():
+            if href not in seen:
+                self.add_enclosure(Enclosure(post=post, href=href, **fields))
+
+    def _drop_enclosure(self, enclosure: Enclosure):
+        # An Enclosure that is no longer in its entry
+        if KEEP_OLD_ENCLOSURES:
+            if enclosure.is_current:
+                enclosure.is_current = False
+                if enclosure.pk is not None:
+                    self.retired_enclosures.append(enclosure.pk)
+        elif enclosure.pk is not None:
+            self.enclosures[enclosure.post_id].remove(enclosure)
+            self.changed_enclosures.pop(enclosure.pk, None)
+            self.deleted_enclosures.append(enclosure.pk)
+        else:
+            self.new_enclosures[id(enclosure.post)].remove(enclosure)
+
+    def save(self):
+        """Creates the new Posts and Enclosures and writes the changes to the existing Enclosures."""
+        if self.new_posts:
+            for p in self.new_posts:
+                _fit(p)
+            Post.objects.bulk_create(self.new_posts)
+            if not connection.features.can_return_rows_from_bulk_insert:
+                ids = dict(Post.objects.filter(source=self.source_feed, guid_hash__in=[p.guid_hash for p in self.new_posts]).values_list("guid_hash", "id"))
+                for p in self.new_posts:
+                    p.pk = ids[p.guid_hash]
+
+        enclosures = [ee for pending in self.new_enclosures.values() for ee in pending]
+        for ee in enclosures:
+            ee.post_id = ee.post.pk  # the Post may have only just been created
+            _fit(ee)
+        Enclosure.objects.bulk_create(enclosures)
+
+        if self.changed_enclosures:
+            for ee in self.changed_enclosures.values():
+                _fit(ee)
+            Enclosure.objects.bulk_update(self.changed_enclosures.values(), ["length", "type", "medium", "description"])
+        if self.retired_enclosures:
+            Enclosure.objects.filter(id__in=self.retired_enclosures).update(is_current=False)
+        if self.deleted_enclosures:
+            Enclosure.objects.filter(id__in=self.deleted_enclosures).delete()
+
+
+def fingerprint_entry(entry: dict, site_url: str) -> str:
+    """A digest of an entry as it was parsed from the feed, to tell if it has changed since it was saved.
+
+    The feed's **site_url** is part of it as relative links in the body are made absolute with it.
+    """
+    m = hashlib.md5()
+    m.update(json.dumps([site_url, entry], sort_keys=True, default=str).encode("utf-8"))
+    return m.hexdigest()
 
-                    post_files += non_dupes
 
-                for ee in list(p.enclosures.all()):
-                    # check existing enclosure is still there
-                    found_enclosure = False
-                    for pe in post_files:
+def _xml_body(e, site_url: str) -> str:
+    # The body of an entry parsed by feedparser
+    # we are going to take the longest
+    body = ""
 
-                        href = "href"
-                        if href not in pe:
-                            href = "url"
+    if hasattr(e, "summary"):
+        if len(e.summary) > len(body):
+            body = e.summary
+            body = body.strip()
 
-                        length = "length"
-                        if length not in pe:
-                            length = "filesize"
+    if hasattr(e, "summary_detail"):
+        if len(e.summary_detail.value) >= len(body):
+            body = e.summary_detail.value
+            body = body.strip()
 
-                        if pe[href] == ee.href and ee.href not in seen_files:
-                            found_enclosure = True
+    if hasattr(e, "description"):
+        if len(e.description) >= len(body):
+            body = e.description
+            body = body.strip()
 
-                            try:
-                                ee.length = int(pe[length])
-                            except Exception:
-                                ee.length = 0
+    # This can be a content:encoded html body
+    # but it can also be the alt-text of an an Enclosure
+    if hasattr(e, "content"):
+        for c in e.content:
+            if c.get("type", "") == "text/html" and len(c.get("value", "")) > len(body):
+                body = c.value
 
-                            try:
-                                type = pe["type"]
-                            except Exception:
-                                type = "unknown"
+    return fix_relative(body, site_url)
 
-                            ee.type = type
 
-                            if "medium" in pe:
-                                ee.medium = pe["medium"]
+def save_xml_entries(source_feed: Source, entries: list, output: TextIO) -> bool:
+    """Creates or updates the Posts (and their Enclosures) for entries parsed by feedparser.
 
-                            if "description" in pe:
-                                ee.description = pe["description"][:512]
+    Entries that are the same as when their Post was last saved (see :func:`fingerprint_entry`)
+    are skipped.
 
-                            ee.save()
-                            break
-                    if not found_enclosure:
-                        if KEEP_OLD_ENCLOSURES:
-                            ee.is_current = False
-                            ee.save()
-                        else:
-                            ee.delete()
-                    seen_files.append(ee.href)
+    :return: True if any of the entries were new.
+    :rtype: bool
+    """
+    changed = False
 
-                for pe in post_files:
+    entries.reverse()  # Entries are typically in reverse chronological order - put them in right order
+    parsed = []
+    for e in entries:
+        e_guid = getattr(e, 'guid', None)
+        e_link = getattr(e, 'link', None)
+        body = None
+        if not is_valid_post_guid(e_guid) and not is_valid_post_guid(e_link):
+            body = _xml_body(e, source_feed.site_url)  # the guid is a hash of it
+        parsed.append((e, body, make_guid(e_guid, e_link, body)))
+
+    with transaction.atomic():
+        writer = PostWriter(source_feed, [guid for (e, body, guid) in parsed])
+        todo = writer.skip_unchanged(parsed, source_feed.site_url, output)
+        for (e, body, guid, fingerprint) in todo:
+            if body is None:
+                body = _xml_body(e, source_feed.site_url)
+            changed = _save_xml_entry(writer, source_feed, e, body, guid, fingerprint, output) or changed
+        writer.save()
+
+    return changed
+
+
+def _save_xml_entry(writer: PostWriter, source_feed: Source, e, body: str, guid: str, fingerprint: str, output: TextIO) -> bool:
+    # Saves one entry with save_xml_entries, returns True if it's new
+    changed = False
 
-                    href = "href"
-                    if href not in pe:
-                        href = "url"
+    p = writer.get(guid)
+    if p is not None:
+        output.write("\nEXISTING " + guid)
 
-                    length = "length"
-                    if length not in pe:
-                        length = "filesize"
+    else:
+        output.write("\nNEW " + guid)
+        p = Post(index=0, body=" ", title="", guid=guid)
+        p.found = timezone.now()
+        changed = True
 
-                    try:
-                        if pe[href] not in seen_files:
+        try:
+            p.created = datetime.datetime.fromtimestamp(time.mktime(e.published_parsed)).replace(tzinfo=datetime.timezone.utc)
+        except Exception:
+            try:
+                p.created = datetime.datetime.fromtimestamp(time.mktime(e.updated_parsed)).replace(tzinfo=datetime.timezone.utc)
+            except Exception as ex3:
+                output.write("\nCREATED ERROR:" + str(ex3))
+                p.created = timezone.now()
 
-                            try:
-                                length = int(pe[length])
-                            except Exception:
-                                length = 0
+        p.source = source_feed
+        writer.add(p)
 
-                            try:
-                                type = pe["type"]
-                            except Exception:
-                                type = "audio/mpeg"
+    p.fingerprint = fingerprint
+    if SAVE_JSON:
+        p.json = e
 
-                            ee = Enclosure(post=p, href=pe[href], length=length, type=type)
+    try:
+        p.title = e.title
+    except Exception as ex:
+        output.write("\nTitle error:" + str(ex))
 
-                            if "medium" in pe:
-                                ee.medium = pe["medium"]
+    try:
+        p.link = e.link
+    except Exception as ex:
+        output.write("\nLink error:" + str(ex))
 
-                            if "description" in pe:
-                                ee.description = pe["description"][:512]
+    try:
+        p.image_url = e.image.href
+    except Exception:
+        pass
 
-                            ee.save()
-                    except Exception:
-                        pass
-            except Exception as ex:
-                output.write("\nNo enclosures - " + str(ex))
+    try:
+        p.author = e.author
+    except Exception:
+        p.author = ""
 
-        if SAVE_JSON:
-            # Kill the entries
-            f["entries"] = None
-            source_feed.json = f
-            source_feed.save(update_fields=["json"])
-
-    if is_first and source_feed.posts.all().count() > 0:
-        # If this is the first time we have parsed this
-        # then see if it's paginated and go back through its history
-        agent = get_agent(source_feed)
-        headers = {"User-Agent": agent}  # identify ourselves
-        keep_going = True
-        while keep_going:
-            keep_going = False  # assume were stopping unless we find a next link
-            if hasattr(f.feed, 'links'):
-                for link in f.feed.links:
-                    if 'rel' in link and link['rel'] == "next":
-                        ret = requests.get(link['href'], headers=headers, verify=VERIFY_HTTPS, allow_redirects=True, timeout=20)
-                        (pok, pchanged) = parse_feed_xml(source_feed, ret.content, output)
-                        # print(link['href'])
-                        # print((pok, pchanged))
-                        f = parser.parse(ret.content)  # rebase the loop on this feed version
-                        keep_going = True
+    p.body = body
+    writer.update(p)
 
-    return (ok, changed)
+    try:
+        files = {}
+        for pe in e["enclosures"]:
+            _add_xml_file(files, pe)
+
+        # add any files in media_content that aren't already declared as enclosures
+        if "media_content" in e:
+            for ee in e["media_content"]:
+                description = None
+                # try and find a description for this.
+                # The way the feedparser works makes this difficult
+                # because it should be a child of ee but it isn't
+                # so while, I don't think this is right, it works most of the time
+                if len(e["media_content"]) == 1 and len(e.get("content", [])) == 1:
+                    description = e["content"][0].get("value")
+                _add_xml_file(files, ee, description)
+
+        writer.sync_enclosures(p, files)
+    except Exception as ex:
+        output.write("\nNo enclosures - " + str(ex))
+
+    return changed
+
+
+def _add_xml_file(files: dict, pe: dict, description: str = None):
+    # Adds the Enclosure fields for an enclosure or media_content parsed by feedparser
+    # to files, by href, unless there is already one for it
+    href = pe["href"] if "href" in pe else pe.get("url")
+    if href is None or href in files:
+        return
 
+    try:
+        length = int(pe["length"] if "length" in pe else pe["filesize"])
+    except Exception:
+        length = 0
 
-def parse_feed_json(source_feed, feed_content, output: TextIO):
+    fields = {"length": length, "type": pe.get("type", "audio/mpeg")}
 
-    ok = True
-    changed = False
+    if "medium" in pe:
+        fields["medium"] = pe["medium"]
 
-    try:
-        f = json.loads(feed_content)
-        entries = f['items']
-        if len(entries):
-            source_feed.last_success = timezone.now()  # in case we start auto unsubscribing long dead feeds
-        else:
-            source_feed.last_result = "Feed is empty"
-            source_feed.interval += 120
-            ok = False
+    if description is None:
+        description = pe.get("description")
+    if description is not None:
+        fields["description"] = description[:512]
 
-        source_feed.save(update_fields=["last_success", "last_result"])
+    files[href] = fields
 
-    except Exception:
-        source_feed.last_result = "Feed Parse Error"
-        entries = []
-        source_feed.interval += 120
-        ok = False
 
-    if ok:
+def _sanitize(html: str) -> str:
+    # borrow the RSS parser's sanitizer
+    _customize_sanitizer(parser)
+    return parser.sanitizer._sanitize_html(html, "utf-8", 'text/html')  # TODO: validate charset ??
 
-        if "expired" in f and f["expired"]:
-            # This feed says it is done
-            # TODO: permanently disable
-            # for now source_feed.interval to max
-            source_feed.interval = (24*3*60)
-            source_feed.last_result = "This feed has expired"
-            return (False, False, source_feed.interval)
 
-        try:
-            source_feed.site_url = f["home_page_url"]
-            source_feed.name = f["title"]
+def parse_json_document(feed_content: str, site_url: str) -> tuple:
+    """Parses a JSON feed and sanitises the html in it.
 
-            source_feed.save(update_fields=["site_url", "title"])
+    Like :func:`parse_document` this only deals in plain data, so it can be run in the
+    sandbox or the parse pool.  Relative links in the bodies are made absolute with the
+    feed's ``home_page_url``, or **site_url** if it doesn't have one.
 
-        except Exception:
-            pass
+    :return: The feed as parsed by :mod:`json` and its sanitised title, description and
+        (body, title, guid) for each item.
+    :rtype: tuple
+    """
+    f = json.loads(feed_content)
+    site_url = f.get("home_page_url", site_url)
 
+    clean = {"items": []}
+    for key in ("title", "description"):
         try:
-            if "description" in f:
-                _customize_sanitizer(parser)
-                source_feed.description = parser.sanitizer._sanitize_html(f["description"], "utf-8", 'text/html')
-                source_feed.save(update_fields=["description"])
+            clean[key] = _sanitize(f[key])
         except Exception:
             pass
 
-        try:
-            _customize_sanitizer(parser)
-            source_feed.name = parser.sanitizer._sanitize_html(source_feed.name, "utf-8", 'text/html')
-            source_feed.save(update_fields=["name"])
+    for e in f["items"]:
+        body = " "
+        if "content_text" in e:
+            body = e["content_text"]
+        if "content_html" in e:
+            body = e["content_html"]  # prefer html over text
 
-        except Exception:
-            pass
+        body = fix_relative(body, site_url)
+        guid = make_guid(e.get("id", None), e.get("url", None), body)
 
         try:
-            if "icon" in f:
-                source_feed.image_url = f["icon"]
-                source_feed.save(update_fields=["icon"])
+            title = _sanitize(e["title"])
         except Exception:
-            pass
+            title = ""
+        # no other fields are ever marked as |safe in the templates
+        clean["items"].append((_sanitize(body), title, guid))
 
-        # output.write(entries)
-        entries.reverse()  # Entries are typically in reverse chronological order - put them in right order
-        for e in entries:
-            body = " "
-            if "content_text" in e:
-                body = e["content_text"]
-            if "content_html" in e:
-                body = e["content_html"]  # prefer html over text
+    return (f, clean)
 
-            body = fix_relative(body, source_feed.site_url)
 
-            e_id = e.get("id", None)
-            e_url = e.get("url", None)
-            guid = make_guid(e_id, e_url, body)
+def _save_json_entry(writer: PostWriter, source_feed: Source, e: dict, body: str, title: str, guid: str, fingerprint: str, output: TextIO) -> bool:
+    # Saves one entry with parse_feed_json, returns True if it's new.  The body and
+    # title have already been sanitised by parse_json_document.
+    changed = False
 
-            try:
-                p = Post.objects.filter(source=source_feed).filter(guid=guid)[0]
-                output.write("\nEXISTING " + guid)
+    p = writer.get(guid)
+    if p is not None:
+        output.write("\nEXISTING " + guid)
 
-            except Exception:
-                output.write("\nNEW " + guid)
-                p = Post(index=0, body=' ')
-                p.found = timezone.now()
-                changed = True
-                p.source = source_feed
+    else:
+        output.write("\nNEW " + guid)
+        p = Post(index=0, body=' ', guid=guid)
+        p.found = timezone.now()
+        changed = True
+        p.source = source_feed
+        writer.add(p)
 
-            try:
-                title = e["title"]
-            except Exception:
-                title = ""
+    if "banner_image" in e:
+        p.image_url = e["banner_image"]
 
-            # borrow the RSS parser's sanitizer
-            _customize_sanitizer(parser)
-            body = parser.sanitizer._sanitize_html(body, "utf-8", 'text/html')  # TODO: validate charset ??
-            _customize_sanitizer(parser)
-            title = parser.sanitizer._sanitize_html(title, "utf-8", 'text/html')  # TODO: validate charset ??
-            # no other fields are ever marked as |safe in the templates
+    if "image" in e:
+        p.image_url = e["image"]
 
-            if "banner_image" in e:
-                p.image_url = e["banner_image"]
+    try:
+        p.link = e["url"]
+    except Exception:
+        p.link = ''
 
-            if "image" in e:
-                p.image_url = e["image"]
+    p.title = title
 
-            try:
-                p.link = e["url"]
-            except Exception:
-                p.link = ''
+    try:
+        p.created = pyrfc3339.parse(e["date_published"])
+    except Exception:
+        output.write("\nCREATED ERROR")
+        if p.created is None:
+            p.created = timezone.now()
 
-            p.title = title
+    p.guid = guid
+    try:
+        p.author = e["author"]
+    except Exception:
+        p.author = ""
 
-            try:
-                p.created = pyrfc3339.parse(e["date_published"])
-            except Exception:
-                output.write("\nCREATED ERROR")
-                p.created = timezone.now()
+    p.fingerprint = fingerprint
+    if SAVE_JSON:
+        p.json = e
+
+    p.body = body
+    writer.update(p)
+
+    try:
+        files = {}
+        for pe in e.get("attachments", []):
+            if "url" not in pe or pe["url"] in files:
+                continue
 
-            p.guid = guid
             try:
-                p.author = e["author"]
+                length = int(pe["size_in_bytes"])
             except Exception:
-                p.author = ""
+                length = 0
 
-            if SAVE_JSON:
-                p.json = e
+            # we are assuming podcasts here but that's probably not safe
+            files[pe["url"]] = {"length": length, "type": pe.get("mime_type", "audio/mpeg")}
 
-            p.save()
+        writer.sync_enclosures(p, files)
+    except Exception as ex:
+        output.write("\nNo enclosures - " + str(ex))
 
-            try:
-                seen_files = []
-                for ee in list(p.enclosures.all()):
-                    # check existing enclosure is still there
-                    found_enclosure = False
-                    if "attachments" in e:
-                        for pe in e["attachments"]:
-
-                            if pe["url"] == ee.href and ee.href not in seen_files:
-                                found_enclosure = True
-
-                                try:
-                                    ee.length = int(pe["size_in_bytes"])
-                                except Exception:
-                                    ee.length = 0
-
-                                try:
-                                    type = pe["mime_type"]
-                                except Exception:
-                                    type = "audio/mpeg"  # we are assuming podcasts here but that's probably not safe
-
-                                ee.type = type
-                                ee.save()
-                                break
-                    if not found_enclosure:
-                        if KEEP_OLD_ENCLOSURES:
-                            ee.is_current = False
-                            ee.save()
-                        else:
-                            ee.delete()
-                    seen_files.append(ee.href)
-
-                if "attachments" in e:
-                    for pe in e["attachments"]:
-
-                        try:
-                            if pe["url"] not in seen_files:
-
-                                try:
-                                    length = int(pe["size_in_bytes"])
-                                except Exception:
-                                    length = 0
-
-                                try:
-                                    type = pe["mime_type"]
-                                except Exception:
-                                    type = "audio/mpeg"
-
-                                ee = Enclosure(post=p, href=pe["url"], length=length, type=type)
-                                ee.save()
-                        except Exception:
-                            pass
-            except Exception as ex:
-                output.write("\nNo enclosures - " + str(ex))
+    return changed
 
-            try:
-                p.body = body
-                p.save()
-                # output.write(p.body)
-            except Exception as ex:
-                output.write(str(ex))
-                output.write(p.body)
+
+def parse_feed_json(source_feed, feed_content, output: TextIO, is_delta: bool = False):
+
+    ok = True
+    changed = False
+
+    try:
+        (f, clean) = read_json_document(feed_content, source_feed.site_url)
+        release_quarantine(source_feed)
+        entries = f['items']
+        if len(entries) or is_delta:
+            source_feed.last_success = timezone.now()  # in case we start auto unsubscribing long dead feeds
+        else:
+            source_feed.last_result = "Feed is empty"
+            source_feed.interval += 120
+            ok = False
+
+    except ParseLimitExceeded as ex:
+        output.write(f"\nQuarantined: {ex}")
+        quarantine(source_feed, str(ex))
+        entries = []
+        ok = False
+
+    except Exception:
+        source_feed.last_result = "Feed Parse Error"
+        entries = []
+        source_feed.interval += 120
+        ok = False
+
+    if ok:
+
+        if "expired" in f and f["expired"]:
+            # This feed says it is done
+            # TODO: permanently disable
+            # for now source_feed.interval to max
+            source_feed.interval = (24*3*60)
+            source_feed.last_result = "This feed has expired"
+            return (False, False)
+
+        if "home_page_url" in f:
+            source_feed.site_url = f["home_page_url"]
+            if "title" in clean:
+                source_feed.name = clean["title"]
+
+        if "description" in clean:
+            source_feed.description = clean["description"]
+
+        if "icon" in f:
+            source_feed.image_url = f["icon"]
+
+        # Entries are typically in reverse chronological order - put them in right order
+        parsed = [(e, (body, title), guid) for (e, (body, title, guid)) in zip(entries, clean["items"])]
+        parsed.reverse()
+
+        with transaction.atomic():
+            writer = PostWriter(source_feed, [guid for (e, body, guid) in parsed])
+            for (e, (body, title), guid, fingerprint) in writer.skip_unchanged(parsed, source_feed.site_url, output):
+                changed = _save_json_entry(writer, source_feed, e, body, title, guid, fingerprint, output) or changed
+            writer.save()
 
         if SAVE_JSON:
             f['items'] = []
             source_feed.json = f
-            source_feed.save(update_fields=["json"])
 
+    _fit(source_feed)
     return (ok, changed)
@@ -30,5 +30,9 @@ setuptools.setup(
         'pyrfc3339',
         'Django>=2.2'
     ],
+    extras_require={
+        'async': ['httpx'],
+        'brotli': ['brotli'],
+    },
     include_package_data=True,
 )
@@ -0,0 +1,49 @@
+"""Times feedparser against feeds.fastparser.
+
+Run from the root of the repo:
+
+    python support/benchmark_parser.py [feed.xml ...]
+
+With no arguments the RSS / Atom files in feeds/testdata are used.
+"""
+import glob
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure()  # fastparser doesn't need any, but the feeds package wants them set up
+
+import feedparser  # noqa: E402
+from feeds import fastparser  # noqa: E402
+
+
+def main(paths):
+    total_slow = total_fast = 0.0
+    print(f"{'feed':<32} {'entries':>7} {'feedparser':>11} {'fastparser':>11} {'speedup':>8}")
+    for path in paths:
+        content = open(path, "rb").read()
+        if fastparser.parse(content) is None:
+            print(f"{os.path.basename(path):<32} {'(uses feedparser)':>40}")
+            continue
+
+        number = max(1, 200000 // max(len(content), 1))
+        slow = min(timeit.repeat(lambda: feedparser.parse(content), number=number, repeat=3)) / number
+        fast = min(timeit.repeat(lambda: fastparser.parse(content), number=number, repeat=3)) / number
+        total_slow += slow
+        total_fast += fast
+
+        entries = len(fastparser.parse(content).entries)
+        print(f"{os.path.basename(path):<32} {entries:>7} {slow * 1000:>9.2f}ms {fast * 1000:>9.2f}ms {slow / fast:>7.1f}x")
+
+    if total_fast:
+        print(f"{'total':<32} {'':>7} {total_slow * 1000:>9.2f}ms {total_fast * 1000:>9.2f}ms {total_slow / total_fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(here, "feeds", "testdata", "*.xml"))))